@@ -376,7 +376,7 @@ class DeviceExampleServer(katcp.DeviceServer):
             for ant_str in ant_strs:
                 if not ant_str in self.c.config._get_ant_mapping_list(): 
                     return katcp.Message.reply(orgmsg.name,"fail","Antenna not found. Valid entries are %s."%str(self.c.config._get_ant_mapping_list()))
-            snap_data=self.c.get_adc_snapshots(ant_strs,trig_level=trig_level,sync_to_pps=sync_to_pps)
+            snap_data=self.c.get_adc_snapshots(ant_strs,trig_level=trig_level,sync_to_pps=sync_to_pps,use_cache=(trig_level<0))
             for ant_str,data in snap_data.iteritems():
                 self.reply_inform(sock,katcp.Message.inform(orgmsg.name,ant_str,str(data['timestamp']*1000),str(data['offset']),*data['data']),orgmsg)
             return katcp.Message.reply(orgmsg.name,'ok',str(len(snap_data)))
@@ -610,8 +610,13 @@ if __name__ == "__main__":
                       help='listen to HOST (default="" - all hosts)')
     parser.add_option('-p', '--port', dest='port', type=long, default=1235, metavar='N',
                       help='attach to port N (default=1235)')
+    parser.add_option('-s', '--snap_cache', dest='snap_cache', type=float, default=0, metavar='SECONDS',
+                      help='share untriggered ADC snapshot captures made within SECONDS between clients, zero to disable (default=0)')
     (opts, args) = parser.parse_args()
 
+    if opts.snap_cache > 0:
+        corr.snap.snapshot_cache_enable(max_age = opts.snap_cache)
+
     print "Server listening on port %d, Ctrl-C to terminate server" % opts.port
     restart_queue = Queue.Queue()
     server = DeviceExampleServer(opts.host, opts.port)
@@ -70,7 +70,7 @@ def getUnpackedData(requiredPol):
     # which fpga do we need?
     requiredFpga = antLocation[0]
     # get the data
-    unpacked_vals = corr.snap.get_quant_snapshot(correlator = c, ant_str = requiredPol, man_trig = True, man_valid = True, wait_period = 0.1)
+    unpacked_vals, n_spectra = corr.snap.get_quant_snapshot(correlator = c, ant_str = requiredPol, man_trig = True, man_valid = True, wait_period = 0.1)
     return unpacked_vals, requiredFpga
 
 # make the log handler
@@ -119,8 +119,8 @@ try:
         for p, pol in enumerate(polList):
             unpacked_vals, ffpga = getUnpackedData(pol)
             data = []
-            data.append([val.real for val in unpacked_vals])
-            data.append([val.imag for val in unpacked_vals])
+            data.append(unpacked_vals.real)
+            data.append(unpacked_vals.imag)
             globalHistMaxY = [[0,0], [0,0]]
             # real and imag per pol
             for d in 0, 1:
@@ -41,6 +41,24 @@ if __name__ == '__main__':
         help='Do not autoscale the data by dividing down by the number of accumulations.  Default: Scale back by n_accs.'
             ,
         )
+    p.add_option(
+        '-s',
+        '--shards',
+        dest='shards',
+        type='int',
+        default=1,
+        help='Receive inter mode data in this many processes, each on its own port counting up from rx_udp_port (see config_udp_output\'s n_ports). Default: 1.'
+            ,
+        )
+    p.add_option(
+        '-r',
+        '--reuse_port',
+        dest='reuse_port',
+        action='store_true',
+        default=False,
+        help='Have all the receive processes share rx_udp_port using SO_REUSEPORT instead of a port each.'
+            ,
+        )
     p.add_option(
         '-v',
         '--verbose',
@@ -56,6 +74,8 @@ if __name__ == '__main__':
     else:
         config_file = args[0]
     acc_scale = opts.acc_scale
+    shards = opts.shards
+    reuse_port = opts.reuse_port
     verbose = opts.verbose
 
 print 'Parsing config file...',
@@ -74,7 +94,12 @@ mode = config['xeng_format']
 filename = str(time.time()) + '.corr.h5'
 
 print 'Initalising SPEAD transports for %s data...' % mode
-print 'Data reception on port', data_port
+if shards > 1 and not reuse_port:
+    print 'Data reception in %i processes on ports %i-%i' % (shards, data_port, data_port + shards - 1)
+elif shards > 1:
+    print 'Data reception in %i processes sharing port %i' % (shards, data_port)
+else:
+    print 'Data reception on port', data_port
 print 'Sending Signal Display data to %s:%i.' % (sd_ip, sd_port)
 print 'Storing to file %s' % filename
 
@@ -85,6 +110,8 @@ crx = corr.rx.CorrRx(
     sd_port=sd_port,
     acc_scale=acc_scale,
     filename=filename,
+    shards=shards,
+    reuse_port=reuse_port,
     log_level=(logging.DEBUG if verbose else logging.INFO),
     )
 try:
@@ -96,3 +123,6 @@ try:
     crx.join()
 except KeyboardInterrupt:
     print 'Stopping...'
+    crx.stop()
+    crx.join()
+    print 'Files and sockets closed.'
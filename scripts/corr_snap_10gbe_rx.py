@@ -29,73 +29,6 @@ def exit_clean():
     except: pass
     exit()
 
-def unpack(f, hdr_index, pkt_len):
-    hdr_64bit = snap_data[f]['data'][hdr_index].data
-    pkt_mcnt = hdr_64bit >> 16
-    pkt_ant = hdr_64bit & ((2**16) - 1)
-    pkt_freq = pkt_mcnt % c.config['n_chans']
-    pkt_xeng = pkt_freq / (c.config['n_chans'] / c.config['n_xeng'])
-
-    sum_polQ_r = 0
-    sum_polQ_i = 0
-    sum_polI_r = 0
-    sum_polI_i = 0
-
-    # average the packet contents - ignore first entry (header)
-    for pkt_index in range(1, pkt_len):
-        pkt_64bit = snap_data[f]['data'][hdr_index + pkt_index].data
-        for offset in range(0, 64, 16):
-            polQ_r = (pkt_64bit & ((2**(offset+16)) - (2**(offset+12))))>>(offset+12)
-            polQ_i = (pkt_64bit & ((2**(offset+12)) - (2**(offset+8))))>>(offset+8)
-            polI_r = (pkt_64bit & ((2**(offset+8)) - (2**(offset+4))))>>(offset+4)
-            polI_i = (pkt_64bit & ((2**(offset+4)) - (2**(offset))))>>offset
-            #square each number and then sum it
-            sum_polQ_r += (float(((numpy.int8(polQ_r << 4)>> 4)))/(2**binary_point))**2
-            sum_polQ_i += (float(((numpy.int8(polQ_i << 4)>> 4)))/(2**binary_point))**2
-            sum_polI_r += (float(((numpy.int8(polI_r << 4)>> 4)))/(2**binary_point))**2
-            sum_polI_i += (float(((numpy.int8(polI_i << 4)>> 4)))/(2**binary_point))**2
-
-    num_accs = (pkt_len-1)*(64/16)
-
-    level_polQ_r = numpy.sqrt(float(sum_polQ_r)/ num_accs)
-    level_polQ_i = numpy.sqrt(float(sum_polQ_i)/ num_accs)
-    level_polI_r = numpy.sqrt(float(sum_polI_r)/ num_accs)
-    level_polI_i = numpy.sqrt(float(sum_polI_i)/ num_accs)
-
-    rms_polQ = numpy.sqrt(((level_polQ_r)**2)  +  ((level_polQ_i)**2))
-    rms_polI = numpy.sqrt(((level_polI_r)**2)  +  ((level_polI_i)**2))
-
-    if level_polQ_r < 1.0/(2**num_bits):
-        ave_bits_used_Q_r = 0
-    else:
-        ave_bits_used_Q_r = numpy.log2(level_polQ_r*(2**binary_point))
-
-    if level_polQ_i < 1.0/(2**num_bits):
-        ave_bits_used_Q_i = 0
-    else:
-        ave_bits_used_Q_i = numpy.log2(level_polQ_i*(2**binary_point))
-
-    if level_polI_r < 1.0/(2**num_bits):
-        ave_bits_used_I_r = 0
-    else:
-        ave_bits_used_I_r = numpy.log2(level_polI_r*(2**binary_point))
-
-    if level_polI_i < 1.0/(2**num_bits):
-        ave_bits_used_I_i = 0
-    else:
-        ave_bits_used_I_i = numpy.log2(level_polI_i*(2**binary_point))
-
-    return {'pkt_mcnt': pkt_mcnt,\
-            'pkt_ant':  pkt_ant,\
-            'pkt_freq': pkt_freq,\
-            'pkt_xeng': pkt_xeng,\
-            'rms_polQ': rms_polQ,\
-            'rms_polI': rms_polI,\
-            'ave_bits_used_Q_r':    ave_bits_used_Q_r,\
-            'ave_bits_used_Q_i':    ave_bits_used_Q_i,\
-            'ave_bits_used_I_r':    ave_bits_used_I_r,\
-            'ave_bits_used_I_i':    ave_bits_used_I_i}
-
 if __name__ == '__main__':
     from optparse import OptionParser
 
@@ -149,117 +82,83 @@ try:
     num_bits = c.config['feng_bits']
     packet_len = c.config['10gbe_pkt_len']
     n_ants = c.config['n_ants']
-    n_ants_per_xaui = c.config['n_ants_per_xaui']
-
-    # figure out which antennas are connected to this X engine via XAUI so that we can ignore the lack of any packets from these antennas...
-    base_ants = []
-
-    #base_ants = [[x for x in range(c.config['n_xaui_ports_per_xfpga'])] for f in c.xfpgas]
-    #x_with_connected_cables = n_ants / n_ants_per_xaui / c.config['n_xaui_ports_per_xfpga']
-    #ant = 0
-    #for x in range(c.config['n_xaui_ports_per_xfpga']):
-    #    for f in range(x_with_connected_cables):
-    #        base_ants[f][x] = ant
-    #        ant += n_ants_per_xaui
+    n_chans = c.config['n_chans']
+    chans_per_xeng = n_chans / c.config['n_xeng']
 
     report = dict()
-    mcnts = dict()
     print 'Analysing packets:'
     for s in snap_data:
-        f = s['fpga_index']        
+        f = s['fpga_index']
+        cols = s['columns']
         report[f] = dict()
-        mcnts[f] = dict()
-        report[f]['pkt_total'] = 0
-        pkt_len = 0
-        prev_eof_index = -1
         report[f]['fpga_index'] = f
-        fpga = c.xfpgas[f]
 
-        for i in range(len(s['data'])):
-            if opts.verbose or opts.raw:
-                pkt_64bit = snap_data[f]['data'][i].data
-                print '[%s] IDX: %4i Contents: %016x' % (c.xsrvs[f], i, pkt_64bit),
-                if s['data'][i].led_rx: print '[rx_data]',
-                if s['data'][i].valid: print '[valid]',
-                if s['data'][i].ack: print '[rd_ack]',
-                if not s['data'][i].led_up: print '[LNK DN]',
-                if s['data'][i].bad_frame: print '[BAD FRAME]',
-                if s['data'][i].overflow: print '[OVERFLOW]',
-                if s['data'][i].eof: print '[eof]',
+        if opts.verbose or opts.raw:
+            for i, d in enumerate(s['data']):
+                print '[%s] IDX: %4i Contents: %016x' % (c.xsrvs[f], i, d.data),
+                if d.led_rx: print '[rx_data]',
+                if d.valid: print '[valid]',
+                if d.ack: print '[rd_ack]',
+                if not d.led_up: print '[LNK DN]',
+                if d.bad_frame: print '[BAD FRAME]',
+                if d.overflow: print '[OVERFLOW]',
+                if d.eof: print '[eof]',
                 print ''
-
-            if s['data'][i].eof and not opts.raw:
-                pkt_ip_str = corr.corr_functions.ip2str(s['data'][i].ip_addr)
-                print '[%s] EOF at %4i. Src: %12s. Len: %3i. ' % (c.xsrvs[f], i, pkt_ip_str, i - prev_eof_index),
-                report[f]['pkt_total'] += 1
-                hdr_index = prev_eof_index + 1
-                pkt_len = i - prev_eof_index
-                prev_eof_index = i
-
-                if not report[f].has_key('dest_ips'):
-                    report[f].update({'dest_ips': {pkt_ip_str: 1}})
-                elif report[f]['dest_ips'].has_key(pkt_ip_str):
-                    report[f]['dest_ips'][pkt_ip_str] += 1
-                else:
-                    report[f]['dest_ips'].update({pkt_ip_str: 1})
-
-                if pkt_len != packet_len + 1:
-                    print '[BAD PKT LEN]'
-                    if not report[f].has_key('bad_pkt_len'):
-                        report[f]['bad_pkt_len'] = 1
-                    else:
-                        report[f]['bad_pkt_len'] += 1
-                else:
-                    unpkd_pkt = unpack(f, hdr_index, pkt_len)
-                    
-                    # Record the reception of the packet for this antenna, with this mcnt
-                    try: mcnts[f][unpkd_pkt['pkt_mcnt']][unpkd_pkt['pkt_ant']] = i
-                    except: 
-                        mcnts[f][unpkd_pkt['pkt_mcnt']] = numpy.ones(n_ants,numpy.int) * (-1)
-                        mcnts[f][unpkd_pkt['pkt_mcnt']][unpkd_pkt['pkt_ant']] = i
-                    #print mcnts
-
-                    print 'HDR @ %4i. MCNT %12u. Ant: %3i. Freq: %4i. Xeng: %2i, 4 bit power: PolQ: %4.2f, PolI: %4.2f' % (hdr_index, unpkd_pkt['pkt_mcnt'], unpkd_pkt['pkt_ant'], unpkd_pkt['pkt_freq'], unpkd_pkt['pkt_xeng'], unpkd_pkt['rms_polQ'], unpkd_pkt['rms_polI'])
-
-                    if not report[f].has_key('Antenna%i' % unpkd_pkt['pkt_ant']):
-                        report[f]['Antenna%i' % unpkd_pkt['pkt_ant']] = 1
-                    else:
-                        report[f]['Antenna%i' % unpkd_pkt['pkt_ant']] += 1
-
-        rcvd_mcnts = mcnts[f].keys()
-        rcvd_mcnts.sort()
-
-        if opts.verbose: print '[%s] Received mcnts: ' % c.xsrvs[f], rcvd_mcnts
+        if opts.raw:
+            continue
+
+        rebuilt = corr.snap.snapshot_packets(cols, packet_len, binary_point = binary_point, n_chans = n_chans)
+        pkts = rebuilt['packets']
+        rms = corr.snap.packet_levels(rebuilt['samples'])['rms']
+        report[f]['pkt_total'] = len(pkts)
+        for n, pkt in enumerate(pkts):
+            print '[%s] EOF at %4i. Src: %12s. Len: %3i. ' % (c.xsrvs[f], pkt['eof_index'], corr.corr_functions.ip2str(int(pkt['ip_addr'])), pkt['length']),
+            if not pkt['valid']:
+                print '[BAD PKT LEN]'
+            else:
+                print 'HDR @ %4i. MCNT %12u. Ant: %3i. Freq: %4i. Xeng: %2i, 4 bit power: PolQ: %4.2f, PolI: %4.2f' % (pkt['header_index'], pkt['mcnt'], pkt['ant'], pkt['freq'], pkt['freq'] / chans_per_xeng, rms[n][0], rms[n][1])
+
+        ips, ip_counts = numpy.unique(pkts['ip_addr'], return_counts = True)
+        if len(ips) > 0:
+            report[f]['dest_ips'] = dict([(corr.corr_functions.ip2str(int(ip)), int(ip_counts[n])) for n, ip in enumerate(ips)])
+        n_bad = int(numpy.sum(~pkts['valid']))
+        if n_bad > 0:
+            report[f]['bad_pkt_len'] = n_bad
+        good = pkts[pkts['valid']]
+        ants, ant_counts = numpy.unique(good['ant'], return_counts = True)
+        for n, ant in enumerate(ants):
+            report[f]['Antenna%i' % ant] = int(ant_counts[n])
+
+        # Record the reception of the packets for each antenna, with each mcnt
+        rcvd_mcnts, pkt_index = corr.snap.packets_by_mcnt(good, n_ants)
+        if opts.verbose: print '[%s] Received mcnts: ' % c.xsrvs[f], rcvd_mcnts.tolist()
         report[f]['min_pkt_latency'] = 99999999
         report[f]['max_pkt_latency'] = -1
-
-        for mcnt in rcvd_mcnts[2: -2]:
-            if c.config['feng_out_type'] == 'xaui':
-                # simulate the reception of the loopback antenna's mcnts, but only for the x engines that actually have connected f engines:
-                if f < x_with_connected_cables:
-                    print 'Replacing antennas on FPGA %s for mcnt %i' % (c.xsrvs[f], mcnt)
-                    for a in range(base_ants[f][opts.core_n],base_ants[f][opts.core_n] + c.config['n_ants_per_xaui']):
-                        mcnts[f][mcnt][a] = mcnts[f][mcnt].max()
-
-            # find the min and max indices of each mcnt:
-            max_mcnt = mcnts[f][mcnt].max() / pkt_len
-            min_mcnt = mcnts[f][mcnt].min() / pkt_len
-
-            # check to ensure that we received all data for each mcnt, by looking for any indices that weren't recorded:
-            if mcnts[f][mcnt].min() < 0:
-                if not report[f].has_key('missing_mcnts'):  report[f]['missing_mcnts'] = [mcnt]
-                else: report[f]['missing_mcnts'].append(mcnt)
-                if opts.verbose:
-                    print """[%s] We're missing data for mcnt %016i from antennas """ % (c.xsrvs[f], mcnt),
-                    for ant in range(n_ants):
-                        if mcnts[f][mcnt][ant] < 0: print ant,
-                    print ''
-
-            # check the latencies in the mcnt values:
-            if opts.verbose: print '[%s] MCNT: %i. Max: %i, Min: %i. Diff: %i' % (c.xsrvs[f], mcnt, max_mcnt, min_mcnt, max_mcnt - min_mcnt)
-            if (max_mcnt - min_mcnt) > 0:
-                if report[f]['max_pkt_latency'] < (max_mcnt - min_mcnt) and min_mcnt >= 0: report[f]['max_pkt_latency'] = max_mcnt - min_mcnt
-                if report[f]['min_pkt_latency'] > (max_mcnt - min_mcnt) and min_mcnt >= 0: report[f]['min_pkt_latency'] = max_mcnt - min_mcnt
+        rcvd_mcnts = rcvd_mcnts[2:-2]
+        pkt_index = pkt_index[2:-2]
+        if len(rcvd_mcnts) == 0:
+            continue
+        eof_index = numpy.where(pkt_index >= 0, good['eof_index'][pkt_index], -1)
+
+        # check to ensure that we received all data for each mcnt, by looking for any indices that weren't recorded:
+        missing = eof_index.min(axis = 1) < 0
+        if missing.any():
+            report[f]['missing_mcnts'] = rcvd_mcnts[missing].tolist()
+            if opts.verbose:
+                for m in numpy.flatnonzero(missing):
+                    print """[%s] We're missing data for mcnt %016i from antennas """ % (c.xsrvs[f], rcvd_mcnts[m]), numpy.flatnonzero(eof_index[m] < 0).tolist()
+
+        # check the latencies in the mcnt values:
+        max_mcnt = eof_index.max(axis = 1) / (packet_len + 1)
+        min_mcnt = eof_index.min(axis = 1) / (packet_len + 1)
+        latency = max_mcnt - min_mcnt
+        if opts.verbose:
+            for m, mcnt in enumerate(rcvd_mcnts):
+                print '[%s] MCNT: %i. Max: %i, Min: %i. Diff: %i' % (c.xsrvs[f], mcnt, max_mcnt[m], min_mcnt[m], latency[m])
+        counted = (latency > 0) & (min_mcnt >= 0)
+        if counted.any():
+            report[f]['max_pkt_latency'] = int(latency[counted].max())
+            report[f]['min_pkt_latency'] = int(latency[counted].min())
 
     print '\n\nDone with all servers.\nSummary:\n=========================='
     for k, r in report.iteritems():
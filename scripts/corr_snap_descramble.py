@@ -21,7 +21,6 @@ data_bitstruct = construct.BitStruct("oob",
     Flag("valid"),
     Flag("flag"),
     Flag("received"))
-data_repeater = construct.GreedyRepeater(data_bitstruct)
 
 dev_prefix = 'snap_descramble'
 
@@ -44,28 +43,18 @@ def exit_clean():
     exit()
 
 def xeng_in_unpack(oob, start_index):
-    sum_polQ_r = 0
-    sum_polQ_i = 0
-    sum_polI_r = 0
-    sum_polI_i = 0
-    rcvd_errs = 0
-    flag_errs = 0
+    """oob is a dictionary of numpy arrays, one per field, as decoded by corr.bitfield."""
     #average the packet contents from the very first entry
-    for slice_index in range(c.config['xeng_acc_len']):
-        abs_index = start_index + slice_index
-        polQ_r = (oob[abs_index]['data'] & ((2**(16)) - (2**(12))))>>(12)
-        polQ_i = (oob[abs_index]['data'] & ((2**(12)) - (2**(8))))>>(8)
-        polI_r = (oob[abs_index]['data'] & ((2**(8)) - (2**(4))))>>(4)
-        polI_i = (oob[abs_index]['data'] & ((2**(4)) - (2**(0))))>>0
-
-        #square each number and then sum it
-        sum_polQ_r += (float(((numpy.int8(polQ_r << 4)>> 4)))/(2**binary_point))**2
-        sum_polQ_i += (float(((numpy.int8(polQ_i << 4)>> 4)))/(2**binary_point))**2
-        sum_polI_r += (float(((numpy.int8(polI_r << 4)>> 4)))/(2**binary_point))**2
-        sum_polI_i += (float(((numpy.int8(polI_i << 4)>> 4)))/(2**binary_point))**2
-
-        if not oob[abs_index]['received']: rcvd_errs += 1
-        if oob[abs_index]['flag']: flag_errs += 1
+    stop_index = start_index + c.config['xeng_acc_len']
+    # each 16-bit data word is two bytes of packed 4-bit complex values, polQ then polI
+    vals = corr.snap.unpack_4bit_complex(oob['data'][start_index:stop_index].astype('>u2'), binary_point = binary_point)
+    #square each number and then sum it
+    sum_polQ_r = numpy.sum(vals[0::2].real.astype(numpy.float64)**2)
+    sum_polQ_i = numpy.sum(vals[0::2].imag.astype(numpy.float64)**2)
+    sum_polI_r = numpy.sum(vals[1::2].real.astype(numpy.float64)**2)
+    sum_polI_i = numpy.sum(vals[1::2].imag.astype(numpy.float64)**2)
+    rcvd_errs = int(numpy.sum(numpy.logical_not(oob['received'][start_index:stop_index])))
+    flag_errs = int(numpy.sum(oob['flag'][start_index:stop_index]))
 
     num_accs = c.config['xeng_acc_len']
 
@@ -107,27 +96,13 @@ def grab_snap_data(c, dev_name):
     """
     Grab the required amount of data off the snap blocks on the x-engines.
     """
-    dmp = dict()
     print 'Trying to retrieve %i words from %s for each x-engine...' % (expected_length, dev_name)
     print '------------------------'
-    #dmp = [[0 for i in range(expected_length*4)] for f in fpgas]
     print 'Triggering and capturing from offset 0 ...',
-    dmp = corr.snap.snapshots_get(c.xfpgas, dev_name, man_trig = man_trigger, man_valid = raw_capture, wait_period = 2, offset = 0, circular_capture = False)
+    sys.stdout.flush()
+    dmp = corr.snap.snapshots_get_long(c.xfpgas, dev_name, expected_length * 4, man_trig = man_trigger, man_valid = raw_capture, wait_period = 2, offset = 0, circular_capture = False, interval = 0.1)
     print 'done'
-    while (dmp['lengths'][0] / 4) < expected_length:
-        capture_offset = dmp['lengths'][0]
-        print 'Triggering and capturing at offset %i...' % capture_offset,
-        bram_tmp = corr.snap.snapshots_get(c.xfpgas, dev_name, man_trig = man_trigger, man_valid = raw_capture, wait_period = 1, offset = capture_offset, circular_capture = False)
-        for f, fpga in enumerate(c.xfpgas):
-            dmp['data'][f] += bram_tmp['data'][f]
-        print 'done'
-        for f, fpga in enumerate(c.xfpgas):
-            if (bram_tmp['lengths'][f] != bram_tmp['lengths'][f - 1]):
-                raise RuntimeError('Not all X engines captured the same amount of snapshot data.')
-            dmp['lengths'][f] += bram_tmp['lengths'][f]
-        time.sleep(0.1)
-    for f, fpga in enumerate(c.xfpgas):
-        dmp['data'][f] = ''.join(dmp['data'][f])
+    dmp['data'] = [d.tostring() for d in dmp['data']]
     #print 'BRAM DUMPS:'
     #print dmp
     for f, fpga in enumerate(c.xfpgas):
@@ -144,11 +119,13 @@ def create_data(c, xeng_number):
     print 'Unpacking bram contents...',
     sys.stdout.flush()
     oobdata = dict()
+    oobcols = dict()
     for f, fpga in enumerate(c.xfpgas):
         if snapdump['lengths'][f] == 0:
             print 'Warning: got nothing back from snap block %s on %s.' % (dev_name, c.xsrvs[f])
         else:
-            oobdata[f] = data_repeater.parse(snapdump['data'][f])
+            oobcols[f] = corr.bitfield.decode(data_bitstruct, snapdump['data'][f])
+            oobdata[f] = corr.bitfield.RowView(oobcols[f])
     print 'done.'
 
     if opts.verbose:
@@ -205,7 +182,7 @@ def create_data(c, xeng_number):
                 else:
                     exp_mcnt = ((i/c.config['xeng_acc_len'])/c.config['n_ants'])+ xeng*(c.config['n_chans']/c.config['n_xeng'])
                     exp_freq = (exp_mcnt) % c.config['n_chans']
-                xeng_unpkd = xeng_in_unpack(oobdata[f], i)
+                xeng_unpkd = xeng_in_unpack(oobcols[f], i)
                 if not freqs.__contains__(exp_freq):
                     if exp_freq != last_freq + 1:
                         print 'Frequency jumped from %d to %d' % (last_freq, exp_freq)
@@ -128,7 +128,7 @@ def get_data_nb_soft_fine_fft_coarse(pol, selectedchan = -1):
         print 'Need to get %i values: ' % requiredlen,
         while(len(snapdata) < requiredlen):
             tempdata = corr.corr_nb.get_snap_coarse_fft(c, fpgas = [pol['fpga']], pol = pol['pol'], setup_snap = False)[0]
-            snapdata.extend(tempdata)
+            snapdata = numpy.concatenate([snapdata, tempdata])
             print '%i/%i, ' % (len(snapdata), requiredlen),
             sys.stdout.flush()
         print ''
@@ -210,7 +210,7 @@ def get_data_nb_soft_fft_buffer_pfb(pol, pfb = False):
         print 'Need to get %i values: ' % requiredlen,
         while(len(snapdata) < requiredlen):
             tempdata = corr.corr_nb.get_snap_buffer_pfb(c, fpgas = [pol['fpga']], pol = pol['pol'], setup_snap = False, pfb = pfb)[0]
-            snapdata.extend(tempdata)
+            snapdata = numpy.concatenate([snapdata, tempdata])
             print '%i/%i, ' % (len(snapdata), requiredlen),
             sys.stdout.flush()
         print ''
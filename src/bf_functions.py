@@ -413,6 +413,7 @@ class fbf:
                 print 'optimisations on, single data item, writing in parallel'
             datum = data[0]
             n_bfs = len(self.get_bfs())
+            groups = []
             # run through all bfs
             for bf_index in range(n_bfs):
                 fpgas = []
@@ -427,18 +428,20 @@ class fbf:
                     if self.config.simulate == True:
                         print 'dummy executing non-blocking request for write to %s on %d fpgas' % (name, len(fpgas))
                     else:
-                        nottimedout, rv = corr.corr_functions.non_blocking_request(fpgas=fpgas, timeout=timeout,
-                                                                                   request='write',
-                                                                                   request_args=[name, offset*4, datum])
-                        if nottimedout == False:
-                            raise fbfException(1, 'Timeout asynchronously writing 0x%.8x to %s on %d fpgas offset %i'
-                                               % (data[0], name, len(fpgas), offset), 'function %s, line no %s\n'
-                                               % (__name__, inspect.currentframe().f_lineno), self.syslogger)
-                        for k, v in rv.items():
-                            if v['reply'] != 'ok':
-                                raise fbfException(1, 'Got %s instead of ''ok'' when writing 0x%.8x to %s:%s offset %i'
-                                                   % (v['reply'], data[0], k, name, offset), 'function %s, line no %s\n'
-                                                   % (__name__, inspect.currentframe().f_lineno), self.syslogger)
+                        # start the writes for every bf before waiting on any of them
+                        groups.append(corr.katcp_wrapper.FpgaAsyncRequestGroup(fpgas, 'write', [name, offset*4, datum], timeout))
+            for group in groups:
+                group.wait()
+            for group in groups:
+                name = group.request_args[0]
+                if len(group.timed_out) > 0:
+                    raise fbfException(1, 'Timeout asynchronously writing 0x%.8x to %s on %d of %d fpgas offset %i: %s'
+                                       % (data[0], name, len(group.timed_out), len(group.fpgas), offset, ', '.join(group.timed_out)),
+                                       'function %s, line no %s\n' % (__name__, inspect.currentframe().f_lineno), self.syslogger)
+                for k in group.failed:
+                    raise fbfException(1, 'Got %s instead of ''ok'' when writing 0x%.8x to %s:%s offset %i'
+                                       % (group.results[k]['reply'], data[0], k, name, offset), 'function %s, line no %s\n'
+                                       % (__name__, inspect.currentframe().f_lineno), self.syslogger)
         # optimisations off, or (many data, or a single target) so many separate writes
         else:
             if self.config.simulate == True:
@@ -0,0 +1,219 @@
+"""
+Compiled decoders for the construct.BitStruct layouts used for registers and snap blocks.
+
+construct parses a BitStruct a bit at a time in Python, which is slow for status polling and very slow for snapshots of thousands of words.
+compile_bitstruct turns a BitStruct made of Flags, unsigned or signed BitFields and Padding into a table of shifts and masks once,
+which can then decode a single register value, or a whole snapshot's worth of words with numpy.
+Field names are the same as those returned by the construct parse.
+"""
+
+import numpy, construct
+
+FIELD_FLAG = 'flag'
+FIELD_UINT = 'uint'
+FIELD_INT = 'int'
+
+class CompiledBitStruct:
+    """A BitStruct layout compiled into shift/mask tables. Use compile_bitstruct to get one.
+    """
+    def __init__(self, bitstruct):
+        self.name = bitstruct.name
+        self.bitstruct = bitstruct
+        if not isinstance(bitstruct, construct.Buffered):
+            raise RuntimeError('%s is not a BitStruct.' % bitstruct.name)
+        # bits per record and the width of the words the record is split into
+        self.width = 0
+        layout = []
+        for sc in bitstruct.subcon.subcons:
+            width = sc.sizeof()
+            if sc.name == None:
+                kind = None
+            elif isinstance(sc, construct.MappingAdapter):
+                if width != 1:
+                    raise RuntimeError('Field %s in %s is a mapping wider than one bit.' % (sc.name, self.name))
+                kind = FIELD_FLAG
+            elif isinstance(sc, construct.BitIntegerAdapter):
+                if sc.swapped:
+                    raise RuntimeError('Field %s in %s is byte-swapped, which is not supported.' % (sc.name, self.name))
+                if width > 64:
+                    raise RuntimeError('Field %s in %s is wider than 64 bits.' % (sc.name, self.name))
+                kind = FIELD_INT if sc.signed else FIELD_UINT
+            else:
+                raise RuntimeError('Field %s in %s is not a Flag, BitField or Padding.' % (sc.name, self.name))
+            layout.append((sc.name, width, kind))
+            self.width += width
+        if self.width % 8 != 0:
+            raise RuntimeError('%s is not a whole number of bytes wide.' % self.name)
+        self.size = self.width / 8
+        if self.width % 32 == 0:
+            self.word_bits = 32
+        elif self.width % 16 == 0:
+            self.word_bits = 16
+        else:
+            self.word_bits = 8
+        self.n_words = self.width / self.word_bits
+        self.word_dtype = numpy.dtype('>u%i' % (self.word_bits / 8))
+        # fields holds (name, shift from the lsb of the record, width, kind), msb first like the construct parse
+        self.fields = []
+        shift = self.width
+        for name, width, kind in layout:
+            shift -= width
+            if kind != None:
+                self.fields.append((name, shift, width, kind))
+        self.names = [f[0] for f in self.fields]
+        self._pieces = {}
+        dt = []
+        for name, shift, width, kind in self.fields:
+            self._pieces[name] = self._field_pieces(shift, width)
+            dt.append((name, _field_dtype(width, kind)))
+        self.dtype = numpy.dtype(dt)
+
+    def _field_pieces(self, shift, width):
+        """Work out which words a field is spread over: a list of (word index, shift in word, mask, shift in field)."""
+        pieces = []
+        lsb = shift
+        msb = shift + width - 1
+        for w in range(self.n_words):
+            # words are big-endian, so word 0 holds the most significant bits of the record
+            w_lsb = (self.n_words - 1 - w) * self.word_bits
+            w_msb = w_lsb + self.word_bits - 1
+            lo = max(lsb, w_lsb)
+            hi = min(msb, w_msb)
+            if lo > hi:
+                continue
+            pieces.append((w, lo - w_lsb, (1 << (hi - lo + 1)) - 1, lo - lsb))
+        return pieces
+
+    def field(self, name):
+        """Return (shift, width, kind) for the named field."""
+        for f in self.fields:
+            if f[0] == name:
+                return f[1:]
+        raise RuntimeError('No field %s in %s.' % (name, self.name))
+
+    def decode_value(self, value):
+        """Decode one record, given as an integer, into a dictionary of field values, as construct's parse would."""
+        rv = {}
+        for name, shift, width, kind in self.fields:
+            v = (value >> shift) & ((1 << width) - 1)
+            if kind == FIELD_FLAG:
+                v = (v == 1)
+            elif (kind == FIELD_INT) and (v >> (width - 1)):
+                v -= (1 << width)
+            rv[name] = v
+        return rv
+
+    def decode_string(self, data):
+        """Decode one record given as a big-endian binary string."""
+        value = 0
+        for c in data[0:self.size]:
+            value = (value << 8) | ord(c)
+        return self.decode_value(value)
+
+    def words(self, data):
+        """Turn snapshot data - a binary string or a numpy array of words - into an (n_records, n_words) array. A partial last record is dropped, as GreedyRepeater would.
+        """
+        if isinstance(data, str):
+            n = len(data) / self.size
+            return numpy.frombuffer(data, dtype = self.word_dtype, count = n * self.n_words).reshape(n, self.n_words)
+        data = numpy.asarray(data)
+        if data.dtype.itemsize * 8 != self.word_bits:
+            # raw bytes, or words of some other size, from a snap block
+            raw = numpy.ascontiguousarray(data).view(numpy.uint8)
+            n = raw.size / self.size
+            return numpy.frombuffer(raw, dtype = self.word_dtype, count = n * self.n_words).reshape(n, self.n_words)
+        if data.ndim == 2:
+            if data.shape[1] != self.n_words:
+                raise RuntimeError('%s needs %i words per record, got %i.' % (self.name, self.n_words, data.shape[1]))
+            return data
+        n = data.size / self.n_words
+        return data[0:n * self.n_words].reshape(n, self.n_words)
+
+    def decode(self, data, names = None):
+        """Decode a whole snapshot into a dictionary of numpy arrays, one per field.
+        @param data: a binary string, as read from a snap block, an array of bytes or an array of words
+        @param names: optional list of the fields wanted, default all of them
+        """
+        words = self.words(data)
+        if names == None:
+            names = self.names
+        rv = {}
+        for name in names:
+            shift, width, kind = self.field(name)
+            pieces = self._pieces[name]
+            if len(pieces) == 1:
+                w, wshift, mask, fshift = pieces[0]
+                v = (words[:, w] >> wshift) & mask
+            else:
+                v = numpy.zeros(words.shape[0], dtype = numpy.uint64)
+                for w, wshift, mask, fshift in pieces:
+                    v |= ((words[:, w] >> wshift) & mask).astype(numpy.uint64) << numpy.uint64(fshift)
+            if (kind == FIELD_INT) and (width == 64):
+                v = v.astype(numpy.uint64).view(numpy.int64)
+            elif kind == FIELD_INT:
+                v = v.astype(numpy.int64)
+                v[v >= (1 << (width - 1))] -= (1 << width)
+            rv[name] = v.astype(_field_dtype(width, kind))
+        return rv
+
+    def decode_array(self, data):
+        """Decode a whole snapshot into a numpy structured array with one named field per BitStruct field."""
+        cols = self.decode(data)
+        n = 0
+        if len(self.names) > 0:
+            n = cols[self.names[0]].shape[0]
+        rv = numpy.empty(n, dtype = self.dtype)
+        for name in self.names:
+            rv[name] = cols[name]
+        return rv
+
+def _field_dtype(width, kind):
+    if kind == FIELD_FLAG:
+        return numpy.bool_
+    for bits in [8, 16, 32, 64]:
+        if width <= bits:
+            break
+    if kind == FIELD_INT:
+        return numpy.dtype('int%i' % bits)
+    return numpy.dtype('uint%i' % bits)
+
+_compiled = {}
+
+def compile_bitstruct(bitstruct):
+    """Return the CompiledBitStruct for a construct.BitStruct, compiling it the first time it is seen."""
+    key = id(bitstruct)
+    if not _compiled.has_key(key):
+        _compiled[key] = (bitstruct, CompiledBitStruct(bitstruct))
+    return _compiled[key][1]
+
+def decode(bitstruct, data, names = None):
+    """Decode snapshot data into a dictionary of numpy arrays using the compiled form of the given BitStruct."""
+    return compile_bitstruct(bitstruct).decode(data, names)
+
+def decode_value(bitstruct, value):
+    """Decode a register value into a dictionary using the compiled form of the given BitStruct."""
+    return compile_bitstruct(bitstruct).decode_value(value)
+
+class RowView:
+    """A read-only, list-like view of decoded columns that gives one construct.Container per record,
+    for code written against the output of construct.GreedyRepeater. The rows are built on first use.
+    """
+    def __init__(self, columns, names = None):
+        self.columns = columns
+        if names == None:
+            names = columns.keys()
+        self.names = names
+        self._rows = None
+    def _build(self):
+        if self._rows == None:
+            lists = [self.columns[n].tolist() for n in self.names]
+            self._rows = [construct.Container(**dict(zip(self.names, vals))) for vals in zip(*lists)]
+        return self._rows
+    def __len__(self):
+        if len(self.names) == 0:
+            return 0
+        return len(self.columns[self.names[0]])
+    def __getitem__(self, index):
+        return self._build()[index]
+    def __iter__(self):
+        return iter(self._build())
@@ -81,72 +81,121 @@ def ip2str(pkt_ip, verbose = False):
         print 'IP(%i) decoded to:' % pkt_ip, ipstr
     return ipstr
 
+def masked_register_fields(bitstruct):
+    """
+    Return a dictionary of {field name: (shift, mask, is_flag)} for a 32-bit construct.BitStruct, so that fields can be updated with integer operations instead of a construct parse and build.
+    The layout is compiled once by corr.bitfield, so this is cheap to call repeatedly.
+    """
+    compiled = corr.bitfield.compile_bitstruct(bitstruct)
+    if compiled.width != 32:
+        raise RuntimeError('Function can only work with 32-bit bitfields.')
+    fields = {}
+    for name, shift, width, kind in compiled.fields:
+        if kind == corr.bitfield.FIELD_INT:
+            raise RuntimeError('Field %s in bitfield %s is signed, which is not supported.' % (name, bitstruct.name))
+        fields[name] = (shift, (1 << width) - 1, kind == corr.bitfield.FIELD_FLAG)
+    return fields
+
+def masked_register_update(fields, value, **kwargs):
+    """
+    Apply field updates to a 32-bit register value, using the table from masked_register_fields. A field value of 'toggle' inverts the current value.
+    """
+    for key, fval in kwargs.iteritems():
+        if not fields.has_key(key):
+            raise RuntimeError('Attempting to write key %s but it doesn\'t exist in bitfield.' % key)
+        shift, mask, is_flag = fields[key]
+        if fval == 'toggle':
+            fval = not ((value >> shift) & mask)
+        if is_flag:
+            fval = 1 if fval else 0
+        fval = int(fval)
+        if (fval < 0) or (fval > mask):
+            raise RuntimeError('Value %i does not fit in field %s.' % (fval, key))
+        value = (value & ~(mask << shift)) | (fval << shift)
+    return value & 0xffffffff
+
+def _masked_register_names(device_list, bitstruct, names):
+    registerNames = names
+    if registerNames == None:
+        registerNames = []
+        for d in device_list: registerNames.append(bitstruct.name)
+    if len(registerNames) !=  len(device_list):
+        raise RuntimeError('Length of list of register names does not match length of list of devices given.')
+    return registerNames
+
+def _masked_register_read(device, register_name, use_shadow):
+    if use_shadow and hasattr(device, 'shadow_read_uint'):
+        return device.shadow_read_uint(register_name)
+    return device.read_uint(register_name)
+
+def _masked_register_write(device, register_name, values):
+    for v in values:
+        device.write_int(register_name, v)
+
 def write_masked_register(device_list, bitstruct, names = None, **kwargs):
     """
     Modify arbitrary bitfields within a 32-bit register, given a list of devices that offer the write_int interface - should be KATCP FPGA devices.
+    The register is read from all the devices at once, the fields are updated with precomputed masks and the new values are written back to all the devices at once.
     """
-    # lazily let the read function check our arguments
-    currentValues = read_masked_register(device_list, bitstruct, names, return_dict = False)
-    wv = []
+    if bitstruct == None:
+        return
+    fields = masked_register_fields(bitstruct)
+    registerNames = _masked_register_names(device_list, bitstruct, names)
+    updates = {}
     pulse_keys = []
-    for c in currentValues:
-        for key in kwargs:
-            if not c.__dict__.has_key(key):
-                raise RuntimeError('Attempting to write key %s but it doesn\'t exist in bitfield.' % key)
-            if kwargs[key] == 'pulse':
-                if pulse_keys.count(key) == 0: pulse_keys.append(key)
-            else:
-                c.__dict__[key] = (not c.__dict__[key]) if (kwargs[key] == 'toggle') else kwargs[key]
-        bitstring = bitstruct.build(c)
-        unpacked = struct.unpack('>I', bitstring)
-        wv.append(unpacked[0])
-    for d, device in enumerate(device_list):
-        device.write_int(c.register_name, wv[d])
-    # now pulse any that were asked to be pulsed
-    if len(pulse_keys) > 0:
-        #print 'Pulsing keys from write_... :(', pulse_keys
-        pulse_masked_register(device_list, bitstruct, pulse_keys)
-
-def read_masked_register(device_list, bitstruct, names = None, return_dict = True):
+    for key in kwargs:
+        if not fields.has_key(key):
+            raise RuntimeError('Attempting to write key %s but it doesn\'t exist in bitfield.' % key)
+        if kwargs[key] == 'pulse':
+            pulse_keys.append(key)
+        else:
+            updates[key] = kwargs[key]
+    currentValues = corr.threaded.run_jobs(device_list, _masked_register_read, [(n, True) for n in registerNames])
+    wv = [masked_register_update(fields, v, **updates) for v in currentValues]
+    # pulses go out in the same pass as the write, ie new value, pulse high, pulse low
+    writes = []
+    for d, v in enumerate(wv):
+        if len(pulse_keys) > 0:
+            zeroKwargs = dict([(k, 0) for k in pulse_keys])
+            oneKwargs = dict([(k, 1) for k in pulse_keys])
+            low = masked_register_update(fields, v, **zeroKwargs)
+            writes.append((registerNames[d], [low, masked_register_update(fields, v, **oneKwargs), low]))
+        else:
+            writes.append((registerNames[d], [v]))
+    corr.threaded.run_jobs(device_list, _masked_register_write, writes)
+
+def read_masked_register(device_list, bitstruct, names = None, return_dict = True, use_shadow = False):
     """
     Read a 32-bit register from each of the devices (anything that provides the read_uint interface) in the supplied list and apply the given construct.BitStruct to the data.
     A list of Containers or dictionaries is returned, indexing the same as the supplied list.
+    If use_shadow is set, devices that keep a register shadow (see FpgaClient.shadow_enable) return the value last written instead of reading the hardware.
     """
     if bitstruct == None:
         return
-    if bitstruct.sizeof() != 4:
+    compiled = corr.bitfield.compile_bitstruct(bitstruct)
+    if compiled.width != 32:
         raise RuntimeError('Function can only work with 32-bit bitfields.')
-    registerNames = names
-    if registerNames == None:
-        registerNames = []
-        for d in device_list: registerNames.append(bitstruct.name)
-    if len(registerNames) !=  len(device_list):
-        raise RuntimeError('Length of list of register names does not match length of list of devices given.')
+    registerNames = _masked_register_names(device_list, bitstruct, names)
+    values = corr.threaded.run_jobs(device_list, _masked_register_read, [(n, use_shadow) for n in registerNames])
     rv = []
-    for d, device in enumerate(device_list):
-        vuint = device.read_uint(registerNames[d])
-        rtmp = bitstruct.parse(struct.pack('>I', vuint))
-        rtmp.raw = vuint
-        rtmp.register_name = registerNames[d]
-        if return_dict: rtmp = rtmp.__dict__
+    for d, vuint in enumerate(values):
+        rtmp = compiled.decode_value(vuint)
+        rtmp['raw'] = vuint
+        rtmp['register_name'] = registerNames[d]
+        if not return_dict: rtmp = construct.Container(**rtmp)
         rv.append(rtmp)
     return rv
 
-def pulse_masked_register(device_list, bitstruct, fields):
+def pulse_masked_register(device_list, bitstruct, fields, names = None):
     """
     Pulse a boolean var somewhere in a masked register.
     The fields argument is a list of strings representing the fields to be pulsed. Does NOT check Flag vs BitField, so make sure!
-    http://stackoverflow.com/questions/1098549/proper-way-to-use-kwargs-in-python
+    The register is read once and the low, high, low values are then written to all the devices concurrently.
     """
-    zeroKwargs = {}
-    oneKwargs = {}
+    kwargs = {}
     for field in fields:
-      zeroKwargs[field] = 0
-      oneKwargs[field] = 1
-    #print zeroKwargs, '|', oneKwargs
-    write_masked_register(device_list, bitstruct, **zeroKwargs)
-    write_masked_register(device_list, bitstruct, **oneKwargs)
-    write_masked_register(device_list, bitstruct, **zeroKwargs)
+        kwargs[field] = 'pulse'
+    write_masked_register(device_list, bitstruct, names, **kwargs)
 
 def log_runtimeerror(logger, err):
     """Have the logger log an error and then raise it.
@@ -156,72 +205,72 @@ def log_runtimeerror(logger, err):
 
 def non_blocking_request(fpgas, timeout, request, request_args):
     """Make a non-blocking request to one or more FPGAs, using the Asynchronous FPGA client.
+    timeout can be a number of seconds, or a dictionary of per-host timeouts.
+    Returns a tuple: whether every host replied in time, and a dictionary of the replies that did arrive, keyed on host.
+    Use katcp_wrapper.FpgaAsyncRequestGroup directly to find out which hosts timed out, or to poll for completion.
+    """
+    group = corr.katcp_wrapper.FpgaAsyncRequestGroup(fpgas, request, request_args, timeout)
+    group.wait()
+    return (len(group.timed_out) == 0), (group.results)
+
+def fanout_request(fpgas, request, request_args, timeout = 10):
+    """Issue the same request to every FPGA in the list at once and collect the replies.
+    Returns a list of reply dictionaries (as per non_blocking_request), ordered the same as the supplied list.
+    Raises a RuntimeError naming every board that timed out or didn't reply 'ok'.
+    """
+    if len(fpgas) == 0:
+        return []
+    group = corr.katcp_wrapper.FpgaAsyncRequestGroup(fpgas, request, request_args, timeout)
+    group.wait()
+    check_request_group(group)
+    return [group.results[f.host] for f in fpgas]
+
+def check_request_group(group):
+    """Raise a RuntimeError naming every board in a completed katcp_wrapper.FpgaAsyncRequestGroup that timed out or didn't reply 'ok'."""
+    if group.ok():
+        return
+    errors = ['%s: timed out' % host for host in group.timed_out]
+    for f in group.fpgas:
+        if f.host in group.failed:
+            f._logger.error('Request \'%s\' failed: %s' % (group.request, group.results[f.host]['reply_args']))
+            errors.append('%s: %s' % (f.host, ' '.join([str(a) for a in group.results[f.host]['reply_args']])))
+    raise RuntimeError('Request \'%s\' failed on %i of %i FPGAs:\n  %s' % (group.request, len(errors), len(group.fpgas), '\n  '.join(errors)))
+
+def _fanout_read_job(fpga, register, size, offset):
+    return fpga.read(register, size, offset)
+
+def fanout_read(fpgas, register, size, offset = 0, timeout = 10):
+    """Reads size bytes from the named register on all the FPGAs concurrently. Returns a list of binary strings, ordered the same as the supplied list.
+    Reads bigger than a board's bulkread_threshold are done with FpgaClient.read on each board, so that they use bulkread. timeout doesn't apply to those.
     """
-    import Queue, threading
-    verbose = False
-    reply_queue = Queue.Queue(maxsize=len(fpgas))
-    requests = {}
-    # reply callback
-    def reply_cb(host, request_id):
-        #if not requests.has_key(host):
-        #    raise RuntimeError('Rx reply(%s) from host(%s), did not send request?' % (request_id, host))
-        ## is the reply queue full?
-        #if reply_queue.full():
-        #    raise RuntimeError('Rx reply(%s) from host(%s), reply queue is full?' % (request_id, host))
-        if verbose: print 'Reply(%s) from host(%s)' % (request_id, host); sys.stdout.flush()
-        reply_queue.put_nowait([host, request_id])
-    # start the requests
-    if verbose: print 'Send request(%s) to %i hosts.' % (request, len(fpgas))
-    lock = threading.Lock()
-    for f in fpgas:
-        lock.acquire()
-        r = f._nb_request(request, None, reply_cb, *request_args)
-        requests[r['host']] = [r['request'], r['id']]
-        lock.release()
-        if verbose: print 'Request \'%s\' id(%s) to host(%s)' % (r['request'], r['id'], r['host']); sys.stdout.flush()
-    # wait for replies from the requests
-    replies = {}
-    timedout = False
-    done = False
-    while (not timedout) and (not done):
-        try:
-            it = reply_queue.get(block = True, timeout = timeout)
-        except:
-            timedout = True
-            break
-        replies[it[0]] = it[1]
-        if len(replies) == len(fpgas): done = True
-    if timedout and verbose:
-        print replies
-        print "non_blocking_request timeout after %is." % timeout; sys.stdout.flush()
-    rv = {}
     for f in fpgas:
-        frv = {}
-        try:
-            request_id = replies[f.host]
-        except:
-            print replies
-            sys.stdout.flush()
-            raise KeyError('Didn\'t get a reply for FPGA \'%s\' so the request \'%s\' probably didn\'t complete.' % (f.host, request))
-        reply, informs = f._nb_get_request_result(request_id)
-        frv['request'] = requests[f.host][0]
-        frv['reply'] = reply.arguments[0]
-        frv['reply_args'] = reply.arguments
-        informlist = []
-        for inf in informs:
-            informlist.append(inf.arguments)
-        frv['informs'] = informlist
-        rv[f.host] = frv
-        f._nb_pop_request_by_id(request_id)
-    return (not timedout), (rv)
+        if (f.bulkread_threshold >= 0) and (size > f.bulkread_threshold):
+            return corr.threaded.run_jobs(fpgas, _fanout_read_job, [(register, size, offset) for f in fpgas])
+    rv = fanout_request(fpgas, 'read', [register, str(offset), str(size)], timeout = timeout)
+    return [r['reply_args'][1] for r in rv]
+
+def fanout_write(fpgas, register, data, offset = 0, blindwrite = False, timeout = 10):
+    """Writes the same binary string to the named register on all the FPGAs concurrently and, unless blindwrite is set, reads it back from all of them to verify."""
+    fanout_request(fpgas, 'write', [register, str(offset), data], timeout = timeout)
+    if blindwrite:
+        return
+    errors = []
+    for f, new_data in zip(fpgas, fanout_read(fpgas, register, len(data), offset, timeout = timeout)):
+        if new_data != data:
+            f._logger.error('Verification of write to %s at offset %d failed.' % (register, offset))
+            errors.append(f.host)
+    if len(errors) > 0:
+        raise RuntimeError('Verification of write to %s at offset %d failed on FPGAs: %s' % (register, offset, ', '.join(errors)))
 
 katcp_prefix = '/'
 if os.environ.has_key('VIRTUAL_ENV'):
     katcp_prefix = os.environ['VIRTUAL_ENV']
 default_config = os.path.join(katcp_prefix, 'etc/corr/default')
 class Correlator:
-    def __init__(self, connect = True, config_file = default_config, log_handler = None, log_level = logging.INFO):
+    def __init__(self, connect = True, config_file = default_config, log_handler = None, log_level = logging.INFO, max_threads = -1):
         global default_config
+        self.max_threads = max_threads
+        self.pool = None
         self.log_handler = log_handler if log_handler != None else corr.log_handlers.DebugLogHandler(100)
         self.syslogger = logging.getLogger('corrsys')
         self.syslogger.addHandler(self.log_handler)
@@ -255,6 +304,11 @@ class Correlator:
         self.ffpgas=[corr.katcp_wrapper.FpgaClient(server,self.config['katcp_port'],
                        timeout=10,logger=self.floggers[s]) for s,server in enumerate(self.fsrvs)]
         self.allfpgas = self.ffpgas + self.xfpgas
+        if self.pool == None:
+            self.pool = corr.threaded.FpgaWorkerPool(num_threads = self.max_threads if self.max_threads > 0 else max(1, len(self.allfpgas)))
+        # everything that runs per-board jobs on these boards uses this pool, see threaded.pool_for
+        for fpga in self.allfpgas:
+            fpga.pool = self.pool
         time.sleep(1)
         if not self.check_katcp_connections():
             raise RuntimeError("Connection to FPGA boards failed.")
@@ -270,6 +324,11 @@ class Correlator:
             for fpga in (self.allfpgas): fpga.stop()
         except:
             pass
+        if self.pool != None:
+            for fpga in self.allfpgas:
+                if fpga.pool == self.pool: fpga.pool = None
+            self.pool.stop()
+            self.pool = None
 
     def get_rcs(self):
         """Extracts and returns a dictionary of the version control information from the F and X engines."""
@@ -378,18 +437,14 @@ class Correlator:
     def prog_all(self, timeout=10):
         """Progam all the FPGAs asynchronously."""
         self.syslogger.info("Programming all FPGAs.")
-        f_nottimedout, frv = non_blocking_request(fpgas = self.ffpgas, timeout = timeout, request = 'progdev', request_args = [self.config['bitstream_f']])
-        f_okay = True
-        for k, v in frv.items():
-            if v['reply'] != 'ok': f_okay = False
-        x_nottimedout, xrv = non_blocking_request(fpgas = self.xfpgas, timeout = timeout, request = 'progdev', request_args = [self.config['bitstream_x']])
-        x_okay = True
-        for k, v in xrv.items():
-            if v['reply'] != 'ok': x_okay = False
-        if not(f_nottimedout and x_nottimedout):
-            raise RuntimeError('Programming the FPGAs timed out: F(%i) X(%i)' % (not f_nottimedout, not x_nottimedout))
-        elif not(x_okay and f_okay):
-            errstr = 'One or more FPGAs didn\'t reply \'ok\' to progdev request:\n', str(frv), '\n', str(xrv)
+        fgroup = corr.katcp_wrapper.FpgaAsyncRequestGroup(self.ffpgas, 'progdev', [self.config['bitstream_f']], timeout)
+        xgroup = corr.katcp_wrapper.FpgaAsyncRequestGroup(self.xfpgas, 'progdev', [self.config['bitstream_x']], timeout)
+        fgroup.wait()
+        xgroup.wait()
+        if len(fgroup.timed_out) > 0 or len(xgroup.timed_out) > 0:
+            raise RuntimeError('Programming the FPGAs timed out: %s' % ', '.join(fgroup.timed_out + xgroup.timed_out))
+        elif not(fgroup.ok() and xgroup.ok()):
+            errstr = 'One or more FPGAs didn\'t reply \'ok\' to progdev request: %s' % ', '.join(fgroup.failed + xgroup.failed)
             raise RuntimeError(errstr)
         elif not self.check_fpga_comms():
             raise RuntimeError("FPGAs were programmed but we don\'t have comms?")
@@ -417,15 +472,16 @@ class Correlator:
         """Checks FPGA <-> BORPH communications by writing a random number into a special register, reading it back and comparing."""
         #Modified 2010-01-03 so that it works on 32 bit machines by only generating random numbers up to 2**30.
         rv = True
-        for fn,fpga in enumerate(self.allfpgas):
+        def write_scratchpad(fpga):
             #keep the random number below 2^32-1 and do not include zero (default register start value), but use a fair bit of the address space...
-            rn=numpy.random.randint(1,2**30)
-            try:
-                fpga.write_int('sys_scratchpad',rn)
-                self.loggers[fn].info("FPGA comms ok")
-            except:
+            fpga.write_int('sys_scratchpad',numpy.random.randint(1,2**30))
+        results = self.pool.map(self.allfpgas, write_scratchpad)
+        for fn,fpga in enumerate(self.allfpgas):
+            if isinstance(results[fpga.host], RuntimeError):
                 rv=False
                 self.loggers[fn].error("FPGA comms failed")
+            else:
+                self.loggers[fn].info("FPGA comms ok")
         if rv==True: self.syslogger.info("All FPGA comms ok.")
         return rv
 
@@ -440,29 +496,27 @@ class Correlator:
 
     def xread_all(self,register,bram_size,offset=0):
         """Reads a register of specified size from all X-engines. Returns a list."""
-        rv = [fpga.read(register,bram_size,offset) for fpga in self.xfpgas]
-        return rv
+        return fanout_read(self.xfpgas, register, bram_size, offset)
 
     def fread_all(self,register,bram_size,offset=0):
         """Reads a register of specified size from all F-engines. Returns a list."""
-        rv = [fpga.read(register,bram_size,offset) for fpga in self.ffpgas]
-        return rv
+        return fanout_read(self.ffpgas, register, bram_size, offset)
 
     def xread_uint_all(self, register):
         """Reads a value from register 'register' for all X-engine FPGAs."""
-        return [fpga.read_uint(register) for fpga in self.xfpgas]
+        return [struct.unpack('>I', d)[0] for d in fanout_read(self.xfpgas, register, 4)]
 
     def fread_uint_all(self, register):
         """Reads a value from register 'register' for all F-engine FPGAs."""
-        return [fpga.read_uint(register) for fpga in self.ffpgas]
+        return [struct.unpack('>I', d)[0] for d in fanout_read(self.ffpgas, register, 4)]
 
     def xwrite_int_all(self,register,value):
         """Writes to a 32-bit software register on all X-engines."""
-        [fpga.write_int(register,value) for fpga in self.xfpgas]
+        fanout_write(self.xfpgas, register, struct.pack('>i' if value < 0 else '>I', value))
 
     def fwrite_int_all(self,register,value):
         """Writes to a 32-bit software register on all F-engines."""
-        [fpga.write_int(register,value) for fpga in self.ffpgas]
+        fanout_write(self.ffpgas, register, struct.pack('>i' if value < 0 else '>I', value))
 
     def feng_ctrl_set_all(self, **kwargs):
         """Valid keyword args include:
@@ -1753,8 +1807,9 @@ class Correlator:
 #                # Assign an IP address to each XAUI port's associated 10GbE core.
 #                fpga.write_int('gbe_ip%i'%x, ip)
 
-    def config_udp_output(self, dest_ip_str=None, dest_port=None):
-        """Configures the destination IP and port for X engine output. dest_port and dest_ip are optional parameters to override the config file defaults. dest_ip is string in dotted-quad notation."""
+    def config_udp_output(self, dest_ip_str=None, dest_port=None, n_ports=1):
+        """Configures the destination IP and port for X engine output. dest_port and dest_ip are optional parameters to override the config file defaults. dest_ip is string in dotted-quad notation.
+        n_ports spreads the X boards over that many consecutive ports from dest_port, for a receiver running a process per port. Metadata always goes to dest_port."""
         if dest_ip_str==None:
             dest_ip_str=self.config['rx_udp_ip_str']
         else:
@@ -1769,8 +1824,13 @@ class Correlator:
             self.config['rx_udp_port']=dest_port
 
         self.xwrite_int_all('gbe_out_ip',struct.unpack('>L',socket.inet_aton(dest_ip_str))[0])
-        self.xwrite_int_all('gbe_out_port',dest_port)
-        self.syslogger.info("Correlator output configured to %s:%i." % (dest_ip_str, dest_port))
+        if n_ports == 1:
+            self.xwrite_int_all('gbe_out_port',dest_port)
+            self.syslogger.info("Correlator output configured to %s:%i." % (dest_ip_str, dest_port))
+        else:
+            for f,fpga in enumerate(self.xfpgas):
+                fpga.write_int('gbe_out_port',dest_port + (f % n_ports))
+            self.syslogger.info("Correlator output configured to %s:%i-%i." % (dest_ip_str, dest_port, dest_port + n_ports - 1))
 
         # need a new spead transmitter if the port and ip have changed
         self.spead_tx = spead.Transmitter(spead.TransportUDPtx(self.config['rx_meta_ip_str'], self.config['rx_udp_port']))
@@ -1947,9 +2007,10 @@ class Correlator:
 #        if frequency>self.config['bandwidth']: raise RuntimeError("that frequency is too high.")
 #        return round(float(frequency)/self.config['bandwidth']*self.config['n_chans'])%self.config['n_chans']
 
-    def get_adc_snapshots(self,ant_strs,trig_level=-1,sync_to_pps=True):
-        """Retrieves raw ADC samples from the specified antennas. Optionally capture the data at the same time. Optionally set a trigger level."""
-        return corr.snap.get_adc_snapshots(self,ant_strs,trig_level=trig_level,sync_to_pps=sync_to_pps)
+    def get_adc_snapshots(self,ant_strs,trig_level=-1,sync_to_pps=True,use_cache=False):
+        """Retrieves raw ADC samples from the specified antennas. Optionally capture the data at the same time. Optionally set a trigger level.
+        use_cache lets untriggered captures come from the snapshot cache, see corr.snap.snapshot_cache_enable."""
+        return corr.snap.get_adc_snapshots(self,ant_strs,trig_level=trig_level,sync_to_pps=sync_to_pps,use_cache=use_cache)
 
     def get_quant_snapshot(self, ant_str, n_spectra = 1):
         """Retrieves quantised samples from the output of the FFT for user-specified antennas."""
@@ -2114,15 +2175,12 @@ class Correlator:
         n_coeffs = self.config['n_chans']/self.config['eq_decimation']
 
         if self.config['eq_type'] == 'scalar':
-            bd=self.ffpgas[ffpga_n].read(register_name,n_coeffs*2)
-            coeffs=numpy.array(struct.unpack('>%ih'%n_coeffs,bd))
+            coeffs=self.ffpgas[ffpga_n].read_array(register_name,numpy.int16,n_coeffs)
             nacexp=(numpy.reshape(coeffs,(n_coeffs,1))*numpy.ones((1,self.config['eq_decimation']))).reshape(self.config['n_chans'])
             return nacexp
 
         elif self.config['eq_type'] == 'complex':
-            bd=self.ffpgas[ffpga_n].read(register_name,n_coeffs*4)
-            coeffs=struct.unpack('>%ih'%(n_coeffs*2),bd)
-            na=numpy.array(coeffs,dtype=numpy.float64)
+            na=self.ffpgas[ffpga_n].read_array(register_name,numpy.int16,n_coeffs*2,out=numpy.empty(n_coeffs*2,dtype=numpy.float64))
             nac=na.view(dtype=numpy.complex128)
             nacexp=(numpy.reshape(nac,(n_coeffs,1))*numpy.ones((1,self.config['eq_decimation']))).reshape(self.config['n_chans'])
             return nacexp
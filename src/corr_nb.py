@@ -5,7 +5,7 @@ Setup and unique functionality for the narrow-band correlator modes. Here narrow
 Revisions:
 2011-07-07  PVP  Initial revision.
 """
-import numpy, struct, construct, corr_functions, snap
+import numpy, struct, construct, corr_functions, snap, bitfield
 
 def bin2fp(bits, m = 8, e = 7):
     if m > 32:
@@ -16,6 +16,41 @@ def bin2fp(bits, m = 8, e = 7):
     e = e + shift
     return float(numpy.int32(bits)) / (2**e)
 
+def bin2fp_array(bits, m = 8, e = 7):
+    """
+    bin2fp for a whole array: interpret unsigned m-bit values as signed fixed-point numbers with e fractional bits.
+    Returns a float64 numpy array.
+    """
+    if m > 32:
+        raise RuntimeError('Unsupported fixed format: %i.%i' % (m,e))
+    bits = numpy.asarray(bits).astype(numpy.int64) & ((1 << m) - 1)
+    bits[bits >= (1 << (m - 1))] -= (1 << m)
+    return bits / float(2**e)
+
+def unpack_fix_complex(data, bitstruct, fields, m, e, dtype = None):
+    """
+    Unpack snapshot data holding signed m.e fixed-point complex values in one pass.
+    @param data: the raw snapshot data
+    @param bitstruct: the BitStruct describing one snapshot word
+    @param fields: the complex values in each word, eg ['d0', 'd1'] for d0_r/d0_i and d1_r/d1_i
+    @param dtype: numpy complex dtype of the result. Default is complex64, or complex128 if m is more than the 24 bits a float32 holds exactly.
+    @return a numpy array of shape (words, len(fields))
+    """
+    if dtype == None:
+        dtype = numpy.complex64 if m <= 24 else numpy.complex128
+    names = []
+    for field in fields:
+        names.extend([field + '_r', field + '_i'])
+    cols = bitfield.decode(bitstruct, data, names)
+    n = 0
+    if len(names) > 0:
+        n = len(cols[names[0]])
+    rv = numpy.empty((n, len(fields)), dtype = dtype)
+    for ctr, field in enumerate(fields):
+        rv[:, ctr].real = bin2fp_array(cols[field + '_r'], m, e)
+        rv[:, ctr].imag = bin2fp_array(cols[field + '_i'], m, e)
+    return rv
+
 # f-engine adc control
 register_fengine_adc_control = construct.BitStruct('adc_ctrl0',
     construct.Flag('enable'),       # 31    Enable input channel on KAT ADC.
@@ -240,17 +275,13 @@ def get_snap_adc(c, fpgas = [], wait_period = 3):
     2 pols, each one 4 parallel samples f8.7. So 64-bits total.
     """
     raw = snap.snapshots_get(fpgas = fpgas, dev_names = snap_adc, wait_period = wait_period)
-    repeater = construct.GreedyRepeater(snap_fengine_adc)
     rv = []
     for index, d in enumerate(raw['data']):
-        upd = repeater.parse(d)
-        data = [[], []]
-        for ctr in range(0, len(upd)):
-            for pol in range(0,2):
-                for sample in range(0,4):
-                    uf = upd[ctr]['d%i_%i' % (pol,sample)]
-                    f87 = bin2fp(uf)
-                    data[pol].append(f87)
+        cols = bitfield.decode(snap_fengine_adc, d)
+        data = []
+        for pol in range(0,2):
+            samples = numpy.column_stack([cols['d%i_%i' % (pol,sample)] for sample in range(0,4)]).ravel()
+            data.append(bin2fp_array(samples))
         v = {'fpga_index': index, 'data': data}
         rv.append(v)
     return rv
@@ -340,16 +371,8 @@ def get_snap_coarse_fft(c, fpgas = [], pol = 0, setup_snap = True):
         corr_functions.write_masked_register(fpgas, register_fengine_coarse_control,    debug_pol_select = pol, debug_specify_chan = 0)
     snap_data = snap.snapshots_get(fpgas = fpgas, dev_names = snap_debug, wait_period = 3)
     rd = []
-    for ctr in range(0, len(snap_data['data'])):
-        d = snap_data['data'][ctr]
-        repeater = construct.GreedyRepeater(snap_fengine_debug_coarse_fft)
-        up = repeater.parse(d)
-        coarsed = []
-        for a in up:
-            for b in range(0,2):
-                num = bin2fp(a['d%i_r'%b], 18, 17) + (1j * bin2fp(a['d%i_i'%b], 18, 17))
-                coarsed.append(num)
-        rd.append(coarsed)
+    for d in snap_data['data']:
+        rd.append(unpack_fix_complex(d, snap_fengine_debug_coarse_fft, ['d0', 'd1'], 18, 17).ravel())
     return rd
 
 def get_snap_coarse_channel(c, fpgas = [], pol = 0, channel = -1, setup_snap = True):
@@ -366,18 +389,8 @@ def get_snap_coarse_channel(c, fpgas = [], pol = 0, channel = -1, setup_snap = T
         corr_functions.write_masked_register(fpgas, register_fengine_coarse_control,    debug_pol_select = pol, debug_specify_chan = 1, debug_chan = channel >> 1)
     snap_data = snap.snapshots_get(fpgas = fpgas, dev_names = snap_debug, wait_period = 3)
     rd = []
-    for ctr in range(0, len(snap_data['data'])):
-        d = snap_data['data'][ctr]
-        repeater = construct.GreedyRepeater(snap_fengine_debug_coarse_fft)
-        up = repeater.parse(d)
-        coarsed = []
-        for a in up:
-            if channel & 1:
-                num = bin2fp(a['d1_r'], 18, 17) + (1j * bin2fp(a['d1_i'], 18, 17))
-            else:
-                num = bin2fp(a['d0_r'], 18, 17) + (1j * bin2fp(a['d0_i'], 18, 17))
-            coarsed.append(num)
-        rd.append(coarsed)
+    for d in snap_data['data']:
+        rd.append(unpack_fix_complex(d, snap_fengine_debug_coarse_fft, ['d%i' % (channel & 1)], 18, 17).ravel())
     return rd
 
 def get_snap_buffer_pfb(c, fpgas = [], pol = 0, setup_snap = True, pfb = False):
@@ -393,15 +406,8 @@ def get_snap_buffer_pfb(c, fpgas = [], pol = 0, setup_snap = True, pfb = False):
         corr_functions.write_masked_register(fpgas, register_fengine_coarse_control, debug_pol_select = pol)
     snap_data = snap.snapshots_get(fpgas = fpgas, dev_names = snap_debug, wait_period = 3)
     rd = []
-    for ctr in range(0, len(snap_data['data'])):
-        d = snap_data['data'][ctr]
-        repeater = construct.GreedyRepeater(snap_fengine_debug_coarse_fft)
-        up = repeater.parse(d)
-        coarsed = []
-        for a in up:
-            num = bin2fp(a['d%i_r'%pol], 18, 17) + (1j * bin2fp(a['d%i_i'%pol], 18, 17))
-            coarsed.append(num)
-        rd.append(coarsed)
+    for d in snap_data['data']:
+        rd.append(unpack_fix_complex(d, snap_fengine_debug_coarse_fft, ['d%i' % pol], 18, 17).ravel())
     return rd
 
 #snap_fengine_debug_fine_fft = construct.BitStruct(snap_debug,
@@ -446,18 +452,9 @@ def get_snap_fine_fft(c, fpgas = [], offset = -1, setup_snap = True):
         corr_functions.write_masked_register(fpgas, register_fengine_control, debug_snap_select = snap_fengine_debug_select['fine_128'])
     snap_data = snap.snapshots_get(fpgas = fpgas, dev_names = snap_debug, wait_period = 3, offset = offset)
     rd = []
-    for ctr in range(0, len(snap_data['data'])):
-        d = snap_data['data'][ctr]
-        repeater = construct.GreedyRepeater(snap_fengine_debug_fine_fft)
-        up = repeater.parse(d)
-        fdata_p0 = []
-        fdata_p1 = []
-        for a in up:
-            p0c = bin2fp(a['p0_r'], fine_fft_bitwidth, 17) + (1j * bin2fp(a['p0_i'], fine_fft_bitwidth, 17))
-            p1c = bin2fp(a['p1_r'], fine_fft_bitwidth, 17) + (1j * bin2fp(a['p1_i'], fine_fft_bitwidth, 17))
-            fdata_p0.append(p0c)
-            fdata_p1.append(p1c)
-        rd.append([fdata_p0, fdata_p1])
+    for d in snap_data['data']:
+        fdata = unpack_fix_complex(d, snap_fengine_debug_fine_fft, ['p0', 'p1'], fine_fft_bitwidth, 17)
+        rd.append([fdata[:, 0], fdata[:, 1]])
     return rd
 
 snap_fengine_debug_quant = construct.BitStruct(snap_debug,
@@ -504,23 +501,18 @@ def _fpga_snap_quant(fpga = None, offset = -1, wbc_compat = False, debug_data =
     _log('unpacking data.')
     data = [[], []]
     if not wbc_compat:
-        repeater = construct.GreedyRepeater(snap_fengine_debug_quant)
-        unpacked = repeater.parse(snap_data)
-        for ctr in unpacked:
-            p0c = bin2fp(ctr['p0_r'], 4, 3) + (1j * bin2fp(ctr['p0_i'], 4, 3))
-            p1c = bin2fp(ctr['p1_r'], 4, 3) + (1j * bin2fp(ctr['p1_i'], 4, 3))
-            data[0].append(p0c)
-            data[1].append(p1c)
+        unpacked = unpack_fix_complex(snap_data, snap_fengine_debug_quant, ['p0', 'p1'], 4, 3)
+        data[0] = unpacked[:, 0]
+        data[1] = unpacked[:, 1]
     else:
         # remember that the data is 16-bit padded up to 128-bit because of the one debug snap block, so only 2 of every 16 bytes are valid data
-        unpacked = numpy.fromstring(snap_data, dtype = numpy.uint8)
-        for ctr in range(14, len(unpacked), 16):
-            pol0_r_bits = (unpacked[ctr]   & ((2**8) - (2**4))) >> 4
-            pol0_i_bits = (unpacked[ctr]   & ((2**4) - (2**0)))
-            pol1_r_bits = (unpacked[ctr+1] & ((2**8) - (2**4))) >> 4
-            pol1_i_bits = (unpacked[ctr+1] & ((2**4) - (2**0)))
-            data[0].append(float(((numpy.int8(pol0_r_bits << 4) >> 4))) + (1j * float(((numpy.int8(pol0_i_bits << 4) >> 4)))))
-            data[1].append(float(((numpy.int8(pol1_r_bits << 4) >> 4))) + (1j * float(((numpy.int8(pol1_i_bits << 4) >> 4)))))
+        if isinstance(snap_data, str):
+            unpacked = numpy.frombuffer(snap_data, dtype = numpy.uint8)
+        else:
+            unpacked = numpy.ascontiguousarray(snap_data).view(numpy.uint8)
+        n_words = len(unpacked) / 16
+        data[0] = snap.unpack_4bit_complex(unpacked[14:n_words * 16:16])
+        data[1] = snap.unpack_4bit_complex(unpacked[15:n_words * 16:16])
     _log('returning %i complex values for each pol.' % len(data[0]))
     return data
 
@@ -547,25 +539,9 @@ def get_snap_ct(c, fpgas = [], offset = -1, setup_snap = True):
         corr_functions.write_masked_register(fpgas, register_fengine_control, debug_snap_select = snap_fengine_debug_select['ct_64'])
     snap_data = snap.snapshots_get(fpgas = fpgas, dev_names = snap_debug, wait_period = 3, offset = offset)
     rd = []
-    for ctr in range(0, len(snap_data['data'])):
-        d = snap_data['data'][ctr]
-        repeater = construct.GreedyRepeater(snap_fengine_debug_ct)
-        up = repeater.parse(d)
-        fdata_p0 = []
-        fdata_p1 = []
-        for a in up:
-            p0 = []
-            p1 = []
-            p0.append(bin2fp(a['p00_r'], 4, 3) + (1j * bin2fp(a['p00_i'], 4, 3)))
-            p0.append(bin2fp(a['p01_r'], 4, 3) + (1j * bin2fp(a['p01_i'], 4, 3)))
-            p0.append(bin2fp(a['p02_r'], 4, 3) + (1j * bin2fp(a['p02_i'], 4, 3)))
-            p0.append(bin2fp(a['p03_r'], 4, 3) + (1j * bin2fp(a['p03_i'], 4, 3)))
-            p1.append(bin2fp(a['p10_r'], 4, 3) + (1j * bin2fp(a['p10_i'], 4, 3)))
-            p1.append(bin2fp(a['p11_r'], 4, 3) + (1j * bin2fp(a['p11_i'], 4, 3)))
-            p1.append(bin2fp(a['p12_r'], 4, 3) + (1j * bin2fp(a['p12_i'], 4, 3)))
-            p1.append(bin2fp(a['p13_r'], 4, 3) + (1j * bin2fp(a['p13_i'], 4, 3)))
-            fdata_p0.extend(p0)
-            fdata_p1.extend(p1)
+    for d in snap_data['data']:
+        fdata_p0 = unpack_fix_complex(d, snap_fengine_debug_ct, ['p00', 'p01', 'p02', 'p03'], 4, 3).ravel()
+        fdata_p1 = unpack_fix_complex(d, snap_fengine_debug_ct, ['p10', 'p11', 'p12', 'p13'], 4, 3).ravel()
         rd.append([fdata_p0, fdata_p1])
     return rd
 
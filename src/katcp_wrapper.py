@@ -8,7 +8,7 @@
    @Revised 2009/12/01 to include print 10gbe core details.
    """
 
-import struct, threading, socket, logging, time, os
+import struct, threading, socket, logging, time, os, collections, numpy
 
 from katcp import *
 log = logging.getLogger("katcp")
@@ -29,13 +29,16 @@ class FpgaAsyncRequest:
         self.inform_cb = inform_cb
     def __str__(self):
         return '%s(%s)@(%10.5f) - reply%s - informs(%i)' % (self.request, self.request_id, self.time_tx, str(self.reply), len(self.informs))
-    def got_reply(self, reply_message):
+    def set_reply(self, reply_message):
+        """Store the reply without calling reply_cb. FpgaClient does this with its request table locked."""
         if not (reply_message.name == self.request):
             error_string = 'rx reply(%s) does not match request(%s)' % (reply_message.name, self.request)
             print error_string
             raise RuntimeError(error_string)
         self.reply = reply_message
         self.reply_time = time.time()
+    def got_reply(self, reply_message):
+        self.set_reply(reply_message)
         if self.reply_cb != None:
             self.reply_cb(self.host, self.request_id)
     def got_inform(self, inform_message):
@@ -56,6 +59,109 @@ class FpgaAsyncRequest:
             return False
         return self.reply.arguments[0] == Message.OK
 
+class FpgaAsyncRequestGroup:
+    """Tracks the completion of the same non-blocking request made to a number of Fpgas.
+       Each host's reply is tracked against its own deadline, so one slow or dead board doesn't hold up
+       or throw away the replies from the others. Use wait() to block until everything has completed or
+       expired, or poll() to check on progress without blocking.
+       """
+    def __init__(self, fpgas, request, request_args, timeout):
+        """Send the request to every Fpga in the list.
+
+           @param fpgas  List of FpgaClient objects.
+           @param request  The request string.
+           @param request_args  List of arguments to the request.
+           @param timeout  Float: seconds to wait for each host's reply. Can also be a dictionary of per-host timeouts, keyed on host.
+           """
+        self.request = request
+        self.request_args = request_args
+        self.fpgas = fpgas
+        self.results = {}
+        self.failed = []
+        self.timed_out = []
+        self._pending = {}
+        self._replied = []
+        self._deadlines = {}
+        self._cond = threading.Condition()
+        for f in fpgas:
+            host_timeout = timeout[f.host] if isinstance(timeout, dict) else timeout
+            self._cond.acquire()
+            r = f._nb_request(request, None, self._reply_cb, *request_args)
+            self._pending[f.host] = (f, r['id'])
+            self._deadlines[f.host] = time.time() + host_timeout
+            self._cond.release()
+
+    def __str__(self):
+        return '%s to %i hosts - ok(%i) failed(%i) timed out(%i) pending(%i)' % (self.request, len(self.fpgas),
+            len(self.results) - len(self.failed), len(self.failed), len(self.timed_out), len(self._pending))
+
+    def _reply_cb(self, host, request_id):
+        self._cond.acquire()
+        self._replied.append(host)
+        self._cond.notify()
+        self._cond.release()
+
+    def _collect(self):
+        """Harvest replies that have arrived and expire hosts whose deadlines have passed. Call with the condition held."""
+        for host in self._replied:
+            if not self._pending.has_key(host):
+                continue
+            f, request_id = self._pending.pop(host)
+            req = f._nb_pop_request_by_id(request_id)
+            if req == None:
+                # evicted from the client's request table before we got to it, so the reply is lost
+                f._logger.error('Request %s(%s) was evicted before its reply was collected.' % (self.request, request_id))
+                self.timed_out.append(host)
+                continue
+            self.results[host] = {'request': self.request,
+                                  'reply': req.reply.arguments[0],
+                                  'reply_args': req.reply.arguments,
+                                  'informs': [inf.arguments for inf in req.informs]}
+            if not req.complete_ok():
+                self.failed.append(host)
+        self._replied = []
+        now = time.time()
+        for host in self._pending.keys():
+            if now >= self._deadlines[host]:
+                f, request_id = self._pending.pop(host)
+                f._nb_pop_request_by_id(request_id)
+                f._logger.error('Request %s(%s) timed out.' % (self.request, request_id))
+                self.timed_out.append(host)
+
+    def poll(self):
+        """Check on progress without blocking.
+           @return  True if every host has either replied or timed out.
+           """
+        self._cond.acquire()
+        self._collect()
+        done = len(self._pending) == 0
+        self._cond.release()
+        return done
+
+    def wait(self, timeout = None):
+        """Block until every host has replied or timed out.
+           @param timeout  Float: give up waiting after this many seconds, even if some hosts are still pending. None waits for all deadlines.
+           @return  True if every host has either replied or timed out.
+           """
+        stime = time.time()
+        self._cond.acquire()
+        self._collect()
+        while len(self._pending) > 0:
+            wait_until = min(self._deadlines[host] for host in self._pending.keys())
+            if timeout != None:
+                if time.time() >= stime + timeout:
+                    break
+                wait_until = min(wait_until, stime + timeout)
+            self._cond.wait(max(0, wait_until - time.time()))
+            self._collect()
+        done = len(self._pending) == 0
+        self._cond.release()
+        return done
+
+    def ok(self):
+        """Did every host reply 'ok'?"""
+        return (len(self._pending) == 0) and (len(self.timed_out) == 0) and (len(self.failed) == 0)
+
 #class FpgaClient(BlockingClient):
 class FpgaClient(CallbackClient):
     """Client for communicating with a ROACH board.
@@ -85,51 +191,86 @@ class FpgaClient(CallbackClient):
         self._timeout = timeout
         self.start(daemon = True)
 
+        # reads bigger than this many bytes use bulkread rather than read. Set negative to always use read.
+        self.bulkread_threshold = 4096
+        # bulkreads bigger than this are split into pipelined requests of this many bytes
+        self.bulkread_chunk_size = 1024*1024
+
+        # the devices in the running design, fetched with listdev on first use, see devices
+        self._devices = None
+
+        # the threaded.FpgaWorkerPool that concurrent jobs on this board run on, set by the Correlator that owns the board. None uses threaded.shared_pool.
+        self.pool = None
+
+        # optional shadow of the data last written to each register, see shadow_enable
+        self._shadow = None
+        self._shadow_volatile = []
+        self._shadow_defer = False
+        self._shadow_pending = collections.OrderedDict()
+
         # async stuff
         self._nb_request_id_lock = threading.Lock()
         self._nb_request_id = 0
         self._nb_requests_lock = threading.Lock()
-        self._nb_requests = {}
+        # ordered by time of transmission, so the oldest request is always first
+        self._nb_requests = collections.OrderedDict()
         self._nb_max_requests = 100
+        self._nb_in_flight = 0
+        self._nb_evictions = 0
+        self._nb_orphans = 0
 
     """**********************************************************************************"""
     """**********************************************************************************"""
 
     def _nb_get_request_by_id(self, request_id):
-        try:
-            return self._nb_requests[request_id]
-        except KeyError:
-            return None
+        return self._nb_requests.get(request_id, None)
 
     def _nb_pop_request_by_id(self, request_id):
+        self._nb_requests_lock.acquire()
         try:
-            self._nb_requests_lock.acquire()
-            r = self._nb_requests.pop(request_id)
-            self._nb_requests_lock.release()
+            r = self._nb_requests.pop(request_id, None)
+            if (r != None) and (r.reply == None):
+                self._nb_in_flight -= 1
             return r
-        except KeyError:
-            return None
+        finally:
+            self._nb_requests_lock.release()
 
     def _nb_pop_oldest_request(self):
-        req = self._nb_requests[self._nb_requests.keys()[0]]
-        for k, v in self._nb_requests.iteritems():
-            if v.time_tx < req.time_tx:
-                req = v
         self._nb_requests_lock.acquire()
-        r = self._nb_pop_request_by_id(req.request_id)
-        self._nb_requests_lock.release()
-        return r
+        try:
+            if len(self._nb_requests) == 0:
+                return None
+            r = self._nb_requests.popitem(last = False)[1]
+            if r.reply == None:
+                self._nb_in_flight -= 1
+            return r
+        finally:
+            self._nb_requests_lock.release()
 
     def _nb_get_request_result(self, request_id):
         req = self._nb_get_request_by_id(request_id)
         return req.reply, req.informs
 
     def _nb_add_request(self, request_name, request_id, inform_cb, reply_cb):
-        if self._nb_requests.has_key(request_id):
-            raise RuntimeError('Trying to add request with id(%s) but it already exists.' % request_id)
+        """Store a new request, evicting the oldest ones if the request table is full.
+           @return  List of the evicted FpgaAsyncRequest objects.
+           """
+        evicted = []
         self._nb_requests_lock.acquire()
-        self._nb_requests[request_id] = FpgaAsyncRequest(self.host, request_name, request_id, inform_cb, reply_cb)
-        self._nb_requests_lock.release()
+        try:
+            if self._nb_requests.has_key(request_id):
+                raise RuntimeError('Trying to add request with id(%s) but it already exists.' % request_id)
+            while len(self._nb_requests) >= self._nb_max_requests:
+                r = self._nb_requests.popitem(last = False)[1]
+                if r.reply == None:
+                    self._nb_in_flight -= 1
+                evicted.append(r)
+            self._nb_evictions += len(evicted)
+            self._nb_requests[request_id] = FpgaAsyncRequest(self.host, request_name, request_id, inform_cb, reply_cb)
+            self._nb_in_flight += 1
+        finally:
+            self._nb_requests_lock.release()
+        return evicted
 
     def _nb_get_next_request_id(self):
         self._nb_request_id_lock.acquire()
@@ -140,19 +281,41 @@ class FpgaClient(CallbackClient):
 
     def _nb_replycb(self, msg, *userdata):
         """The callback for request replies. Check that the ID exists and call that request's got_reply function.
+           Replies to requests that have already been evicted or abandoned are counted and dropped.
            """
         request_id = ''.join(userdata)
-        if not self._nb_requests.has_key(request_id):
-            raise RuntimeError('Recieved reply for request_id(%s), but no such stored request.' % request_id)
-        self._nb_requests[request_id].got_reply(msg.copy())
+        stored = False
+        self._nb_requests_lock.acquire()
+        try:
+            req = self._nb_requests.get(request_id, None)
+            if req == None:
+                self._nb_orphans += 1
+            elif req.reply == None:
+                # store the reply and count it in one go, as _nb_pop_request_by_id decides whether to count it by looking at req.reply
+                req.set_reply(msg.copy())
+                self._nb_in_flight -= 1
+                stored = True
+        finally:
+            self._nb_requests_lock.release()
+        if req == None:
+            self._logger.warn('Received reply for request_id(%s), but no such stored request. Evicted or timed out?' % request_id)
+            return
+        if not stored:
+            self._logger.warn('Received a second reply for request_id(%s), ignoring it.' % request_id)
+            return
+        # the callback is made without the lock, as it may take locks of its own, eg FpgaAsyncRequestGroup's
+        if req.reply_cb != None:
+            req.reply_cb(req.host, req.request_id)
 
     def _nb_informcb(self, msg, *userdata):
         """The callback for request informs. Check that the ID exists and call that request's got_inform function.
            """
         request_id = ''.join(userdata)
-        if not self._nb_requests.has_key(request_id):
-            raise RuntimeError('Recieved inform for request_id(%s), but no such stored request.' % request_id)
-        self._nb_requests[request_id].got_inform(msg.copy())
+        req = self._nb_get_request_by_id(request_id)
+        if req == None:
+            self._logger.warn('Received inform for request_id(%s), but no such stored request. Evicted or timed out?' % request_id)
+            return
+        req.got_inform(msg.copy())
 
     def _nb_request(self, request, inform_cb = None, reply_cb = None, *args):
         """Make a non-blocking request.
@@ -162,15 +325,75 @@ class FpgaClient(CallbackClient):
            @param inform_cb An optional callback function, called upon receipt of the reply to the request.
            @param args      Arguments to the katcp.Message object.
            """
-        if len(self._nb_requests) == self._nb_max_requests:
-            oldreq = self._nb_pop_oldest_request()
-            self._logger.info("Request list full, removing oldest one(%s,%s)." % (oldreq.request, oldreq.request_id))
-            print "Request list full, removing oldest one(%s,%s)." % (oldreq.request, oldreq.request_id)
+        self._invalidate_for(request, args)
         request_id = self._nb_get_next_request_id()
-        self._nb_add_request(request, request_id, inform_cb, reply_cb)
+        evicted = self._nb_add_request(request, request_id, inform_cb, reply_cb)
+        for oldreq in evicted:
+            self._logger.info("Request list full, removing oldest one(%s,%s)." % (oldreq.request, oldreq.request_id))
         self.callback_request(msg = Message.request(request, *args), reply_cb = self._nb_replycb, inform_cb = self._nb_informcb, user_data = request_id)
         return {'host': self.host, 'request': request, 'id': request_id}
 
+    def nb_request_stats(self):
+        """Return counters for the non-blocking request table.
+
+           @param self  This object.
+           @return  Dictionary: requests stored, requests still awaiting a reply, requests evicted because the table was full, and replies received for requests no longer stored.
+           """
+        return {'stored': len(self._nb_requests),
+                'in_flight': self._nb_in_flight,
+                'evictions': self._nb_evictions,
+                'orphan_replies': self._nb_orphans}
+
+    def _nb_request_many(self, requests, timeout = None):
+        """Pipeline a list of requests: put them all on the wire back-to-back using the non-blocking
+           machinery and then wait for their replies. Requests are sent in windows no larger than
+           half the async request table so that none of them get evicted before their reply arrives.
+
+           Raise an error if any reply indicates a request failure or if the replies don't arrive in time.
+
+           @param self      This object.
+           @param requests  List of (request_name, [args]) tuples.
+           @param timeout   Float: seconds to wait for each window of replies. Defaults to the client timeout.
+           @return  List of (reply, informs) tuples, in the same order as the requests.
+           """
+        import Queue
+        if timeout == None:
+            timeout = self._timeout
+        reply_queue = Queue.Queue()
+        def reply_cb(host, request_id):
+            reply_queue.put(request_id)
+        window = max(1, self._nb_max_requests / 2)
+        rv = []
+        for start in range(0, len(requests), window):
+            request_ids = []
+            for request, args in requests[start:start + window]:
+                r = self._nb_request(request, None, reply_cb, *args)
+                request_ids.append(r['id'])
+            stime = time.time()
+            for n in range(len(request_ids)):
+                try:
+                    reply_queue.get(block = True, timeout = max(0, stime + timeout - time.time()))
+                except Queue.Empty:
+                    for request_id in request_ids:
+                        self._nb_pop_request_by_id(request_id)
+                    self._logger.error("Timed out after %.2fs waiting for %i pipelined replies." % (timeout, len(request_ids) - n))
+                    raise RuntimeError("Timed out after %.2fs waiting for %i pipelined replies." % (timeout, len(request_ids) - n))
+            failed = []
+            reqs = [self._nb_pop_request_by_id(request_id) for request_id in request_ids]
+            for n, req in enumerate(reqs):
+                if req == None:
+                    # another request on this client pushed it out of the request table after its reply arrived
+                    request, args = requests[start + n]
+                    self._logger.error("Pipelined request %s(%s) was evicted before its reply was collected." % (request, request_ids[n]))
+                    raise RuntimeError("Pipelined request %s(%s) was evicted before its reply was collected." % (request, request_ids[n]))
+                if not req.complete_ok():
+                    failed.append(req)
+                rv.append((req.reply, req.informs))
+            if len(failed) > 0:
+                self._logger.error("%i pipelined requests failed. First: %s." % (len(failed), failed[0]))
+                raise RuntimeError("%i pipelined requests failed. First: %s." % (len(failed), failed[0]))
+        return rv
+
     """**********************************************************************************"""
     """**********************************************************************************"""
 
@@ -184,6 +407,7 @@ class FpgaClient(CallbackClient):
            @param args  List of strings: request arguments.
            @return  Tuple: containing the reply and a list of inform messages.
            """
+        self._invalidate_for(name, args)
         request = Message.request(name, *args)
         reply, informs = self.blocking_request(request, timeout = request_timeout)
         #reply, informs = self.blocking_request(request,keepalive=True)
@@ -205,6 +429,18 @@ class FpgaClient(CallbackClient):
         reply, informs = self._request("listdev", self._timeout)
         return [i.arguments[0] for i in informs]
 
+    def devices(self, refresh=False):
+        """Return the set of register / device names in the running design.
+           The list is fetched once and kept until the FPGA is reprogrammed with progdev.
+
+           @param self  This object.
+           @param refresh  Boolean: fetch the list again anyway.
+           @return  A set of register names.
+           """
+        if refresh or (self._devices == None):
+            self._devices = set(self.listdev())
+        return self._devices
+
     def listbof(self):
         """Return a list of executable files.
 
@@ -505,23 +741,78 @@ class FpgaClient(CallbackClient):
            @param offset  Integer: offset to read data from (in bytes).
            @return  Bindary string: data read.
            """
-        reply, informs = self._request("bulkread", self._timeout, device_name, str(offset), str(size))
-        return ''.join([i.arguments[0] for i in informs])
+        return ''.join(self._bulkread_pages(device_name, size, offset))
+
+    def _bulkread_pages(self, device_name, size, offset=0):
+        """Return the list of pages of data returned by one or more bulkread requests, without joining them.
+           Reads bigger than bulkread_chunk_size are split into pipelined requests.
+           """
+        if size <= self.bulkread_chunk_size:
+            reply, informs = self._request("bulkread", self._timeout, device_name, str(offset), str(size))
+            return [i.arguments[0] for i in informs]
+        requests = [("bulkread", [device_name, str(offset + start), str(min(self.bulkread_chunk_size, size - start))])
+            for start in range(0, size, self.bulkread_chunk_size)]
+        return [i.arguments[0] for reply, informs in self._nb_request_many(requests) for i in informs]
 
     def read(self, device_name, size, offset=0):
         """Return size_bytes of binary data with carriage-return
-           escape-sequenced.
+           escape-sequenced. Reads of more than bulkread_threshold bytes
+           are passed on to bulkread.
 
+           @see bulkread
            @param self  This object.
            @param device_name  String: name of device / register to read from.
            @param size  Integer: amount of data to read (in bytes).
            @param offset  Integer: offset to read data from (in bytes).
            @return  Bindary string: data read.
            """
+        if (self.bulkread_threshold >= 0) and (size > self.bulkread_threshold):
+            return self.bulkread(device_name, size, offset)
         reply, informs = self._request("read", self._timeout, device_name, str(offset),
             str(size))
         return reply.arguments[1]
 
+    def read_array(self, device_name, dtype, count, offset=0, out=None):
+        """Read count big-endian values of the given numpy dtype and return them in a numpy array.
+           The reply payload is copied straight into the array, page by page, without building
+           intermediate strings or lists.
+
+           @see read
+           @param self  This object.
+           @param device_name  String: name of device / register to read from.
+           @param dtype  numpy dtype of the values. Always interpreted as big-endian.
+           @param count  Integer: number of values to read.
+           @param offset  Integer: offset to read data from (in bytes).
+           @param out  Optional numpy array to fill. If it has the same (big-endian) dtype and is contiguous the data
+                       lands in it directly, otherwise the values are converted into it.
+           @return  numpy array: out if given, else a new array of count values.
+           """
+        dt = numpy.dtype(dtype).newbyteorder('>')
+        size = count * dt.itemsize
+        if (out is not None) and (out.size < count):
+            raise RuntimeError('Output array for read of %i values from %s only has room for %i.' % (count, device_name, out.size))
+        if (out is not None) and (out.dtype == dt) and out.flags.c_contiguous:
+            rv = out.reshape(-1)[0:count]
+        else:
+            rv = numpy.empty(count, dtype = dt)
+        if (self.bulkread_threshold >= 0) and (size > self.bulkread_threshold):
+            pages = self._bulkread_pages(device_name, size, offset)
+        else:
+            reply, informs = self._request("read", self._timeout, device_name, str(offset), str(size))
+            pages = [reply.arguments[1]]
+        raw = rv.view(numpy.uint8)
+        pos = 0
+        for page in pages:
+            raw[pos:pos + len(page)] = numpy.frombuffer(page, dtype = numpy.uint8)
+            pos += len(page)
+        if pos != size:
+            raise RuntimeError("Read of %i bytes from %s at offset %i returned %i bytes." % (size, device_name, offset, pos))
+        if out is None:
+            return rv
+        if not numpy.may_share_memory(rv, out):
+            out.reshape(-1)[0:count] = rv
+        return out
+
     def read_dram(self, size, offset=0,verbose=False):
         """Reads data from a ROACH's DRAM. Reads are done up to 1MB at a time.
            The 64MB indirect address register is automatically incremented as necessary.
@@ -602,8 +893,14 @@ class FpgaClient(CallbackClient):
            @param offset  Integer: offset to write data to (in bytes)
            """
         self.blindwrite(device_name, data, offset)
+        if (self._shadow != None) and (device_name not in self._shadow_volatile):
+            self._shadow.setdefault(device_name, {})[offset] = data
+            if self._shadow_defer:
+                self._shadow_pending[(device_name, offset)] = data
+                return
         new_data = self.read(device_name, len(data), offset)
         if new_data != data:
+            self.shadow_clear(device_name)
 
             unpacked_wrdata=struct.unpack('>L',data[0:4])[0]
             unpacked_rddata=struct.unpack('>L',new_data[0:4])[0]
@@ -627,6 +924,110 @@ class FpgaClient(CallbackClient):
         assert ((offset%4) ==0) , 'You must write 32bit-bounded words!'
         self._request("write", self._timeout, device_name, str(offset), data)
 
+    def shadow_enable(self, volatile=[], defer_verify=False):
+        """Start keeping a local shadow of the data last written to each register with .write().
+           Read-modify-write helpers can then use shadow_read_uint to skip reading back registers whose contents are already known.
+           Writes with .blindwrite() invalidate the shadow for that register and reprogramming the FPGA clears it.
+
+           @see shadow_verify
+           @param self  This object.
+           @param volatile  List of strings: names of registers that the hardware may change. These are always verified immediately and never shadowed.
+           @param defer_verify  Boolean: if true, .write() doesn't read back what it wrote. Call shadow_verify() to check all the outstanding writes in one pipelined batch.
+           """
+        self._shadow = {}
+        self._shadow_volatile = list(volatile)
+        self._shadow_defer = defer_verify
+        self._shadow_pending = collections.OrderedDict()
+
+    def shadow_disable(self):
+        """Verify any outstanding deferred writes and stop shadowing registers.
+
+           @param self  This object.
+           """
+        try:
+            self.shadow_verify()
+        finally:
+            self._shadow = None
+            self._shadow_defer = False
+            self._shadow_pending = collections.OrderedDict()
+
+    def shadow_clear(self, device_name=None):
+        """Forget the shadowed contents of one register, or of all of them.
+           Outstanding deferred verifications of the forgotten registers are dropped too.
+
+           @param self  This object.
+           @param device_name  String: name of the register. None clears everything.
+           """
+        if self._shadow == None:
+            return
+        if device_name == None:
+            self._shadow = {}
+            self._shadow_pending = collections.OrderedDict()
+        elif self._shadow.has_key(device_name):
+            self._shadow.pop(device_name)
+            for key in [k for k in self._shadow_pending.keys() if k[0] == device_name]:
+                self._shadow_pending.pop(key)
+
+    def _invalidate_for(self, request, args):
+        """Forget what a request is about to change on the board: the shadowed data it overwrites, or for progdev the whole
+           shadow and the device list. _request and _nb_request call this for every request, so raw writes are covered too.
+           """
+        if request == 'write':
+            self._shadow_invalidate(args[0], int(args[1]), len(args[2]))
+        elif request == 'wordwrite':
+            self._shadow_invalidate(args[0], int(args[1]) * 4, 4)
+        elif request == 'progdev':
+            self.shadow_clear()
+            self._devices = None
+
+    def _shadow_invalidate(self, device_name, offset, size):
+        """Forget shadowed data, and drop deferred verifications, that overlap the given byte range of a register."""
+        if (self._shadow == None) or (not self._shadow.has_key(device_name)):
+            return
+        regs = self._shadow[device_name]
+        for o in [o for o, d in regs.items() if (o < offset + size) and (offset < o + len(d))]:
+            regs.pop(o)
+            self._shadow_pending.pop((device_name, o), None)
+
+    def shadow_verify(self):
+        """Read back every write whose verification was deferred, in one pipelined batch, and compare.
+           Registers that fail verification are dropped from the shadow.
+
+           @param self  This object.
+           @return  Integer: number of writes verified.
+           """
+        if len(self._shadow_pending) == 0:
+            return 0
+        pending = self._shadow_pending.items()
+        self._shadow_pending = collections.OrderedDict()
+        new_data = self.read_many([(device_name, len(data), offset) for (device_name, offset), data in pending])
+        failed = []
+        for n, ((device_name, offset), data) in enumerate(pending):
+            if new_data[n] != data:
+                self.shadow_clear(device_name)
+                failed.append("%s at offset %d: wrote 0x%08x... but got back 0x%08x..." % (device_name, offset,
+                    struct.unpack('>L',data[0:4])[0], struct.unpack('>L',new_data[n][0:4])[0]))
+        if len(failed) > 0:
+            self._logger.error("Verification of %i deferred writes failed: %s" % (len(failed), '; '.join(failed)))
+            raise RuntimeError("Verification of %i deferred writes failed: %s" % (len(failed), '; '.join(failed)))
+        return len(pending)
+
+    def shadow_read_uint(self, device_name, offset=0):
+        """As in .read_uint(), but return the shadowed value if the register was last written with .write() while shadowing was enabled.
+           Falls back to reading the hardware otherwise.
+
+           @see read_uint
+           @param self  This object.
+           @param device_name  String: name of device / register to read from.
+           @param offset int: The offset (in 32bit words) at which to read; default is zero.
+           @return  Integer: value read.
+           """
+        if (self._shadow != None) and self._shadow.has_key(device_name):
+            data = self._shadow[device_name].get(offset*4, None)
+            if (data != None) and (len(data) == 4):
+                return struct.unpack(">I", data)[0]
+        return self.read_uint(device_name, offset)
+
     def read_int(self, device_name, offset=0):
         """Calls .read() command with size=4, offset=0 and
            unpacks returned four bytes into signed 32bit integer.
@@ -678,6 +1079,63 @@ class FpgaClient(CallbackClient):
         data = self.read(device_name, 4, offset*4)
         return struct.unpack(">I", data)[0]
 
+    def read_many(self, reads):
+        """Pipelined version of .read(). All the reads are issued back-to-back and the replies gathered afterwards,
+           so a batch costs roughly one round-trip instead of one per read.
+
+           @see read
+           @param self  This object.
+           @param reads  List of (device_name, size, offset) tuples. The offset (in bytes) may be omitted.
+           @return  List of binary strings, in the same order as reads.
+           """
+        requests = []
+        for r in reads:
+            offset = r[2] if len(r) > 2 else 0
+            requests.append(('read', [r[0], str(offset), str(r[1])]))
+        return [reply.arguments[1] for reply, informs in self._nb_request_many(requests)]
+
+    def read_uint_many(self, device_names, offset=0):
+        """Pipelined version of .read_uint() for a list of registers.
+
+           @see read_uint
+           @param self  This object.
+           @param device_names  List of strings: names of the registers to read.
+           @param offset int: The offset (in 32bit words) at which to read each register; default is zero.
+           @return  List of integers, in the same order as device_names.
+           """
+        data = self.read_many([(device_name, 4, offset*4) for device_name in device_names])
+        return [struct.unpack(">I", d)[0] for d in data]
+
+    def write_many(self, writes, blindwrite=False):
+        """Pipelined version of .write(). All the writes are issued back-to-back, followed by a pipelined read-back of
+           everything written unless blindwrite is set.
+
+           @see write
+           @param self  This object.
+           @param writes  List of (device_name, data, offset) tuples. The offset (in bytes) may be omitted.
+           @param blindwrite  Boolean: if true, don't verify the writes.
+           """
+        requests = []
+        for w in writes:
+            offset = w[2] if len(w) > 2 else 0
+            assert (type(w[1])==str) , 'You need to supply binary packed string data!'
+            assert (len(w[1])%4) ==0 , 'You must write 32bit-bounded words!'
+            assert ((offset%4) ==0) , 'You must write 32bit-bounded words!'
+            requests.append(('write', [w[0], str(offset), w[1]]))
+        self._nb_request_many(requests)
+        if blindwrite:
+            return
+        new_data = self.read_many([(w[0], len(w[1]), w[2] if len(w) > 2 else 0) for w in writes])
+        for n, w in enumerate(writes):
+            if new_data[n] != w[1]:
+                offset = w[2] if len(w) > 2 else 0
+                unpacked_wrdata=struct.unpack('>L',w[1][0:4])[0]
+                unpacked_rddata=struct.unpack('>L',new_data[n][0:4])[0]
+                self._logger.error("Verification of write to %s at offset %d failed. Wrote 0x%08x... but got back 0x%08x..."
+                    % (w[0], offset, unpacked_wrdata, unpacked_rddata))
+                raise RuntimeError("Verification of write to %s at offset %d failed. Wrote 0x%08x... but got back 0x%08x..."
+                    % (w[0], offset, unpacked_wrdata, unpacked_rddata))
+
     def stop(self):
         """Stop the client.
 
@@ -714,7 +1172,7 @@ class FpgaClient(CallbackClient):
         #0x2000     : CPU RX buffer
         #0x3000     : ARP tables start
 
-        port_dump=list(struct.unpack('>16384B',self.read(dev_name,16384)))
+        port_dump=self.read_array(dev_name,numpy.uint8,16384).tolist()
         #ip_prefix = '%3d.%3d.%3d.'%(port_dump[0x10],port_dump[0x11],port_dump[0x12])
 
         rv={}
@@ -780,7 +1238,7 @@ class FpgaClient(CallbackClient):
            @param arp boolean: Include the ARP table
            @param cpu boolean: Include the cpu packet buffers
         """
-        port_dump=list(struct.unpack('>16384B',self.read(dev_name,16384)))
+        port_dump=self.read_array(dev_name,numpy.uint8,16384).tolist()
         ip_prefix= '%3d.%3d.%3d.'%(port_dump[0x10],port_dump[0x11],port_dump[0x12])
 
         print '------------------------'
@@ -898,46 +1356,26 @@ class FpgaClient(CallbackClient):
         #               copy-paste errors from corr_functions :( really need to consolodate these snap functions.
         #2010-02-19 JRM Updated to match snap_x.
         #WORKING OK 2009-07-01
-        if offset >= 0:
-            self.write_int(dev_name+'_trig_offset',offset)
-            #print 'Capturing from snap offset %i'%offset
-
-        #print 'Triggering Capture...',
-        self.write_int(dev_name+'_ctrl',(0 + (man_trig<<1) + (man_valid<<2) + (circular_capture<<3)))
-        self.write_int(dev_name+'_ctrl',(1 + (man_trig<<1) + (man_valid<<2) + (circular_capture<<3)))
-
-        done=False
-        start_time=time.time()
-        while not (done and (offset>=0 or circular_capture)) and ((time.time()-start_time)<wait_period or (wait_period < 0)):
-            addr = self.read_uint(dev_name+'_addr')
-            done = not bool(addr & 0x80000000)
-
-        bram_size= self.read_uint(dev_name+'_addr')&0x7fffffff
-        bram_dmp=dict()
-        bram_dmp={'length':bram_size+1}
-        bram_dmp['offset']=0
-        if (bram_size != self.read_uint(dev_name+'_addr')&0x7fffffff) or bram_size==0:
-            #if address is still changing, then the snap block didn't finish capturing. we return empty.
+        import snap
+        snapshot = snap.Snapshot(self, dev_name, brams = brams, word_mult = word_mult, poll_policy = snap.SNAP_POLL_SPIN)
+        snapshot.arm(man_trig = man_trig, man_valid = man_valid, offset = offset, circular_capture = circular_capture)
+        status, pending = snapshot.poll(wait_period)
+        bram_size = status[0] & 0x7fffffff
+        if bram_size == 0:
             raise RuntimeError("Looks like snap block didn't finish.")
-            bram_dmp['length']=0
-            bram_dmp['offset']=0
-            bram_size=0
-
-        if circular_capture or (offset>=0):
-            #print 'offset: %i,tr_en_cnt: %i'%(offset,self.read_uint(dev_name+'_tr_en_cnt'))
-            bram_dmp['offset']=self.read_uint(dev_name+'_tr_en_cnt') + offset - bram_size
-        else: bram_dmp['offset']=0
-
+        now_status, tr_en_cnt, val, data = snapshot.download(status, circular_capture = (circular_capture or (offset >= 0)))[0]
+        if data == None:
+            #if address is still changing, then the snap block didn't finish capturing.
+            raise RuntimeError("Looks like snap block didn't finish.")
+        bram_dmp = {'length': bram_size + 1}
+        if circular_capture or (offset >= 0):
+            bram_dmp['offset'] = tr_en_cnt + offset - bram_size
+        else:
+            bram_dmp['offset'] = 0
         if (bram_dmp['offset'] < 0):
             #you got a trigger and then a stop before the bram could even fill.
-            bram_dmp['offset']=0
-
-        for b,bram in enumerate(brams):
-            bram_path = dev_name+'_'+bram
-            if (bram_size == 0):
-                bram_dmp[bram]=[]
-            else:
-                bram_dmp[bram]=(self.read(bram_path,(bram_size+1)*4*word_mult))
+            bram_dmp['offset'] = 0
+        bram_dmp.update(data)
         return bram_dmp
 
     def get_rcs(self,rcs_block_name='rcs'):
@@ -979,12 +1417,9 @@ class FpgaClient(CallbackClient):
         return rv
 
     def snapshot_arm(self, dev_name, man_trig=False, man_valid=False, offset=-1, circular_capture=False):
-        if offset >=0:
-            self.write_int(dev_name+'_trig_offset', offset)
-            #print 'Capturing from snap offset %i'%offset
-        #print 'Triggering Capture...',
-        self.write_int(dev_name + '_ctrl', (0 + (man_trig<<1) + (man_valid<<2) + (circular_capture<<3)))
-        self.write_int(dev_name + '_ctrl', (1 + (man_trig<<1) + (man_valid<<2) + (circular_capture<<3)))
+        """Arms a snapshot block on this FPGA device. See snapshot_get."""
+        import snap
+        snap.Snapshot(self, dev_name).arm(man_trig=man_trig, man_valid=man_valid, offset=offset, circular_capture=circular_capture)
 
     def snapshot_get(self, dev_name, man_trig=False, man_valid=False, wait_period=1, offset=-1, circular_capture=False, get_extra_val=False, arm=True):
         """Grabs all brams from a single snap block on this FPGA device.\n
@@ -998,47 +1433,13 @@ class FpgaClient(CallbackClient):
             \t\toffset: number of bytes since last trigger.\n
             \t\tdata: list of data from each fpga for corresponding bram.\n"""
         # new snapshot block support (bytes instead of words) with hardware-configurable datawidth and user-selectable features.
-        #TODO Test offset, get_extra_val and circular capture modes.
-        if arm:
-            self.snapshot_arm(dev_name=dev_name, man_trig=man_trig, man_valid=man_valid, offset=offset, circular_capture=circular_capture)
-        done=False
-        start_time=time.time()
-        while not done and ((time.time()-start_time)<wait_period or (wait_period < 0)):
-            addr = self.read_uint(dev_name+'_status')
-            done = not bool(addr & 0x80000000)
-            time.sleep(0.05)
-
-        bram_size= addr&0x7fffffff
-        bram_dmp=dict()
-        bram_dmp['length']=bram_size
-        if (bram_size != self.read_uint(dev_name+'_status')&0x7fffffff) or bram_size==0:
-            #if address is still changing, then the snap block didn't finish capturing. we return empty.
-            raise RuntimeError("A snap block logic error occurred or it didn't finish capturing in the allotted %2.2f seconds. Reported %i bytes captured."%(wait_period,bram_size))
-            bram_dmp['length']=0
-            bram_dmp['offset']=0
-            bram_size=0
-
-        if circular_capture:
-            #print 'offset: %i,tr_en_cnt: %i'%(offset,self.read_uint(dev_name+'_tr_en_cnt'))
-            # Snap block only starts incrementing tr_en_cnt after it has started writing into memory. Must thus add requested offset. Done later anyway.
-            bram_dmp['offset']=self.read_uint(dev_name+'_tr_en_cnt') - bram_size
-        else:
-            bram_dmp['offset']=0
-
-        bram_dmp['offset']+=offset
-
-        if (bram_dmp['offset'] < 0):
-            #you got a trigger and then a stop before the bram could even fill.
-            bram_dmp['offset']=0
-
-        if (bram_size == 0):
-            bram_dmp['data']=[]
-        else:
-            bram_dmp['data']=(self.read(dev_name+'_bram',(bram_size)))
-
+        # the capture itself is done by snap.Snapshot, which also handles many boards at once.
+        import snap
+        snapshot = snap.Snapshot(self, dev_name, poll_policy = snap.SNAP_POLL_FIXED, poll_interval = 0.05)
+        raw = snapshot.capture(man_trig=man_trig, man_valid=man_valid, wait_period=wait_period, offset=offset, circular_capture=circular_capture, arm=arm, get_extra_val=get_extra_val)
+        bram_dmp = {'length': raw['lengths'][0], 'offset': int(raw['offsets'][0]), 'data': raw['data'][0]}
         if get_extra_val==True:
-            bram_dmp['val']=self.read_uint(dev_name+'_val')
-
+            bram_dmp['val'] = raw['vals'][0]
         return bram_dmp
 
     def arp_announce_adj(self,dev_name, announce_start=130, announce_stop=10000, announce_step=500):
@@ -8,6 +8,9 @@
 """
 
 import threading
+import Queue
+import multiprocessing
+import socket
 import numpy as np
 import spead64_48 as spead
 import logging
@@ -16,6 +19,429 @@ import time
 import h5py
 import corr
 
+class DatasetWriter:
+    """Appends rows - one per dump - to an HDF5 dataset.
+    The dataset is chunked a whole number of rows at a time and grows geometrically, so it is resized a handful of times rather than once per dump.
+    Rows are gathered in memory and written in batches, at least every flush_rows dumps or flush_interval seconds. close() writes what is left and trims the dataset to the number of rows written.
+    """
+    def __init__(self, f, name, shape, dtype, initial_rows = 16, chunk_bytes = 1024*1024, buffer_bytes = 4*1024*1024, compression = None, flush_rows = 16, flush_interval = 10.0):
+        """
+        @param f: the open h5py File
+        @param name: the dataset name
+        @param shape: the shape of one row, [1] for a scalar
+        @param dtype: the numpy dtype of the data
+        @param initial_rows: the number of rows to allocate to start with
+        @param chunk_bytes: the target HDF5 chunk size. A chunk always holds at least one row, ie one dump.
+        @param buffer_bytes: how much data to gather in memory before writing it. At least one row is always gathered.
+        @param compression: optional h5py compression filter, eg 'gzip' or 'lzf'
+        @param flush_rows: write at least every this many rows, so small items such as timestamps don't sit in memory for long
+        @param flush_interval: write gathered rows once they've been waiting this many seconds
+        """
+        self.name = name
+        self.row_shape = [] if list(shape) == [1] else list(shape)
+        self.dtype = np.dtype(dtype)
+        row_bytes = max(1, int(np.multiply.reduce(self.row_shape)) * self.dtype.itemsize)
+        chunk_rows = max(1, min(1024, chunk_bytes / row_bytes))
+        self.buffer_rows = max(1, min(flush_rows, buffer_bytes / row_bytes))
+        self.flush_interval = flush_interval
+        self.capacity = max(initial_rows, chunk_rows)
+        self.size = 0
+        self.dataset = f.create_dataset(name, [self.capacity] + self.row_shape, maxshape = [None] + self.row_shape, dtype = self.dtype,
+            chunks = tuple([chunk_rows] + self.row_shape), compression = compression)
+        self._buffer = np.empty([self.buffer_rows] + self.row_shape, dtype = self.dtype)
+        self._buffered = 0
+        self._flush_time = time.time()
+
+    def __len__(self):
+        return self.size + self._buffered
+
+    def append(self, value):
+        """Add a row."""
+        self._buffer[self._buffered] = value
+        self._buffered += 1
+        if (self._buffered == self.buffer_rows) or (time.time() - self._flush_time >= self.flush_interval):
+            self.flush()
+
+    def flush(self):
+        """Write the gathered rows to the dataset, growing it if necessary."""
+        self._flush_time = time.time()
+        if self._buffered == 0:
+            return
+        if self.size + self._buffered > self.capacity:
+            while self.size + self._buffered > self.capacity:
+                self.capacity *= 2
+            self.dataset.resize(self.capacity, axis = 0)
+        self.dataset[self.size:self.size + self._buffered] = self._buffer[0:self._buffered]
+        self.size += self._buffered
+        self._buffered = 0
+
+    def close(self):
+        """Write any gathered rows and trim the dataset to the rows written."""
+        self.flush()
+        self.dataset.resize(self.size, axis = 0)
+
+class BoundedQueue:
+    """A fixed-depth queue between two pipeline stages, counting what happens when it fills up.
+    A full queue either drops the new item (drop = True, for best-effort data such as signal display frames) or makes the producer wait (counted as an overflow).
+    """
+    def __init__(self, name, depth, drop = False):
+        self.name = name
+        self.depth = depth
+        self.drop = drop
+        self._queue = Queue.Queue(depth)
+        self._lock = threading.Lock()
+        self.puts = 0
+        self.drops = 0
+        self.overflows = 0
+        self.high_water = 0
+
+    def put(self, item, drop = None):
+        """Queue an item. Returns False if it was dropped.
+        @param drop: override the queue's drop policy for this item
+        """
+        if drop == None:
+            drop = self.drop
+        try:
+            self._queue.put_nowait(item)
+        except Queue.Full:
+            if drop:
+                self.note_drop()
+                return False
+            self._lock.acquire()
+            self.overflows += 1
+            self._lock.release()
+            self._queue.put(item)
+        self._lock.acquire()
+        self.puts += 1
+        self.high_water = max(self.high_water, self._queue.qsize())
+        self._lock.release()
+        return True
+
+    def note_drop(self):
+        """Count an item that was dropped before it could be queued, eg because the producer had nowhere to put it."""
+        self._lock.acquire()
+        self.drops += 1
+        self._lock.release()
+
+    def put_end(self):
+        """Tell the consumer that there is no more data. This is never dropped."""
+        self._queue.put(None)
+
+    def get(self):
+        return self._queue.get()
+
+    def stats(self):
+        self._lock.acquire()
+        rv = {'depth': self.depth, 'queued': self._queue.qsize(), 'puts': self.puts, 'drops': self.drops, 'overflows': self.overflows, 'high_water': self.high_water}
+        self._lock.release()
+        return rv
+
+class FrameRing:
+    """A fixed set of frame buffers passed between the stage that fills them and the stage that sends them.
+    Buffers are zeroed and reused in place, so nothing is allocated per frame once the ring is set up.
+    """
+    def __init__(self, shape, dtype, n_buffers = 2):
+        """
+        @param shape: shape of each frame
+        @param dtype: numpy dtype of each frame
+        @param n_buffers: number of buffers, ie one being filled plus up to n_buffers - 1 waiting to be sent
+        """
+        if n_buffers < 2:
+            raise RuntimeError('A frame ring needs at least two buffers.')
+        self.shape = tuple(shape)
+        self.buffers = [np.zeros(shape, dtype = dtype) for n in range(n_buffers)]
+        self.current = 0
+        self._free = Queue.Queue()
+        for n in range(1, n_buffers):
+            self._free.put(n)
+
+    def frame(self):
+        """The buffer currently being filled."""
+        return self.buffers[self.current]
+
+    def clear(self):
+        """Zero the buffer currently being filled."""
+        self.buffers[self.current].fill(0)
+
+    def swap(self):
+        """Hand on the buffer being filled and start filling a free one.
+        @return the index of the buffer handed on, to be passed to release once it has been used. None if no buffer was free, in which case the current frame is cleared and filled again.
+        """
+        try:
+            n = self._free.get_nowait()
+        except Queue.Empty:
+            self.clear()
+            return None
+        done = self.current
+        self.current = n
+        return done
+
+    def release(self, n):
+        """Zero buffer n and return it to the ring. Called by the consumer once it has finished with the buffer."""
+        self.buffers[n].fill(0)
+        self._free.put(n)
+
+class PipelineStage(threading.Thread):
+    """A thread that hands each item from a BoundedQueue to a function until the queue's end marker arrives.
+    Errors are logged and counted, but don't stop the stage.
+    """
+    def __init__(self, name, in_queue, handler, logger):
+        threading.Thread.__init__(self, name = name)
+        self.daemon = True
+        self.in_queue = in_queue
+        self.handler = handler
+        self.logger = logger
+        self.errors = 0
+
+    def run(self):
+        while True:
+            item = self.in_queue.get()
+            if item is None:
+                return
+            try:
+                self.handler(item)
+            except Exception:
+                self.errors += 1
+                self.logger.exception("Error in %s stage." % self.name)
+
+def _receive_heaps(source, heaps):
+    # the receive stage: nothing but taking heaps off the socket, or off the shard processes
+    try:
+        for heap in source:
+            heaps.put(heap)
+    finally:
+        heaps.put_end()
+
+# item values shorter than this are passed from shard processes in the message itself, longer ones through shared memory
+SHARD_INLINE_BYTES = 4096
+
+# the parts of spead64_48 that the shard processes use themselves rather than through TransportUDPrx and ItemGroup, as (name, attribute)
+_SHARD_SPEAD_NEEDS = [('DESCRIPTOR_ID', None), ('iterheaps', None), ('SpeadHeap', 'get_items')]
+_SHARED_PORT_SPEAD_NEEDS = [('MAX_PACKET_LEN', None), ('SpeadPacket', 'unpack'), ('SpeadPacket', 'is_stream_ctrl_term')]
+
+def _check_spead_for_shards(reuse_port):
+    # a mismatch would otherwise only show up inside the shard processes, once data arrives
+    missing = []
+    for name, attr in _SHARD_SPEAD_NEEDS + (_SHARED_PORT_SPEAD_NEEDS if reuse_port else []):
+        if not hasattr(spead, name):
+            missing.append(name)
+        elif (attr != None) and not hasattr(getattr(spead, name), attr):
+            missing.append('%s.%s' % (name, attr))
+    if len(missing) > 0:
+        raise RuntimeError('The installed spead64_48 has no %s, which receiving in several processes needs. Use a single process.' % ', '.join(missing))
+
+class TransportUDPrxShared:
+    """A SPEAD UDP receive transport on a socket opened with SO_REUSEPORT, so that several processes can listen on the same port.
+    The kernel hands all the packets from one source address and port to the same socket, so each X engine's stream goes to a single process.
+    """
+    def __init__(self, port, buffer_size = 0, timeout = 0.5):
+        if not hasattr(socket, 'SO_REUSEPORT'):
+            raise RuntimeError('SO_REUSEPORT is not available on this platform, use a port per shard instead.')
+        self.port = port
+        self._sock = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+        self._sock.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+        self._sock.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEPORT, 1)
+        if buffer_size > 0:
+            self._sock.setsockopt(socket.SOL_SOCKET, socket.SO_RCVBUF, buffer_size)
+        self._sock.bind(('', port))
+        self._sock.settimeout(timeout)
+        self._running = True
+
+    def iterpackets(self):
+        while self._running:
+            try:
+                data = self._sock.recv(spead.MAX_PACKET_LEN)
+            except socket.timeout:
+                continue
+            pkt = spead.SpeadPacket()
+            try:
+                pkt.unpack(data)
+            except ValueError:
+                continue
+            if pkt.is_stream_ctrl_term:
+                break
+            yield pkt
+
+    def stop(self):
+        self._running = False
+        self._sock.close()
+
+class _ShardHeap:
+    # a heap as assembled by a shard process, with its item values still as strings, which is all ItemGroup.update needs
+    def __init__(self, heap_cnt, items):
+        self.heap_cnt = heap_cnt
+        self._items = items
+    def get_items(self):
+        return self._items
+
+def _shard_receive(shard, port, reuse_port, buffer_size, shm, slot_bytes, free_slots, out_queue):
+    # runs in a shard process: assemble heaps from packets and pass their items on, the big ones through a slot in shared memory.
+    # At the end it sends (shard, None, None, None, None), or (shard, None, None, error message, None) if it failed.
+    rx = None
+    try:
+        if reuse_port:
+            rx = TransportUDPrxShared(port, buffer_size=buffer_size)
+        else:
+            rx = spead.TransportUDPrx(port, pkt_count=1024, buffer_size=buffer_size)
+        view = np.frombuffer(shm, dtype=np.uint8)
+        for heap in spead.iterheaps(rx):
+            items = heap.get_items()
+            inline = {}
+            shared = []
+            slot = None
+            offset = 0
+            for id, value in items.iteritems():
+                if id == spead.DESCRIPTOR_ID or not isinstance(value, str) or len(value) < SHARD_INLINE_BYTES or offset + len(value) > slot_bytes:
+                    inline[id] = value
+                    continue
+                if slot is None:
+                    slot = free_slots.get()
+                start = slot * slot_bytes + offset
+                view[start:start + len(value)] = np.frombuffer(value, dtype=np.uint8)
+                shared.append((id, offset, len(value)))
+                offset += len(value)
+            out_queue.put((shard, heap.heap_cnt, slot, inline, shared))
+        out_queue.put((shard, None, None, None, None))
+    except Exception, e:
+        out_queue.put((shard, None, None, '%s: %s' % (e.__class__.__name__, e), None))
+    finally:
+        if rx != None:
+            rx.stop()
+
+class ShardedReceiver:
+    """Receives SPEAD heaps in several processes and merges them into a single stream of heaps.
+    Each process listens on its own port, or they all share one port with SO_REUSEPORT, and handles the X engines that send to it.
+    The processes only assemble heaps from packets, which is where a single receiver runs out of CPU. Items are decoded by the merging process,
+    so the metadata and data descriptors only need to reach one of the processes.
+    Only works for data where each heap comes from a single X engine, ie inter mode.
+    """
+    def __init__(self, ports, reuse_port = False, buffer_size = 51200000, slots = 4, slot_bytes = 16*1024*1024, drain_timeout = 1.0, poll_interval = 0.5):
+        """
+        @param ports: list of UDP ports, one per process. With reuse_port they're all the same port.
+        @param reuse_port: open the sockets with SO_REUSEPORT
+        @param buffer_size: socket receive buffer size for each process
+        @param slots: number of heaps each process can have waiting in shared memory for the merger
+        @param slot_bytes: shared memory per heap. Larger items are passed through a queue instead, which is slower.
+        @param drain_timeout: seconds to keep taking heaps from the other processes once one of them has got the end-of-stream marker
+        @param poll_interval: how often to check that the processes are still running while waiting for heaps
+        """
+        if reuse_port and not hasattr(socket, 'SO_REUSEPORT'):
+            raise RuntimeError('SO_REUSEPORT is not available on this platform, use a port per shard instead.')
+        _check_spead_for_shards(reuse_port)
+        self.ports = list(ports)
+        self.reuse_port = reuse_port
+        self.slot_bytes = slot_bytes
+        self.drain_timeout = drain_timeout
+        self.poll_interval = poll_interval
+        self._stopped = False
+        self.heaps = [0] * len(self.ports)
+        self._queue = multiprocessing.Queue()
+        self._shm = []
+        self._views = []
+        self._free = []
+        self.processes = []
+        for shard, port in enumerate(self.ports):
+            shm = multiprocessing.RawArray('c', slots * slot_bytes)
+            free = multiprocessing.Queue()
+            for slot in range(slots):
+                free.put(slot)
+            self._shm.append(shm)
+            self._views.append(np.frombuffer(shm, dtype=np.uint8))
+            self._free.append(free)
+            p = multiprocessing.Process(target=_shard_receive, name='shard%i' % shard,
+                args=(shard, port, reuse_port, buffer_size, shm, slot_bytes, free, self._queue))
+            p.daemon = True
+            self.processes.append(p)
+
+    def start(self):
+        for p in self.processes:
+            p.start()
+
+    def iterheaps(self):
+        """Yield the heaps from all the processes in the order they arrive, until one of them gets a SPEAD end-of-stream marker
+        and the others have nothing more to pass on. The marker is only sent to one port, so the others don't see it.
+        Stops early, after passing on what is already queued, once stop() is called.
+        Raises RuntimeError if a process fails or exits without getting the marker.
+        """
+        ended = 0
+        while True:
+            try:
+                if self._stopped:
+                    shard, heap_cnt, slot, items, shared = self._queue.get(False)
+                else:
+                    shard, heap_cnt, slot, items, shared = self._queue.get(True, self.poll_interval if ended == 0 else self.drain_timeout)
+            except Queue.Empty:
+                if self._stopped or ended > 0:
+                    return
+                self._check_processes()
+                continue
+            if heap_cnt == None:
+                if items != None:
+                    raise RuntimeError('Receive process for port %i failed: %s' % (self.ports[shard], items))
+                ended += 1
+                if ended == len(self.ports):
+                    return
+                continue
+            if slot != None:
+                view = self._views[shard]
+                base = slot * self.slot_bytes
+                for id, offset, length in shared:
+                    items[id] = view[base + offset:base + offset + length].tostring()
+                self._free[shard].put(slot)
+            self.heaps[shard] += 1
+            yield _ShardHeap(heap_cnt, items)
+
+    def _check_processes(self):
+        # called when nothing has arrived for a while: a process that died without saying so would otherwise leave us waiting forever
+        for shard, p in enumerate(self.processes):
+            if not p.is_alive() and self._queue.empty():
+                raise RuntimeError('Receive process for port %i exited with code %s without getting an end-of-stream marker.' % (self.ports[shard], p.exitcode))
+
+    def stop(self):
+        self._stopped = True
+        for p in self.processes:
+            if p.is_alive():
+                p.terminate()
+            p.join()
+
+    def stats(self):
+        return [{'port': port, 'heaps': self.heaps[shard], 'alive': self.processes[shard].is_alive()} for shard, port in enumerate(self.ports)]
+
+class HeapDispatcher:
+    """Unpacks heaps into an ItemGroup and calls handlers for just the items each heap carried, rather than looking at every item in the group.
+    The handlers for each item come from a table keyed on item name, filled in the first time the item is described.
+    """
+    def __init__(self, ig, new_item):
+        """
+        @param ig: the spead.ItemGroup to unpack heaps into
+        @param new_item: function(name) called once for each newly described item, returning the list of handlers for its values.
+                         Each is called as handler(name) and can return False to stop the rest of the list being called.
+        """
+        self.ig = ig
+        self.new_item = new_item
+        self.handlers = {}
+        self.names = {}
+
+    def _describe(self):
+        # new descriptors: map ids to names, and set up items we haven't seen before
+        for name in self.ig.keys():
+            self.names[self.ig.get_item(name).id] = name
+            if not self.handlers.has_key(name):
+                self.handlers[name] = self.new_item(name)
+
+    def dispatch(self, heap):
+        """Update the ItemGroup from a heap and call the handlers of the items whose values it carried."""
+        self.ig.update(heap)
+        items = heap.get_items()
+        if len(items.get(spead.DESCRIPTOR_ID, [])) > 0:
+            self._describe()
+        for id in items.iterkeys():
+            name = self.names.get(id)
+            if name == None: continue
+            for handler in self.handlers[name]:
+                if handler(name) == False: break
+            self.ig.get_item(name)._changed = False
+
 class CorrRx(threading.Thread):
     def __init__(self, mode = 'cont', port=7148, log_handler = None, log_level = logging.INFO, spead_log_level = logging.WARN, **kwargs):
         if log_handler == None:
@@ -32,18 +458,97 @@ class CorrRx(threading.Thread):
             self._target = self.rx_inter
         else:
             raise RuntimeError('Mode not understood. Expecting inter or cont.')
+        if mode == 'cont' and kwargs.get('shards', 1) > 1:
+            raise RuntimeError('Only inter mode data can be received by several processes, in cont mode every X engine sends part of each heap.')
+        if kwargs.get('shards', 1) > 1:
+            _check_spead_for_shards(kwargs.get('reuse_port', False))
         self._kwargs = kwargs
         #print kwargs
+        self.queues = {}
+        self.stages = []
+        self.receiver = None
+        self.transport = None
+        self._transport_lock = threading.Lock()
+        self._stop_requested = False
         threading.Thread.__init__(self)
 
     def run(self):
         #print 'starting target with kwargs ',self._kwargs
         self._target(**self._kwargs)
 
-    def rx_cont(self,data_port=7148, sd_ip='127.0.0.1', sd_port=7149,acc_scale=True, filename=None,**kwargs):
+    def stop(self):
+        """Stop receiving, as if the SPEAD end-of-stream marker had arrived. What has already been received is still written
+        and the file closed as the thread finishes, so join() the thread afterwards.
+        """
+        self._stop_requested = True
+        self._stop_transport()
+
+    def _set_transport(self, transport):
+        self.transport = transport
+        if self._stop_requested:
+            self._stop_transport()
+
+    def _stop_transport(self):
+        # stop the transport once, whether asked to by stop() or because the assemble stage is finishing
+        self._transport_lock.acquire()
+        transport = self.transport
+        self.transport = None
+        self._transport_lock.release()
+        if transport != None:
+            transport.stop()
+
+    def stats(self):
+        """Counters for each of the queues between the receive, assemble, write and signal display stages."""
+        rv = {}
+        for name, queue in self.queues.iteritems():
+            rv[name] = queue.stats()
+        for stage in self.stages:
+            rv[stage.name]['errors'] = stage.errors
+        if self.receiver != None:
+            rv['shards'] = self.receiver.stats()
+        return rv
+
+    def _pipeline_start(self, source, f, compression, queue_depth, sd_queue_depth, sd_handler):
+        """Start the receive, write and signal display stages. The receive stage takes heaps from source, an iterator.
+        The caller is the assemble stage, taking heaps from queues['receive'] and
+        putting ('create', name, shape, dtype) and ('append', name, value) onto queues['write'] and signal display work onto queues['sd'].
+        """
+        datasets = {}
+        def write_handler(item):
+            if item[0] == 'create':
+                datasets[item[1]] = DatasetWriter(f, item[1], item[2], item[3], compression=compression)
+            else:
+                datasets[item[1]].append(item[2])
+        self.queues = {'receive': BoundedQueue('receive', queue_depth),
+                       'write': BoundedQueue('write', queue_depth),
+                       'sd': BoundedQueue('sd', sd_queue_depth, drop=True)}
+        receiver = threading.Thread(target=_receive_heaps, args=(source, self.queues['receive']), name='receive')
+        receiver.daemon = True
+        self.stages = [PipelineStage('write', self.queues['write'], write_handler, self.logger),
+                       PipelineStage('sd', self.queues['sd'], sd_handler, self.logger)]
+        for stage in self.stages:
+            stage.start()
+        receiver.start()
+        return datasets
+
+    def _pipeline_stop(self, datasets):
+        """Let the write and signal display stages finish what is queued, then close the datasets."""
+        for name in ['write', 'sd']:
+            self.queues[name].put_end()
+        for stage in self.stages:
+            stage.join()
+        for writer in datasets.itervalues():
+            writer.close()
+        stats = self.stats()
+        for name in ['receive', 'write', 'sd']:
+            self.logger.info("%s queue: %s" % (name, str(stats[name])))
+
+    def rx_cont(self,data_port=7148, sd_ip='127.0.0.1', sd_port=7149,acc_scale=True, filename=None, compression=None, queue_depth=64, sd_queue_depth=4, **kwargs):
         logger=self.logger
         logger.info("Data reception on port %i."%data_port)
         rx = spead.TransportUDPrx(data_port, pkt_count=1024, buffer_size=51200000)
+        source = spead.iterheaps(rx)
+        self._set_transport(rx)
         logger.info("Sending Signal Display data to %s:%i."%(sd_ip,sd_port))
         tx_sd = spead.Transmitter(spead.TransportUDPtx(sd_ip, sd_port))
         ig = spead.ItemGroup()
@@ -55,117 +560,148 @@ class CorrRx(threading.Thread):
         data_ds = None
         ts_ds = None
         idx = 0
-        dump_size = 0
-        datasets = {}
-        datasets_index = {}
+        dataset_rows = {}
         meta_required = ['n_chans','bandwidth','n_bls','n_xengs','center_freq','bls_ordering']
          # we need these bits of meta data before being able to assemble and transmit signal display data
         meta_desired = ['n_accs']
         meta = {}
-        for heap in spead.iterheaps(rx):
-            ig.update(heap)
-            logger.debug("PROCESSING HEAP idx(%i) cnt(%i) @ %.4f" % (idx, heap.heap_cnt, time.time()))
-            for name in ig.keys():
-                item = ig.get_item(name)
-                if not item._changed and datasets.has_key(name): continue # the item is not marked as changed, and we have a record for it
-                if name in meta_desired:
-                    meta[name] = ig[name]
-                if name in meta_required:
-                    meta[name] = ig[name]
-                    meta_required.pop(meta_required.index(name))
-                    if len(meta_required) == 0:
-                        #sd_frame = np.zeros((meta['n_chans'],meta['n_bls'],2),dtype=np.float32)
-                        logger.info("Got all required metadata. Expecting data frame shape of %i %i %i"%(meta['n_chans'],meta['n_bls'],2))
-                        meta_required = ['n_chans','bandwidth','n_bls','n_xengs','center_freq','bls_ordering']
-                        ig_sd = spead.ItemGroup()
-                        for meta_item in meta_required:
-                          ig_sd.add_item(
-                            name=ig.get_item(meta_item).name,
-                            id=ig.get_item(meta_item).id,
-                            description=ig.get_item(meta_item).description,
-                            #shape=ig.get_item(meta_item).shape,
-                            #fmt=ig.get_item(meta_item).format,
-                            init_val=ig.get_item(meta_item).get_value())
-                        tx_sd.send_heap(ig_sd.get_heap())
-
-                if not datasets.has_key(name):
-                 # check to see if we have encountered this type before
-                    shape = ig[name].shape if item.shape == -1 else item.shape
-                    dtype = np.dtype(type(ig[name])) if shape == [] else item.dtype
-                    if dtype is None: dtype = ig[name].dtype
-                     # if we can't get a dtype from the descriptor try and get one from the value
-                    logger.info("Creating dataset for %s (%s,%s)."%(str(name),str(shape),str(dtype)))
-                    f.create_dataset(name,[1] + ([] if list(shape) == [1] else list(shape)), maxshape=[None] + ([] if list(shape) == [1] else list(shape)), dtype=dtype)
-                    dump_size += np.multiply.reduce(shape) * dtype.itemsize
-                    datasets[name] = f[name]
-                    datasets_index[name] = 0
-                    if not item._changed: continue
-                     # if we built from and empty descriptor
-                else:
-                    logger.info("Adding %s to dataset. New size is %i."%(name,datasets_index[name]+1))
-                    f[name].resize(datasets_index[name]+1, axis=0)
-                if name.startswith("xeng_raw"):
-                    sd_timestamp = ig['sync_time'] + (ig['timestamp'] / float(ig['scale_factor_timestamp']))
-                    #logger.info("SD Timestamp: %f (%s)."%(sd_timestamp,time.ctime(sd_timestamp)))
 
-                    scale_factor=float(meta['n_accs'] if (meta.has_key('n_accs') and acc_scale) else 1)
-                    scaled_data = (ig[name]/scale_factor).astype(np.float32)
+        def sd_handler(item):
+            # the signal display stage: scale the data and send it, or send metadata
+            if item[0] == 'meta':
+                tx_sd.send_heap(item[1].get_heap())
+                return
+            name, data, sd_timestamp, scale_factor = item[1:]
+            scaled_data = (data/scale_factor).astype(np.float32)
+
+             # reinit the group to force meta data resend
+            ig_sd = spead.ItemGroup()
+            ig_sd.add_item(name=('sd_data'),
+                            id=(0x3501),
+                            description="Combined raw data from all x engines.",
+                            ndarray=(scaled_data.dtype,scaled_data.shape))
+            ig_sd.add_item(name=('sd_timestamp'),
+                            id=0x3502,
+                            description='Timestamp of this sd frame in centiseconds since epoch (40 bit limitation).',
+                            init_val=sd_timestamp)
+                            #shape=[],
+                            #fmt=spead.mkfmt(('u',spead.ADDRSIZE)))
+            t_it = ig_sd.get_item('sd_data')
+            logger.debug("Added SD frame with shape %s, dtype %s"%(str(t_it.shape),str(t_it.dtype)))
+            tx_sd.send_heap(ig_sd.get_heap())
+
+            logger.info("Sending signal display frame with timestamp %i (%s). %s. Max: %i, Mean: %i"%(
+                sd_timestamp,
+                time.ctime(sd_timestamp),
+                "Unscaled" if not acc_scale else "Scaled by %i" % (scale_factor),
+                np.max(scaled_data),
+                np.mean(scaled_data)))
+            ig_sd['sd_data'] = scaled_data
+            ig_sd['sd_timestamp'] = sd_timestamp * 100
+            #ig_sd['sd_timestamp'] = sd_timestamp
+            tx_sd.send_heap(ig_sd.get_heap())
+
+        datasets = self._pipeline_start(source, f, compression, queue_depth, sd_queue_depth, sd_handler)
+        heaps = self.queues['receive']
+        writes = self.queues['write']
+        sd = self.queues['sd']
+        meta_missing = list(meta_required)
 
-                     # reinit the group to force meta data resend
+        def update_meta(name):
+            meta[name] = ig[name]
+            if name in meta_missing:
+                meta_missing.remove(name)
+                if len(meta_missing) == 0:
+                    #sd_frame = np.zeros((meta['n_chans'],meta['n_bls'],2),dtype=np.float32)
+                    logger.info("Got all required metadata. Expecting data frame shape of %i %i %i"%(meta['n_chans'],meta['n_bls'],2))
+                    meta_missing.extend(meta_required)
                     ig_sd = spead.ItemGroup()
-                    ig_sd.add_item(name=('sd_data'),
-                                    id=(0x3501),
-                                    description="Combined raw data from all x engines.",
-                                    ndarray=(scaled_data.dtype,scaled_data.shape))
-                    ig_sd.add_item(name=('sd_timestamp'),
-                                    id=0x3502,
-                                    description='Timestamp of this sd frame in centiseconds since epoch (40 bit limitation).',
-                                    init_val=sd_timestamp)
-                                    #shape=[],
-                                    #fmt=spead.mkfmt(('u',spead.ADDRSIZE)))
-                    t_it = ig_sd.get_item('sd_data')
-                    logger.debug("Added SD frame with shape %s, dtype %s"%(str(t_it.shape),str(t_it.dtype)))
-                    tx_sd.send_heap(ig_sd.get_heap())
-
-                    logger.info("Sending signal display frame with timestamp %i (%s). %s. Max: %i, Mean: %i"%(
-                        sd_timestamp,
-                        time.ctime(sd_timestamp),
-                        "Unscaled" if not acc_scale else "Scaled by %i" % (scale_factor),
-                        np.max(scaled_data),
-                        np.mean(scaled_data)))
-                    ig_sd['sd_data'] = scaled_data
-                    ig_sd['sd_timestamp'] = sd_timestamp * 100
-                    #ig_sd['sd_timestamp'] = sd_timestamp
-                    tx_sd.send_heap(ig_sd.get_heap())
-
-                f[name][datasets_index[name]] = ig[name]
-                datasets_index[name] += 1
-                item._changed = False
-                  # we have dealt with this item so continue...
-            idx+=1
+                    for meta_item in meta_required:
+                      ig_sd.add_item(
+                        name=ig.get_item(meta_item).name,
+                        id=ig.get_item(meta_item).id,
+                        description=ig.get_item(meta_item).description,
+                        #shape=ig.get_item(meta_item).shape,
+                        #fmt=ig.get_item(meta_item).format,
+                        init_val=ig.get_item(meta_item).get_value())
+                    sd.put(('meta', ig_sd), drop=False)
+
+        def forward_sd(name):
+            sd_timestamp = ig['sync_time'] + (ig['timestamp'] / float(ig['scale_factor_timestamp']))
+            #logger.info("SD Timestamp: %f (%s)."%(sd_timestamp,time.ctime(sd_timestamp)))
+            scale_factor=float(meta['n_accs'] if (meta.has_key('n_accs') and acc_scale) else 1)
+            if not sd.put(('data', name, ig[name], sd_timestamp, scale_factor)):
+                logger.warning("Signal display stage is behind, dropped the frame for %s."%name)
+
+        def append_dataset(name):
+            logger.info("Adding %s to dataset. New size is %i."%(name,dataset_rows[name]+1))
+            writes.put(('append', name, ig[name]))
+            dataset_rows[name] += 1
+
+        def new_item(name):
+            # create the dataset for an item seen for the first time and pick the handlers for its values
+            item = ig.get_item(name)
+            shape = ig[name].shape if item.shape == -1 else item.shape
+            dtype = np.dtype(type(ig[name])) if shape == [] else item.dtype
+            if dtype is None: dtype = ig[name].dtype
+             # if we can't get a dtype from the descriptor try and get one from the value
+            logger.info("Creating dataset for %s (%s,%s)."%(str(name),str(shape),str(dtype)))
+            writes.put(('create', name, shape, dtype))
+            dataset_rows[name] = 0
+            handlers = []
+            if name in meta_required or name in meta_desired:
+                handlers.append(update_meta)
+            if name.startswith("xeng_raw"):
+                handlers.append(forward_sd)
+            handlers.append(append_dataset)
+            return handlers
+
+        dispatcher = HeapDispatcher(ig, new_item)
+        try:
+            while True:
+                heap = heaps.get()
+                if heap is None: break
+                logger.debug("PROCESSING HEAP idx(%i) cnt(%i) @ %.4f" % (idx, heap.heap_cnt, time.time()))
+                dispatcher.dispatch(heap)
+                idx+=1
+        finally:
+            # on the end-of-stream marker, stop() or a failing handler, still write out what was received and close the file
+            logger.info("Got a SPEAD end-of-stream marker, or stopping. Closing File.")
+            self._stop_transport()
+            self._pipeline_stop(datasets)
+            f.flush()
+            f.close()
 
 #        for (name,idx) in datasets_index.iteritems():
 #            if idx == 1:
 #                self.logger.info("Repacking dataset %s as an attribute as it is singular."%name)
 #                f['/'].attrs[name] = f[name].value[0]
 #                f.__delitem__(name)
-        logger.info("Got a SPEAD end-of-stream marker. Closing File.")
-        f.flush()
-        f.close()
-        rx.stop()
         ig_sd = None
         sd_timestamp = None
         logger.info("Files and sockets closed.")
 
 
-    def rx_inter(self,data_port=7148, sd_ip='127.0.0.1', sd_port=7149, acc_scale=True, filename=None, **kwargs):
+    def rx_inter(self,data_port=7148, sd_ip='127.0.0.1', sd_port=7149, acc_scale=True, filename=None, compression=None, queue_depth=64, sd_queue_depth=4, shards=1, reuse_port=False, **kwargs):
         '''
         Process SPEAD data from X engines and forward it to the SD.
+        @param shards: number of processes to receive the data in. Each listens on its own port, from data_port up, unless reuse_port is set.
+        @param reuse_port: have all the receive processes share data_port using SO_REUSEPORT
         '''
         print 'WARNING: This function is not yet tested. YMMV.'
         logger=self.logger
-        logger.info("Data reception on port %i."%data_port)
-        rx = spead.TransportUDPrx(data_port, pkt_count=1024, buffer_size=51200000)
+        if shards > 1:
+            ports = [data_port] * shards if reuse_port else range(data_port, data_port + shards)
+            logger.info("Data reception in %i processes on port(s) %s."%(shards,', '.join(str(p) for p in sorted(set(ports)))))
+            rx = ShardedReceiver(ports, reuse_port=reuse_port)
+            self.receiver = rx
+            rx.start()
+            source = rx.iterheaps()
+        else:
+            logger.info("Data reception on port %i."%data_port)
+            rx = spead.TransportUDPrx(data_port, pkt_count=1024, buffer_size=51200000)
+            source = spead.iterheaps(rx)
+        self._set_transport(rx)
         logger.info("Sending Signal Display data to %s:%i."%(sd_ip,sd_port))
         tx_sd = spead.Transmitter(spead.TransportUDPtx(sd_ip, sd_port))
         ig = spead.ItemGroup()
@@ -177,137 +713,184 @@ class CorrRx(threading.Thread):
         data_ds = None
         ts_ds = None
         idx = 0
-        dump_size = 0
-        datasets = {}
-        datasets_index = {}
+        dataset_rows = {}
         # we need these bits of meta data before being able to assemble and transmit signal display data
         meta_required = ['n_chans','n_bls','n_xengs','center_freq','bls_ordering','bandwidth']
         meta_desired = ['n_accs']
         meta = {}
-        sd_frame = None
-        sd_slots = None
-        timestamp = None
 
-        # log the latest timestamp for which we've stored data
-        currentTimestamp = -1
+        # the signal display stage's float32 output buffer and the item group describing it, kept from frame to frame
+        sd_out = {'data': None, 'ig': None}
 
-        # iterate through SPEAD heaps returned by the SPEAD receiver.
-        for heap in spead.iterheaps(rx):
-            ig.update(heap)
-            logger.debug("PROCESSING HEAP idx(%i) cnt(%i) @ %.4f" % (idx, heap.heap_cnt, time.time()))
-            for name in ig.keys():
-                item = ig.get_item(name)
-
-                # the item is not marked as changed and we already have a record for it, continue
-                if not item._changed and datasets.has_key(name):
-                  continue
-                logger.debug("PROCESSING KEY %s @ %.4f" % (name, time.time()))
-
-                if name in meta_desired:
-                    meta[name] = ig[name]
-
-                if name in meta_required:
-                  meta[name] = ig[name]
-                  meta_required.pop(meta_required.index(name))
-                  if len(meta_required) == 0:
-                    sd_frame = np.zeros((meta['n_chans'],meta['n_bls'],2),dtype=np.float32)
-                    logger.info("Got all required metadata. Initialised sd frame to shape %s"%(str(sd_frame.shape)))
-                    meta_required = ['n_chans','bandwidth','n_bls','n_xengs','center_freq','bls_ordering']
-                    ig_sd = spead.ItemGroup()
-                    for meta_item in meta_required:
-                      ig_sd.add_item(
-                        name=ig.get_item(meta_item).name,
-                        id=ig.get_item(meta_item).id,
-                        description=ig.get_item(meta_item).description,
-                        #shape=ig.get_item(meta_item).shape,
-                        #fmt=ig.get_item(meta_item).format,
-                        init_val=ig.get_item(meta_item).get_value())
-                    tx_sd.send_heap(ig_sd.get_heap())
-                    sd_slots = np.zeros(meta['n_xengs'])
-                if not datasets.has_key(name):
-                 # check to see if we have encountered this type before
-                  shape = ig[name].shape if item.shape == -1 else item.shape
-                  dtype = np.dtype(type(ig[name])) if shape == [] else item.dtype
-                  if dtype is None: dtype = ig[name].dtype
-                   # if we can't get a dtype from the descriptor, try and get one from the value
-                  logger.info("Creating dataset for %s (%s,%s)."%(str(name),str(shape),str(dtype)))
-                  f.create_dataset(name,[1] + ([] if list(shape) == [1] else list(shape)), maxshape=[None] + ([] if list(shape) == [1] else list(shape)), dtype=dtype)
-                  dump_size += np.multiply.reduce(shape) * dtype.itemsize
-                  datasets[name] = f[name]
-                  datasets_index[name] = 0
-                  # if we built from an empty descriptor
-                  if not item._changed:
-                    continue
+        def sd_handler(item):
+            # the signal display stage: scale and send complete frames, or send metadata
+            if item[0] == 'meta':
+                tx_sd.send_heap(item[1].get_heap())
+                # the receivers are starting afresh, so describe the frame items again with the next frame
+                sd_out['ig'] = None
+                return
+            ring, n, timestamp, scale_factor = item[1:]
+            try:
+                sd_frame = ring.buffers[n]
+                if sd_out['data'] is None or sd_out['data'].shape != sd_frame.shape:
+                    sd_out['data'] = np.empty(sd_frame.shape, dtype=np.float32)
+                    sd_out['ig'] = None
+                if acc_scale:
+                    np.divide(sd_frame, float(scale_factor), sd_out['data'])
                 else:
-                  logger.info("Adding %s to dataset. New size is %i."%(name,datasets_index[name]+1))
-                  f[name].resize(datasets_index[name]+1, axis=0)
-
-                # now we store this x engine's data for sending sd data.
-                if sd_frame is not None and name.startswith("xeng_raw"):
-                  xeng_id = int(name[8:])
-                  sd_frame[xeng_id::meta['n_xengs']] = ig[name]
-                  logger.debug('Received data for Xeng %i @ %.4f' % (xeng_id, time.time()))
-
-                # we got a timestamp.
-                if sd_frame is not None and name.startswith("timestamp"):
-                  xeng_id = int(name[9:])
-                  timestamp = ig['sync_time'] + (ig[name] / ig['scale_factor_timestamp']) #in seconds since unix epoch
-                  localTime = time.time()
-                  print "Decoded timestamp for Xeng", xeng_id, ":", timestamp, " (", time.ctime(timestamp),") @ %.4f" % localTime, " ", time.ctime(localTime), "diff(", localTime-timestamp, ")"
-
-                  # is this timestamp in the past?
-                  if currentTimestamp > timestamp:
-                    errorString = "Timestamp %.2f (%s) is earlier than the current timestamp %.2f (%s). Ignoring..." % (timestamp, time.ctime(timestamp), currentTimestamp, time.ctime(currentTimestamp))
-                    logger.warning(errorString)
-                    continue
+                    sd_out['data'][...] = sd_frame
+            finally:
+                ring.release(n)
+            if sd_out['ig'] is None:
+                # the descriptors only go out with the first frame sent from a new item group
+                ig_sd = spead.ItemGroup()
+                ig_sd.add_item(name=('sd_data'), id=(0x3501), description="Combined raw data from all x engines.", ndarray=(sd_out['data'].dtype,sd_out['data'].shape))
+                ig_sd.add_item(name=('sd_timestamp'), id=0x3502, description='Timestamp of this sd frame in centiseconds since epoch (40 bit limitation).', shape=[], fmt=spead.mkfmt(('u',spead.ADDRSIZE)))
+                t_it = ig_sd.get_item('sd_data')
+                logger.info("Added SD frame with shape %s, dtype %s" % (str(t_it.shape),str(t_it.dtype)))
+                sd_out['ig'] = ig_sd
+            ig_sd = sd_out['ig']
+            logger.info("Sending signal display frame with timestamp %i (%s). %s. @ %.4f" % (timestamp, time.ctime(timestamp), "Unscaled" if not acc_scale else "Scaled by %i" % (scale_factor), time.time()))
+            ig_sd['sd_data'] = sd_out['data']
+            ig_sd['sd_timestamp'] = int(timestamp * 100)
+            tx_sd.send_heap(ig_sd.get_heap())
 
-                  # is this a new timestamp before a complete set?
-                  if (timestamp > currentTimestamp) and sd_slots.any():
-                    errorString = "New timestamp %.2f from Xeng%i before previous set %.2f sent" % (timestamp, xeng_id, currentTimestamp)
-                    logger.warning(errorString)
-                    sd_slots = np.zeros(meta['n_xengs'])
-                    sd_frame = np.zeros((ig['n_chans'],ig['n_bls'],2),dtype=sd_frame.dtype)
-                    currentTimestamp = -1
-                    continue
+        datasets = self._pipeline_start(source, f, compression, queue_depth, sd_queue_depth, sd_handler)
+        heaps = self.queues['receive']
+        writes = self.queues['write']
+        sd = self.queues['sd']
+        meta_missing = list(meta_required)
+        # the ring of SD frames being assembled and sent, which x engines have contributed to the current frame and the latest timestamp for which we've stored data
+        frame = {'ring': None, 'slots': None, 'timestamp': None, 'current_timestamp': -1}
 
-                  # is this new timestamp in the past for this X engine?
-                  if timestamp <= sd_slots[xeng_id]:
-                    errorString = 'Xeng%i already on timestamp %.2f but got %.2f now, THIS SHOULD NOT HAPPEN' % (xeng_id, sd_slots[xeng_id], timestamp)
-                    logger.error(errorString)
-                    raise RuntimeError(errorString)
+        def update_meta(name):
+            meta[name] = ig[name]
+            if name in meta_missing:
+              meta_missing.remove(name)
+              if len(meta_missing) == 0:
+                shape = (meta['n_chans'],meta['n_bls'],2)
+                if frame['ring'] is None or frame['ring'].shape != shape:
+                    frame['ring'] = FrameRing(shape, np.float32)
+                else:
+                    frame['ring'].clear()
+                logger.info("Got all required metadata. Initialised sd frame to shape %s"%(str(shape)))
+                meta_missing.extend(meta_required)
+                ig_sd = spead.ItemGroup()
+                for meta_item in meta_required:
+                  ig_sd.add_item(
+                    name=ig.get_item(meta_item).name,
+                    id=ig.get_item(meta_item).id,
+                    description=ig.get_item(meta_item).description,
+                    #shape=ig.get_item(meta_item).shape,
+                    #fmt=ig.get_item(meta_item).format,
+                    init_val=ig.get_item(meta_item).get_value())
+                sd.put(('meta', ig_sd), drop=False)
+                frame['slots'] = np.zeros(meta['n_xengs'])
 
-                  # update our info on which integrations we have
-                  sd_slots[xeng_id] = timestamp
-                  currentTimestamp = timestamp
+        def reset_frame():
+            # reset the arrays that hold integration data
+            frame['slots'].fill(0)
+            frame['ring'].clear()
+
+        def store_xeng(name):
+            # now we store this x engine's data for sending sd data.
+            if frame['ring'] is None: return
+            xeng_id = int(name[8:])
+            frame['ring'].frame()[xeng_id::meta['n_xengs']] = ig[name]
+            logger.debug('Received data for Xeng %i @ %.4f' % (xeng_id, time.time()))
+
+        def store_timestamp(name):
+            # we got a timestamp.
+            if frame['ring'] is None: return
+            sd_slots = frame['slots']
+            currentTimestamp = frame['current_timestamp']
+            xeng_id = int(name[9:])
+            timestamp = ig['sync_time'] + (ig[name] / ig['scale_factor_timestamp']) #in seconds since unix epoch
+            localTime = time.time()
+            print "Decoded timestamp for Xeng", xeng_id, ":", timestamp, " (", time.ctime(timestamp),") @ %.4f" % localTime, " ", time.ctime(localTime), "diff(", localTime-timestamp, ")"
+
+            # is this timestamp in the past?
+            if currentTimestamp > timestamp:
+              errorString = "Timestamp %.2f (%s) is earlier than the current timestamp %.2f (%s). Ignoring..." % (timestamp, time.ctime(timestamp), currentTimestamp, time.ctime(currentTimestamp))
+              logger.warning(errorString)
+              # only the signal display skips it, the dataset still gets its row from append_dataset
+              return
+
+            # is this a new timestamp before a complete set?
+            if (timestamp > currentTimestamp) and sd_slots.any():
+              errorString = "New timestamp %.2f from Xeng%i before previous set %.2f sent" % (timestamp, xeng_id, currentTimestamp)
+              logger.warning(errorString)
+              reset_frame()
+              frame['current_timestamp'] = -1
+              return
+
+            # is this new timestamp in the past for this X engine?
+            if timestamp <= sd_slots[xeng_id]:
+              errorString = 'Xeng%i already on timestamp %.2f but got %.2f now, THIS SHOULD NOT HAPPEN' % (xeng_id, sd_slots[xeng_id], timestamp)
+              logger.error(errorString)
+              raise RuntimeError(errorString)
+
+            # update our info on which integrations we have
+            sd_slots[xeng_id] = timestamp
+            frame['timestamp'] = timestamp
+            frame['current_timestamp'] = timestamp
+
+            # do we have integration data and timestamps for all the xengines? If so, send the SD frame.
+            if sd_slots.all():
+                scale_factor=(meta['n_accs'] if meta.has_key('n_accs') else 1)
+                ring = frame['ring']
+                # hand the frame to the signal display stage and carry on in the other buffer, which comes back zeroed
+                n = ring.swap()
+                if n is None:
+                    # both buffers busy, count it with the signal display queue's drops
+                    sd.note_drop()
+                if n is None or not sd.put(('frame', ring, n, timestamp, scale_factor)):
+                    logger.warning("Signal display stage is behind, dropped the frame for timestamp %.2f." % timestamp)
+                    if n is not None: ring.release(n)
+                frame['slots'].fill(0)
+                frame['timestamp'] = None
+
+        def append_dataset(name):
+            logger.info("Adding %s to dataset. New size is %i."%(name,dataset_rows[name]+1))
+            writes.put(('append', name, ig[name]))
+            dataset_rows[name] += 1
+
+        def new_item(name):
+            # create the dataset for an item seen for the first time and pick the handlers for its values
+            item = ig.get_item(name)
+            shape = ig[name].shape if item.shape == -1 else item.shape
+            dtype = np.dtype(type(ig[name])) if shape == [] else item.dtype
+            if dtype is None: dtype = ig[name].dtype
+             # if we can't get a dtype from the descriptor, try and get one from the value
+            logger.info("Creating dataset for %s (%s,%s)."%(str(name),str(shape),str(dtype)))
+            writes.put(('create', name, shape, dtype))
+            dataset_rows[name] = 0
+            handlers = []
+            if name in meta_required or name in meta_desired:
+                handlers.append(update_meta)
+            if name.startswith("xeng_raw"):
+                handlers.append(store_xeng)
+            elif name.startswith("timestamp"):
+                handlers.append(store_timestamp)
+            handlers.append(append_dataset)
+            return handlers
+
+        # iterate through SPEAD heaps passed on by the receive stage.
+        dispatcher = HeapDispatcher(ig, new_item)
+        try:
+            while True:
+                heap = heaps.get()
+                if heap is None: break
+                logger.debug("PROCESSING HEAP idx(%i) cnt(%i) @ %.4f" % (idx, heap.heap_cnt, time.time()))
+                dispatcher.dispatch(heap)
+                idx+=1
+        finally:
+            # on the end-of-stream marker, stop() or a failing handler, still write out what was received and close the file
+            logger.info("Got a SPEAD end-of-stream marker, or stopping. Closing File.")
+            self._stop_transport()
+            self._pipeline_stop(datasets)
+            f.flush()
+            f.close()
 
-                # do we have integration data and timestamps for all the xengines? If so, send the SD frame.
-                if timestamp is not None and sd_frame is not None and sd_slots is not None and sd_slots.all():
-                    ig_sd = spead.ItemGroup()
-                    # make sure we have the right dtype for the sd data
-                    ig_sd.add_item(name=('sd_data'), id=(0x3501), description="Combined raw data from all x engines.", ndarray=(sd_frame.dtype,sd_frame.shape))
-                    ig_sd.add_item(name=('sd_timestamp'), id=0x3502, description='Timestamp of this sd frame in centiseconds since epoch (40 bit limitation).', shape=[], fmt=spead.mkfmt(('u',spead.ADDRSIZE)))
-                    t_it = ig_sd.get_item('sd_data')
-                    logger.info("Added SD frame with shape %s, dtype %s" % (str(t_it.shape),str(t_it.dtype)))
-                    scale_factor=(meta['n_accs'] if meta.has_key('n_accs') else 1)
-                    logger.info("Sending signal display frame with timestamp %i (%s). %s. @ %.4f" % (timestamp, time.ctime(timestamp), "Unscaled" if not acc_scale else "Scaled by %i" % (scale_factor), time.time()))
-                    ig_sd['sd_data'] = sd_frame.astype(np.float32) if not acc_scale else (sd_frame / float(scale_factor)).astype(np.float32)
-                    ig_sd['sd_timestamp'] = int(timestamp * 100)
-                    tx_sd.send_heap(ig_sd.get_heap())
-                    # reset the arrays that hold integration data
-                    sd_slots = np.zeros(meta['n_xengs'])
-                    sd_frame = np.zeros((ig['n_chans'],ig['n_bls'],2),dtype=sd_frame.dtype)
-                    timestamp = None
-
-                f[name][datasets_index[name]] = ig[name]
-                datasets_index[name] += 1
-                item._changed = False
-            idx+=1
-
-        logger.info("Got a SPEAD end-of-stream marker. Closing File.")
-        f.flush()
-        f.close()
-        rx.stop()
-        sd_frame = None
-        sd_slots = None
         ig_sd = None
 
@@ -7,17 +7,211 @@ Revs:
 
 """
 
-import corr, numpy, time, construct, logging
+import corr, numpy, time, construct, logging, threading, collections
+
+# polling of snap block status registers starts at the min interval and backs off to the max
+snap_poll_min_interval = 0.001
+snap_poll_max_interval = 0.1
+
+SNAP_POLL_BACKOFF = 'backoff'
+SNAP_POLL_FIXED = 'fixed'
+SNAP_POLL_SPIN = 'spin'
+
+_snap_registers = ['ctrl', 'status', 'bram', 'addr', 'tr_en_cnt', 'val', 'trig_offset']
+
+def _snap_find_registers(fpga, dev_name):
+    """Work out which of a snap block's registers exist from the device list of its FPGA. Devices that can't list their registers are assumed to have a snapshot block with all of them."""
+    rv = {}
+    if hasattr(fpga, 'devices'):
+        devices = fpga.devices()
+        for reg in _snap_registers:
+            rv[reg] = (dev_name + '_' + reg) if ((dev_name + '_' + reg) in devices) else None
+        if rv['ctrl'] == None:
+            raise RuntimeError('There is no snap block called %s on %s.' % (dev_name, fpga.host))
+    else:
+        for reg in _snap_registers:
+            rv[reg] = dev_name + '_' + reg
+        rv['addr'] = None
+    # old snap blocks have an addr register reporting words instead of a status register reporting bytes
+    rv['legacy'] = (rv['status'] == None)
+    if rv['legacy'] and (rv['addr'] == None):
+        raise RuntimeError('Snap block %s on %s has neither a status nor an addr register.' % (dev_name, getattr(fpga, 'host', fpga)))
+    return rv
+
+def _snap_arm(fpga, regs, ctrl, offset):
+    if offset >= 0:
+        if regs['trig_offset'] == None:
+            raise RuntimeError('Snap block %s does not support offset triggering.' % regs['ctrl'][:-5])
+        fpga.write_int(regs['trig_offset'], offset)
+    fpga.write_int(regs['ctrl'], ctrl)
+    fpga.write_int(regs['ctrl'], ctrl + 1)
+
+def _snap_status(fpga, regs):
+    return fpga.read_uint(regs['status'] or regs['addr'])
+
+def _snap_download(fpga, regs, status, length, brams, read_tr_en_cnt, read_val):
+    """Re-read the status of a finished snap block to check that it has stopped, then fetch its data.
+    Returns (status now, valids since the trigger or zero, the _val register or None, data). data is None if the block hadn't stopped."""
+    names = [regs['status'] or regs['addr']]
+    for wanted, reg in [(read_tr_en_cnt, 'tr_en_cnt'), (read_val, 'val')]:
+        if wanted:
+            if regs[reg] == None:
+                raise RuntimeError('Snap block %s has no %s register.' % (regs['ctrl'][:-5], reg))
+            names.append(regs[reg])
+    if isinstance(fpga, corr.katcp_wrapper.FpgaClient):
+        values = fpga.read_uint_many(names)
+    else:
+        values = [fpga.read_uint(name) for name in names]
+    now_status = values.pop(0)
+    tr_en_cnt = values.pop(0) if read_tr_en_cnt else 0
+    val = values.pop(0) if read_val else None
+    if (now_status != status) or (length == 0) or (now_status & 0x80000000):
+        return now_status, tr_en_cnt, val, None
+    if brams == None:
+        return now_status, tr_en_cnt, val, fpga.read(regs['bram'], length)
+    return now_status, tr_en_cnt, val, dict([(bram, fpga.read(regs['ctrl'][:-5] + '_' + bram, length)) for bram in brams])
+
+class Snapshot:
+    """A snap block, or the same snap block on a number of FPGAs, captured together.
+    The block's registers are worked out once, from each FPGA's device list. Both snapshot blocks (with _status and _bram registers, lengths in bytes)
+    and the older snap blocks (with an _addr register counting words, and named brams) are supported.
+    A capture is arm, poll and download, which can also be called separately; all of them act on all the FPGAs at once.
+    """
+    def __init__(self, fpgas, dev_names, bitstruct = None, brams = None, word_mult = 1, poll_policy = SNAP_POLL_BACKOFF, poll_interval = None, poll_max_interval = None):
+        """
+        @param fpgas: an FpgaClient, or a list of them.
+        @param dev_names: the name of the snap block, or a list of names, one per fpga.
+        @param bitstruct: optional construct.BitStruct describing the data, used by decode.
+        @param brams: for old snap blocks, the names of the brams to read, eg ['bram_msb', 'bram_lsb']. The default is the single _bram of a snapshot block.
+        @param word_mult: for old snap blocks, the width of the data in 32-bit words.
+        @param poll_policy: how to wait for the capture to finish: SNAP_POLL_BACKOFF, from poll_interval doubling up to poll_max_interval, SNAP_POLL_FIXED, every poll_interval, or SNAP_POLL_SPIN, as fast as the boards reply.
+        """
+        if not isinstance(fpgas, list):
+            fpgas = [fpgas]
+        if isinstance(dev_names, str):
+            dev_names = [dev_names for f in fpgas]
+        if len(dev_names) != len(fpgas):
+            raise RuntimeError('Need one snap block name per FPGA.')
+        self.fpgas = fpgas
+        self.dev_names = dev_names
+        self.brams = brams
+        self.word_mult = word_mult
+        self.poll_policy = poll_policy
+        self.poll_interval = snap_poll_min_interval if poll_interval == None else poll_interval
+        self.poll_max_interval = snap_poll_max_interval if poll_max_interval == None else poll_max_interval
+        self.registers = [_snap_find_registers(fpga, dev_names[fn]) for fn, fpga in enumerate(fpgas)]
+        self.legacy = self.registers[0]['legacy']
+        for regs in self.registers:
+            if regs['legacy'] != self.legacy:
+                raise RuntimeError('Cannot capture old snap blocks and snapshot blocks together.')
+        if (brams != None) and not self.legacy:
+            raise RuntimeError('Snapshot blocks have a single bram, brams can only be given for old snap blocks.')
+        if self.legacy and (brams == None):
+            raise RuntimeError('Old snap blocks need the names of their brams.')
+        self.compiled = None
+        if bitstruct != None:
+            self.compiled = corr.bitfield.compile_bitstruct(bitstruct)
+        # the width of a word of data, in bits
+        if self.compiled != None:
+            self.width = self.compiled.width
+        else:
+            self.width = 32 * word_mult
+
+    def _run(self, job_function, job_args):
+        return corr.threaded.run_jobs(self.fpgas, job_function, job_args)
+
+    def length_from_status(self, status):
+        """The number of bytes captured, from the status (or addr) register."""
+        if self.legacy:
+            return ((status & 0x7fffffff) + 1) * 4 * self.word_mult
+        return status & 0x7fffffff
+
+    def arm(self, man_trig = False, man_valid = False, offset = -1, circular_capture = False):
+        """Arm the snap block on all the FPGAs."""
+        if snapshot_cache != None:
+            # the blocks are about to capture something new, so what was cached from them no longer matches the _val registers
+            snapshot_cache.forget(self.fpgas, self.dev_names)
+        ctrl = (man_trig<<1) + (man_valid<<2) + (circular_capture<<3)
+        self._run(_snap_arm, [(regs, ctrl, offset) for regs in self.registers])
+
+    def poll(self, wait_period = -1):
+        """Wait for the capture to finish on all the FPGAs, reading the status of all the blocks still running at once each round.
+        Returns a list of the last status read from each block, and a list of the indices of the blocks that hadn't finished when wait_period ran out."""
+        status = [0 for f in self.fpgas]
+        pending = range(len(self.fpgas))
+        interval = self.poll_interval
+        start_time = time.time()
+        while True:
+            values = corr.threaded.run_jobs([self.fpgas[fn] for fn in pending], _snap_status, [(self.registers[fn],) for fn in pending])
+            still_running = []
+            for n, fn in enumerate(pending):
+                status[fn] = values[n]
+                if values[n] & 0x80000000:
+                    still_running.append(fn)
+            pending = still_running
+            if len(pending) == 0:
+                break
+            elapsed = time.time() - start_time
+            if (wait_period >= 0) and (elapsed >= wait_period):
+                break
+            if self.poll_policy == SNAP_POLL_SPIN:
+                continue
+            if wait_period >= 0:
+                interval = min(interval, wait_period - elapsed)
+            time.sleep(interval)
+            if self.poll_policy == SNAP_POLL_BACKOFF:
+                interval = min(interval * 2, self.poll_max_interval)
+            else:
+                interval = self.poll_interval
+        return status, pending
+
+    def download(self, status, circular_capture = False, get_extra_val = False):
+        """Fetch the data from all the FPGAs, given the status each block reported when it finished.
+        Returns a list of (status now, valids since the trigger or zero, the _val register or None, data) per FPGA. data is None if that block hadn't really finished."""
+        return self._run(_snap_download, [(self.registers[fn], status[fn], self.length_from_status(status[fn]), self.brams, circular_capture, get_extra_val) for fn in range(len(self.fpgas))])
+
+    def capture(self, man_trig = False, man_valid = False, wait_period = -1, offset = -1, circular_capture = False, arm = True, get_extra_val = False):
+        """Arm, wait for and download a capture from all the FPGAs. Returns a dictionary as for snapshots_get, plus vals if get_extra_val is set."""
+        if self.legacy:
+            raise RuntimeError('Use FpgaClient.get_snap for old snap blocks.')
+        if arm:
+            self.arm(man_trig = man_trig, man_valid = man_valid, offset = offset, circular_capture = circular_capture)
+        status, pending = self.poll(wait_period)
+        bram_dmp = dict()
+        bram_dmp['lengths'] = [self.length_from_status(i) for i in status]
+        bram_dmp['offsets'] = [0 for fn in self.fpgas]
+        if len(pending) > 0:
+            fn = pending[0]
+            raise RuntimeError("A snap block logic error occurred on capture #%i. It reported capture complete but the address is either still changing, or it returned 0 bytes captured after the allotted %2.2f seconds. Addr at stop time: %i. Now: Still running :%s, addr: %i."%(fn,wait_period,bram_dmp['lengths'][fn],'yes',bram_dmp['lengths'][fn]))
+        downloads = self.download(status, circular_capture = circular_capture, get_extra_val = get_extra_val)
+        bram_dmp['data'] = []
+        if get_extra_val:
+            bram_dmp['vals'] = []
+        for fn, (now_status, tr_en_cnt, val, data) in enumerate(downloads):
+            if data == None:
+                #if address is still changing, then the snap block didn't finish capturing. we return empty.
+                raise RuntimeError("A snap block logic error occurred on capture #%i. It reported capture complete but the address is either still changing, or it returned 0 bytes captured after the allotted %2.2f seconds. Addr at stop time: %i. Now: Still running :%s, addr: %i."%(fn,wait_period,bram_dmp['lengths'][fn],{True:'yes',False:'no'}[bool(now_status&0x80000000)],now_status&0x7fffffff))
+            if circular_capture:
+                bram_dmp['offsets'][fn] = tr_en_cnt - bram_dmp['lengths'][fn]
+            bram_dmp['data'].append(data)
+            if get_extra_val:
+                bram_dmp['vals'].append(val)
+        bram_dmp['offsets'] = numpy.add(bram_dmp['offsets'], offset)
+        for fn in range(len(self.fpgas)):
+            if (bram_dmp['offsets'][fn] < 0):
+                bram_dmp['offsets'][fn] = 0
+        return bram_dmp
+
+    def decode(self, bram_dmp):
+        """Decode captured data with the snap block's BitStruct. Returns a list of dictionaries of numpy arrays, one per FPGA."""
+        if self.compiled == None:
+            raise RuntimeError('No BitStruct was given for snap block %s.' % self.dev_names[0])
+        return [self.compiled.decode(d) for d in bram_dmp['data']]
 
 def snapshots_arm(fpgas, dev_names, man_trig, man_valid, offset, circular_capture):
-    if offset >=0:
-        for fn, fpga in enumerate(fpgas):
-            fpga.write_int(dev_names[fn] + '_trig_offset', offset)
-    for fn, fpga in enumerate(fpgas):
-        fpga.write_int(dev_names[fn]+'_ctrl', (0 + (man_trig<<1) + (man_valid<<2) + (circular_capture<<3)))
-        fpga.write_int(dev_names[fn]+'_ctrl', (1 + (man_trig<<1) + (man_valid<<2) + (circular_capture<<3)))
-
-def snapshots_get(fpgas, dev_names, man_trig=False, man_valid=False, wait_period=-1, offset=-1, circular_capture=False, arm=True):
+    Snapshot(fpgas, dev_names).arm(man_trig = man_trig, man_valid = man_valid, offset = offset, circular_capture = circular_capture)
+
+def snapshots_get(fpgas, dev_names, man_trig=False, man_valid=False, wait_period=-1, offset=-1, circular_capture=False, arm=True, use_cache=False, get_extra_val=False):
     """Fetches data from multiple snapshot devices. fpgas and dev_names are lists of katcp_wrapper.FpgaClient,and 'snapshot_device_name', respectively.
         This function triggers and retrieves data from the snap block devices. The actual captured length and starting offset is returned with the dictionary of data for each FPGA (useful if you've done a circular capture and can't calculate this yourself).\n
         \tdev_names: list of strings, names of the snap block corresponding to FPGA list. Can optionally be 1-D, in which case name is used for all FPGAs.\n
@@ -29,50 +223,335 @@ def snapshots_get(fpgas, dev_names, man_trig=False, man_valid=False, wait_period
         \t\tlengths: list of integers matching number of valids captured off each fpga.\n
         \t\toffset: optional (depending on snap block version) list of number of valids elapsed since last trigger on each fpga.
         \t\t{brams}: list of data from each fpga for corresponding bram.\n
+        	get_extra_val: also return the _val register of each block, read with the data, as a list under vals.
+
+        If snapshot_cache_enable has been called, use_cache returns recent captures with the same parameters from the cache.
+        Only set it where nothing that changes what the block captures, eg a select or trigger level register, is written before the capture.
         """
     # 2011-06-24 JRM first write.
     if isinstance(dev_names, str):
         dev_names=[dev_names for f in fpgas]
-    if arm:
-        snapshots_arm(fpgas=fpgas, dev_names=dev_names, man_trig=man_trig, man_valid=man_valid, offset=offset, circular_capture=circular_capture)
-    # wait
-    done=False
-    start_time=time.time()
-    while not done and ((time.time()-start_time)<wait_period or (wait_period < 0)):
-        addr      = [fpga.read_uint(dev_names[fn]+'_status') for fn,fpga in enumerate(fpgas)]
-        done_list = [not bool(i & 0x80000000) for i in addr]
-        if (done_list == [True for i in fpgas]): done=True
-
-    bram_dmp=dict()
-    bram_dmp['data']=[]
-    bram_dmp['lengths']=[i&0x7fffffff for i in addr]
-    bram_dmp['offsets']=[0 for fn in fpgas]
-    for fn,fpga in enumerate(fpgas):
-        now_status=bool(fpga.read_uint(dev_names[fn]+'_status')&0x80000000)
-        now_addr=fpga.read_uint(dev_names[fn]+'_status')&0x7fffffff
-        if (bram_dmp['lengths'][fn] != now_addr) or (bram_dmp['lengths'][fn]==0) or (now_status==True):
-            #if address is still changing, then the snap block didn't finish capturing. we return empty.
-            raise RuntimeError("A snap block logic error occurred on capture #%i. It reported capture complete but the address is either still changing, or it returned 0 bytes captured after the allotted %2.2f seconds. Addr at stop time: %i. Now: Still running :%s, addr: %i."%(fn,wait_period,bram_dmp['lengths'][fn],{True:'yes',False:'no'}[now_status],now_addr))
-            bram_dmp['lengths'][fn]=0
-            bram_dmp['offsets'][fn]=0
-
-        if circular_capture:
-            bram_dmp['offsets'][fn]=fpga.read_uint(dev_names[fn]+'_tr_en_cnt') - bram_dmp['lengths'][fn]
-        else:
-            bram_dmp['offsets'][fn]=0
+    if arm and use_cache and (snapshot_cache != None):
+        return snapshot_cache.snapshots_get(fpgas, dev_names, man_trig=man_trig, man_valid=man_valid, wait_period=wait_period, offset=offset, circular_capture=circular_capture, get_extra_val=get_extra_val)
+    raw = Snapshot(fpgas, dev_names).capture(man_trig=man_trig, man_valid=man_valid, wait_period=wait_period, offset=offset, circular_capture=circular_capture, arm=arm, get_extra_val=get_extra_val)
+    if snapshot_recorder != None:
+        snapshot_recorder.record(fpgas, dev_names, raw)
+    return raw
 
-        if bram_dmp['lengths'][fn] == 0:
-            bram_dmp['data'].append([])
-        else:
-            bram_dmp['data'].append(fpga.read(dev_names[fn]+'_bram',bram_dmp['lengths'][fn]))
+class SnapshotCache:
+    """A time-bounded, least-recently-used cache of snap block captures, keyed on (host, dev_name, man_trig, man_valid, offset, circular_capture, get_extra_val).
+    Callers asking for a capture that is already under way wait for it and share its result, instead of re-arming the snap block underneath it.
+    The key says nothing about the registers that choose what a block captures, so it's only used by callers that ask for it, and arming a block
+    any other way drops what was cached from it.
+    """
+    def __init__(self, max_age = 1.0, max_entries = 64):
+        """
+        @param max_age: seconds for which a capture is reused.
+        @param max_entries: the number of captures kept, least recently used are dropped first.
+        """
+        self.max_age = max_age
+        self.max_entries = max_entries
+        self.hits = 0
+        self.misses = 0
+        self._entries = collections.OrderedDict()
+        self._lock = threading.Lock()
+
+    def _lookup(self, keys):
+        """Find an entry for each key, making new ones for keys that aren't cached or have expired. Returns the entries and the indices of those this caller must capture."""
+        entries = []
+        claimed = []
+        self._lock.acquire()
+        now = time.time()
+        for n, key in enumerate(keys):
+            entry = self._entries.pop(key, None)
+            if (entry != None) and entry['event'].isSet() and (now - entry['time'] > self.max_age):
+                entry = None
+            if entry == None:
+                entry = {'event': threading.Event(), 'time': now, 'result': None, 'error': None}
+                claimed.append(n)
+                self.misses += 1
+            else:
+                self.hits += 1
+            # most recently used at the end
+            self._entries[key] = entry
+            entries.append(entry)
+        while len(self._entries) > self.max_entries:
+            self._entries.popitem(last = False)
+        self._lock.release()
+        return entries, claimed
+
+    def _forget(self, key, entry):
+        self._lock.acquire()
+        if self._entries.get(key) is entry:
+            self._entries.pop(key)
+        self._lock.release()
+
+    def forget(self, fpgas, dev_names):
+        """Drop the finished captures from the given snap blocks. Captures still under way are left to finish."""
+        blocks = set([(fpga.host, dev_names[fn]) for fn, fpga in enumerate(fpgas)])
+        self._lock.acquire()
+        for key in [key for key, entry in self._entries.iteritems() if (key[0:2] in blocks) and entry['event'].isSet()]:
+            self._entries.pop(key)
+        self._lock.release()
+
+    def clear(self):
+        """Drop all the cached captures."""
+        self._lock.acquire()
+        self._entries.clear()
+        self._lock.release()
+
+    def snapshots_get(self, fpgas, dev_names, man_trig=False, man_valid=False, wait_period=-1, offset=-1, circular_capture=False, get_extra_val=False):
+        """As for snap.snapshots_get, capturing only from the snap blocks that aren't cached or being captured by someone else."""
+        keys = [(fpga.host, dev_names[fn], bool(man_trig), bool(man_valid), offset, bool(circular_capture), bool(get_extra_val)) for fn, fpga in enumerate(fpgas)]
+        entries, claimed = self._lookup(keys)
+        if len(claimed) > 0:
+            try:
+                raw = snapshots_get([fpgas[n] for n in claimed], [dev_names[n] for n in claimed], man_trig=man_trig, man_valid=man_valid, wait_period=wait_period, offset=offset, circular_capture=circular_capture, use_cache=False, get_extra_val=get_extra_val)
+            except Exception as exc:
+                for n in claimed:
+                    self._forget(keys[n], entries[n])
+                    entries[n]['error'] = RuntimeError('Capture from %s on %s failed: %s' % (dev_names[n], fpgas[n].host, exc))
+                    entries[n]['event'].set()
+                raise
+            now = time.time()
+            for i, n in enumerate(claimed):
+                entries[n]['result'] = (raw['data'][i], raw['lengths'][i], raw['offsets'][i], raw['vals'][i] if get_extra_val else None)
+                entries[n]['time'] = now
+                entries[n]['event'].set()
+        bram_dmp = {'data': [], 'lengths': [], 'offsets': []}
+        if get_extra_val:
+            bram_dmp['vals'] = []
+        for entry in entries:
+            entry['event'].wait()
+            if entry['error'] != None:
+                raise entry['error']
+            data, length, snap_offset, val = entry['result']
+            bram_dmp['data'].append(data)
+            bram_dmp['lengths'].append(length)
+            bram_dmp['offsets'].append(snap_offset)
+            if get_extra_val:
+                bram_dmp['vals'].append(val)
+        bram_dmp['offsets'] = numpy.array(bram_dmp['offsets'])
+        return bram_dmp
+
+snapshot_cache = None
+
+def snapshot_cache_enable(max_age = 1.0, max_entries = 64):
+    """Have snapshots_get calls that set use_cache reuse captures made in the last max_age seconds, and share captures that are in progress. See SnapshotCache."""
+    global snapshot_cache
+    snapshot_cache = SnapshotCache(max_age = max_age, max_entries = max_entries)
+    return snapshot_cache
+
+def snapshot_cache_disable():
+    """Stop caching snapshot captures."""
+    global snapshot_cache
+    snapshot_cache = None
+
+class SnapshotRecorder:
+    """Records snapshot captures, with the details of where and when they were made, to a compressed HDF5 file so that they can be decoded later without the hardware. See SnapshotArchive.
+    Each capture is a group under /captures holding one chunked, compressed dataset of raw bytes per snap block. The group's attributes hold the capture time and the hosts, device names, lengths and offsets of its snap blocks,
+    and each dataset's attributes the revision control information of its FPGA from FpgaClient.get_rcs, where the design has an rcs block.
+    """
+    def __init__(self, filename, compression = 'gzip', chunk_size = 64*1024):
+        """
+        @param filename: the HDF5 file to record to, added to if it exists
+        @param compression: the h5py compression filter for the data, None to store it uncompressed
+        @param chunk_size: the maximum chunk size of the data, in bytes
+        """
+        import h5py
+        self.filename = filename
+        self.compression = compression
+        self.chunk_size = chunk_size
+        self._file = h5py.File(filename, mode = 'a')
+        self._captures = self._file.require_group('captures')
+        self._rcs = {}
+        self._lock = threading.Lock()
+
+    def _get_rcs(self, fpga):
+        # the rcs info only changes when the FPGA is reprogrammed, so it's fetched once per host. Designs without an rcs block record nothing.
+        if not self._rcs.has_key(fpga.host):
+            try:
+                self._rcs[fpga.host] = fpga.get_rcs()
+            except Exception:
+                self._rcs[fpga.host] = {}
+        return self._rcs[fpga.host]
+
+    def record(self, fpgas, dev_names, raw, timestamp = None):
+        """Store a capture.
+        @param fpgas: the FpgaClients the capture was made from
+        @param dev_names: the snap block name, or a list of them, one per fpga
+        @param raw: the snapshots_get result
+        @param timestamp: the time of the capture, default now
+        @return the name of the capture's group
+        """
+        if timestamp == None:
+            timestamp = time.time()
+        if isinstance(dev_names, str):
+            dev_names = [dev_names for f in fpgas]
+        rcs = [self._get_rcs(fpga) for fpga in fpgas]
+        self._lock.acquire()
+        try:
+            name = '%08i' % len(self._captures)
+            group = self._captures.create_group(name)
+            group.attrs['timestamp'] = timestamp
+            group.attrs['hosts'] = [str(fpga.host) for fpga in fpgas]
+            group.attrs['dev_names'] = dev_names
+            group.attrs['lengths'] = numpy.array(raw['lengths'], dtype = numpy.int64)
+            group.attrs['offsets'] = numpy.array(raw['offsets'], dtype = numpy.int64)
+            for fn, d in enumerate(raw['data']):
+                if isinstance(d, str):
+                    d = numpy.frombuffer(d, dtype = numpy.uint8)
+                else:
+                    d = numpy.ascontiguousarray(d).view(numpy.uint8)
+                chunks = None
+                if len(d) > 0:
+                    chunks = (min(len(d), self.chunk_size),)
+                dset = group.create_dataset('data%i' % fn, data = d, chunks = chunks, compression = self.compression if len(d) > 0 else None)
+                for key, value in rcs[fn].iteritems():
+                    dset.attrs['rcs_' + key] = value
+            self._file.flush()
+        finally:
+            self._lock.release()
+        return name
+
+    def close(self):
+        self._file.close()
+
+class SnapshotArchive:
+    """Read back the captures stored by a SnapshotRecorder. Each capture is loaded as a dictionary like that of snapshots_get, so it can be given to snapshot_decode, snapshot_packets and the like.
+    """
+    def __init__(self, filename):
+        import h5py
+        self.filename = filename
+        self._file = h5py.File(filename, mode = 'r')
+        self._captures = self._file['captures']
+
+    def __len__(self):
+        return len(self._captures)
+
+    def names(self, host = None, dev_name = None):
+        """The names of the stored captures, in the order they were made, optionally only those from a given host or snap block."""
+        rv = []
+        for name in sorted(self._captures.keys()):
+            attrs = self._captures[name].attrs
+            if (host != None) and (host not in list(attrs['hosts'])):
+                continue
+            if (dev_name != None) and (dev_name not in list(attrs['dev_names'])):
+                continue
+            rv.append(str(name))
+        return rv
+
+    def load(self, name):
+        """Load a capture.
+        @return dictionary with keywords lengths, offsets and data as for snapshots_get, and:
+
+            	timestamp: the time the capture was made.
+
+            	hosts, dev_names: lists of the host and snap block of each capture.
+
+            	rcs: list of the revision control information of each FPGA, empty where there was none.
+        """
+        group = self._captures[name]
+        rv = {}
+        rv['timestamp'] = float(group.attrs['timestamp'])
+        rv['hosts'] = [str(h) for h in group.attrs['hosts']]
+        rv['dev_names'] = [str(d) for d in group.attrs['dev_names']]
+        rv['lengths'] = [int(l) for l in group.attrs['lengths']]
+        rv['offsets'] = numpy.array(group.attrs['offsets'])
+        rv['data'] = []
+        rv['rcs'] = []
+        for fn in range(len(rv['hosts'])):
+            dset = group['data%i' % fn]
+            rv['data'].append(dset[...].tostring())
+            rv['rcs'].append(dict([(str(key[4:]), dset.attrs[key]) for key in dset.attrs.keys() if key.startswith('rcs_')]))
+        return rv
 
-    bram_dmp['offsets']=numpy.add(bram_dmp['offsets'],offset)
+    def __iter__(self):
+        for name in self.names():
+            yield self.load(name)
 
-    for fn,fpga in enumerate(fpgas):
-        if (bram_dmp['offsets'][fn]<0):
-            bram_dmp['offsets'][fn]=0
+    def close(self):
+        self._file.close()
 
-    return bram_dmp
+snapshot_recorder = None
+
+def snapshot_record_enable(filename, compression = 'gzip'):
+    """Have snapshots_get record every capture it makes from the hardware to an HDF5 file. See SnapshotRecorder."""
+    global snapshot_recorder
+    snapshot_record_disable()
+    snapshot_recorder = SnapshotRecorder(filename, compression = compression)
+    return snapshot_recorder
+
+def snapshot_record_disable():
+    """Stop recording snapshot captures."""
+    global snapshot_recorder
+    if snapshot_recorder != None:
+        snapshot_recorder.close()
+    snapshot_recorder = None
+
+def snapshots_stream(fpgas, dev_names, length = -1, man_trig = False, man_valid = False, wait_period = 2, offset = 0, circular_capture = False, dtype = numpy.uint8, out = None, interval = 0):
+    """Capture more data than a snap block can hold by re-arming it at successive trigger offsets. This is a generator, so the data can be consumed a window at a time.
+        \tfpgas, dev_names, man_trig, man_valid, wait_period and circular_capture are as for snapshots_get.\n
+        \tlength: integer, number of bytes to capture from each snap block. Negative to keep capturing until the caller stops asking for more.\n
+        \toffset: integer, the trigger offset of the first window. Each following window starts where the last one ended.\n
+        \tdtype: numpy type of the data yielded, big-endian types should be given explicitly (eg '>u4').\n
+        \tout: optional preallocated arrays, one per fpga (a list, or a 2-D array), long enough for length bytes. Each window is copied into place and the data yielded are views into out.\n
+        \tinterval: seconds to wait between captures.\n
+        \tYIELDS: dictionary with keywords: \n
+        \t\toffset: the trigger offset, in bytes, of this window.\n
+        \t\tlengths: list of the number of bytes in this window for each fpga.\n
+        \t\toffsets: as for snapshots_get.\n
+        \t\tdata: list of numpy arrays of type dtype, one per fpga.\n
+    """
+    dtype = numpy.dtype(dtype)
+    if (length >= 0) and (length % dtype.itemsize != 0):
+        raise RuntimeError('Capture length of %i bytes is not a whole number of %s items.' % (length, dtype))
+    if out is not None:
+        if length < 0:
+            raise RuntimeError('Need a capture length to fill an output buffer.')
+        for fn in range(len(fpgas)):
+            if out[fn].nbytes < length:
+                raise RuntimeError('Output buffer %i holds %i bytes, need %i.' % (fn, out[fn].nbytes, length))
+    done = 0
+    window_offset = offset
+    while (length < 0) or (done < length):
+        if done > 0 and interval > 0:
+            time.sleep(interval)
+        raw = snapshots_get(fpgas, dev_names, man_trig = man_trig, man_valid = man_valid, wait_period = wait_period, offset = window_offset, circular_capture = circular_capture)
+        for fn in range(len(fpgas)):
+            if raw['lengths'][fn] != raw['lengths'][0]:
+                raise RuntimeError('Not all snap blocks captured the same amount of data: %s.' % raw['lengths'])
+        n = raw['lengths'][0]
+        if length >= 0:
+            n = min(n, length - done)
+        # only whole items of dtype are returned
+        n -= n % dtype.itemsize
+        chunk = {'offset': window_offset, 'lengths': [n for f in fpgas], 'offsets': raw['offsets'], 'data': []}
+        for fn in range(len(fpgas)):
+            d = numpy.frombuffer(raw['data'][fn], dtype = dtype, count = n / dtype.itemsize)
+            if out is not None:
+                dest = out[fn].view(numpy.uint8)[done:done + n].view(dtype)
+                dest[:] = d
+                d = dest
+            chunk['data'].append(d)
+        done += n
+        window_offset += raw['lengths'][0]
+        yield chunk
+
+def snapshots_get_long(fpgas, dev_names, length, dtype = numpy.uint8, **kwargs):
+    """Capture length bytes from each of the snap blocks, re-arming them at successive offsets as needed, into one preallocated array per fpga.
+    Takes the same keyword arguments as snapshots_stream. Returns a dictionary with keywords:
+    data: an (n_fpgas, length / itemsize) array of type dtype, lengths: list of bytes captured and offsets: the offsets of the first window.
+    """
+    dtype = numpy.dtype(dtype)
+    out = numpy.empty((len(fpgas), length / dtype.itemsize), dtype = dtype)
+    rv = {'data': out, 'lengths': [0 for f in fpgas], 'offsets': None}
+    for chunk in snapshots_stream(fpgas, dev_names, length = out.shape[1] * dtype.itemsize, dtype = dtype, out = out, **kwargs):
+        if rv['offsets'] is None:
+            rv['offsets'] = chunk['offsets']
+        for fn in range(len(fpgas)):
+            rv['lengths'][fn] += chunk['lengths'][fn]
+    return rv
 
 #def unpack_snapshot(data, bitmap, word_width=32):
 #    """Unpacks data from a snap block. data is the raw binary (string). bitmap is a dictionary of form {yourvariablename: (bitfield_length,bitfield_start_pos,dtype)}. dtype should be a numpy type (eg numpy.int8, numpy.int16, numpy.uint32 etc). Bitfields with length of 1 are automatically unpacked as binary values (True/False). Word width should reflect your snap hardware block's databus width."""
@@ -92,8 +571,38 @@ def snapshots_get(fpgas, dev_names, man_trig=False, man_valid=False, wait_period
 #   INCOMPLETE. use construct instead.
 
 
-def get_adc_snapshots(correlator, ant_strs = [], trig_level = -1, sync_to_pps = True):
-    """Fetches multiple ADC snapshots from hardware. Set trig_level to negative value to disable triggered captures. Timestamps only valid if system is correctly sync'd!"""
+def _write_int(fpga, dev_name, value):
+    fpga.write_int(dev_name, value)
+
+def _read_uints(fpga, dev_names):
+    if isinstance(fpga, corr.katcp_wrapper.FpgaClient):
+        return fpga.read_uint_many(dev_names)
+    return [fpga.read_uint(dev_name) for dev_name in dev_names]
+
+def read_uint_group(fpgas, dev_names):
+    """Read a register from each of a list of (fpga, register) pairs, with one batched read per board, all boards at once. Returns the values in list order."""
+    boards = []
+    board_regs = {}
+    for n, fpga in enumerate(fpgas):
+        if not board_regs.has_key(id(fpga)):
+            boards.append(fpga)
+            board_regs[id(fpga)] = []
+        board_regs[id(fpga)].append(n)
+    values = corr.threaded.run_jobs(boards, _read_uints, [([dev_names[n] for n in board_regs[id(fpga)]],) for fpga in boards])
+    rv = [0 for f in fpgas]
+    for b, fpga in enumerate(boards):
+        for n, v in zip(board_regs[id(fpga)], values[b]):
+            rv[n] = v
+    return rv
+
+def get_adc_snapshot_group(correlator, ant_strs = [], trig_level = -1, sync_to_pps = True, use_cache = False):
+    """Captures ADC snapshots from a group of inputs at once. Set trig_level to negative value to disable triggered captures. Timestamps only valid if system is correctly sync'd!
+    use_cache lets untriggered captures come from the snapshot cache, see snapshot_cache_enable.
+    Returns a dictionary with keywords:
+    ant_strs: the inputs, in the order of the rows of data.
+    data: an (n_inputs, n_samples) int8 array. If the inputs captured different amounts of data, the shortest length is used.
+    timestamps, offsets, lengths: numpy arrays with one entry per input.
+    """
     if correlator.config['adc_n_bits'] !=8:
         raise RuntimeError('This function is hardcoded to work with 8 bit ADCs. According to your config file, yours is %i bits.' % correlator.config['adc_n_bits'])
 
@@ -104,82 +613,113 @@ def get_adc_snapshots(correlator, ant_strs = [], trig_level = -1, sync_to_pps =
         fpgas.append(correlator.ffpgas[ffpga_n])
         dev_names.append('adc_snap%i' % feng_input)
 
-    #if correlator.is_narrowband():
-    #    return corr.corr_nb.get_adc_snapshot(c = correlator, ant_names = ant_strs, trig_level = trig_level, sync_to_pps = sync_to_pps)
-
-    init_mcnt = correlator.mcnt_current_get(ant_str = ant_strs[0])
-    mcnt_lsbs = init_mcnt & 0xffffffff
-
     if trig_level >= 0:
-        [fpga.write_int('trig_level', trig_level) for fpga in fpgas]
+        init_mcnt = correlator.mcnt_current_get(ant_str = ant_strs[0])
+        corr.threaded.run_jobs(fpgas, _write_int, [('trig_level', trig_level) for fpga in fpgas])
         raw = snapshots_get(fpgas, dev_names, wait_period = -1, circular_capture = True, man_trig = (not sync_to_pps))
-        ready = ((int(time.time() * 10) % 10) == 5)
-        while not ready:
-            time.sleep(0.05)
-            ready = ((int(time.time() * 10) % 10) == 5)
+        # wait for the next half-second boundary
+        time.sleep((0.5 - (time.time() % 1.0)) % 1.0)
+    elif use_cache:
+        # the capture may have been made before this call, so its _val comes with it and the mcnt is read afterwards
+        raw = snapshots_get(fpgas, dev_names, wait_period = 2, circular_capture = False, man_trig = (not sync_to_pps), use_cache = True, get_extra_val = True)
+        now_mcnt = correlator.mcnt_current_get(ant_str = ant_strs[0])
+        ts = numpy.array(raw['vals'], dtype = numpy.uint64)
+        mcnts = (now_mcnt & 0xffffffff00000000) + ts
+        # the 32 bit number must've overflowed once since the capture if it's more than it is now
+        mcnts[ts > (now_mcnt & 0xffffffff)] -= 0x100000000
     else:
+        init_mcnt = correlator.mcnt_current_get(ant_str = ant_strs[0])
         raw = snapshots_get(fpgas, dev_names, wait_period = 2, circular_capture = False, man_trig = (not sync_to_pps))
 
+    if (trig_level >= 0) or not use_cache:
+        ts = numpy.array(read_uint_group(fpgas, [dev_name + '_val' for dev_name in dev_names]), dtype = numpy.uint64)
+        mcnts = (init_mcnt & 0xffffffff00000000) + ts
+        # the 32 bit number must've overflowed once if it's less than it was before the capture
+        mcnts[ts < (init_mcnt & 0xffffffff)] += 0x100000000
+
+    n_samples = min(raw['lengths'])
+    rv = {'ant_strs': list(ant_strs), 'data': numpy.empty((len(ant_strs), n_samples), dtype = numpy.int8)}
+    for ant_n in range(len(ant_strs)):
+        rv['data'][ant_n] = numpy.frombuffer(raw['data'][ant_n], dtype = numpy.int8, count = n_samples)
+    rv['timestamps'] = numpy.array([correlator.time_from_mcnt(m) for m in mcnts])
+    rv['offsets'] = numpy.array(raw['offsets'])
+    rv['lengths'] = numpy.array(raw['lengths'])
+    return rv
+
+def get_adc_snapshots(correlator, ant_strs = [], trig_level = -1, sync_to_pps = True, use_cache = False):
+    """Fetches multiple ADC snapshots from hardware. Set trig_level to negative value to disable triggered captures. Timestamps only valid if system is correctly sync'd!
+    Returns a dictionary keyed on ant_str. See get_adc_snapshot_group for the same data as one array."""
+    group = get_adc_snapshot_group(correlator, ant_strs, trig_level = trig_level, sync_to_pps = sync_to_pps, use_cache = use_cache)
     rv = {}
     for ant_n, ant_str in enumerate(ant_strs):
-        rv[ant_str] = {'data': numpy.fromstring(raw['data'][ant_n], dtype = numpy.int8), 'offset': raw['offsets'][ant_n], 'length': raw['lengths'][ant_n]}
-        ts = fpgas[ant_n].read_uint(dev_names[ant_n] + '_val')
-        rv[ant_str]['timestamp'] = correlator.time_from_mcnt((init_mcnt & 0xffffffff00000000) + ts)
-        if mcnt_lsbs > ts:
-            rv[ant_str]['timestamp'] += 0x100000000 # 32 bit number must've overflowed once.
-
+        rv[ant_str] = {'data': group['data'][ant_n], 'offset': group['offsets'][ant_n], 'length': group['lengths'][ant_n], 'timestamp': group['timestamps'][ant_n]}
     return rv
 
     #return numpy.fromstring(self.ffpgas[ffpga_n].snapshot_get('adc_snap%i'%feng_input,man_trig=False,circular_capture=True,wait_period=-1)['data'],dtype=numpy.int8)
 
+# complex values of every byte holding a 4-bit signed real part in the high nibble and imaginary part in the low nibble
+_nibbles = numpy.arange(256, dtype = numpy.uint8)
+_4bit_complex_lut = ((_nibbles.astype(numpy.int8) >> 4).astype(numpy.float32) + 1j * ((_nibbles << 4).astype(numpy.int8) >> 4).astype(numpy.float32)).astype(numpy.complex64)
+
+def unpack_4bit_complex(data, binary_point = 0, out = None):
+    """Unpack packed 4-bit signed complex values - real part in the high nibble, imaginary in the low nibble of each byte - into a complex64 array.
+    @param data: a binary string, or a numpy array of bytes (or of wider words, which are taken apart byte by byte in memory order)
+    @param binary_point: position of the binary point, the values are scaled by 2**-binary_point
+    @param out: optional complex64 array to unpack into
+    """
+    if isinstance(data, str):
+        data = numpy.frombuffer(data, dtype = numpy.uint8)
+    else:
+        data = numpy.ascontiguousarray(data).view(numpy.uint8)
+    lut = _4bit_complex_lut
+    if binary_point != 0:
+        lut = lut / numpy.float32(2**binary_point)
+    if out is None:
+        return lut[data]
+    return numpy.take(lut, data, out = out)
+
 def get_quant_snapshot(correlator, ant_str, n_spectra = 1, man_trig = False, man_valid = False, wait_period = 2):
     """
     Fetches a quantiser snapshot from hardware for a single given antenna.
-    Returns a numpy array.
+    Returns a complex64 numpy array and the number of spectra in it.
     """
     if correlator.config['feng_bits'] != 4:
         raise RuntimeError('Sorry, this function is currently hard-coded to unpack 4 bit values')
     (ffpga_n, xfpga_n, fxaui_n, xxaui_n, feng_input) = correlator.get_ant_str_location(ant_str)
-    ns = 0
-    unpacked_vals = []
+    n_chans = correlator.config['n_chans']
+    rv = numpy.empty(n_spectra * n_chans, dtype = numpy.complex64)
+    # the number of values captured, anything beyond n_spectra is not kept
+    n_vals = 0
     fpga = correlator.ffpgas[ffpga_n]
-    while ns < n_spectra:
+    while n_vals < rv.size:
         if correlator.is_wideband():
             bram_dmp = fpga.snapshot_get('quant_snap%i' % feng_input, man_trig = man_trig, man_valid = man_valid, wait_period = wait_period)
-            pckd_8bit = numpy.fromstring(bram_dmp['data'], dtype = numpy.uint8)
-            for val in pckd_8bit:
-                # get the right 4 bit values:
-                r_bits = (val & ((2**8) - (2**4))) >> 4
-                i_bits = (val & ((2**4) - (2**0)))
-                # cast up to signed numbers:
-                unpacked_vals.append(float(((numpy.int8(r_bits << 4) >> 4))) + (1j * float(((numpy.int8(i_bits << 4) >> 4)))))
+            pckd_8bit = numpy.frombuffer(bram_dmp['data'], dtype = numpy.uint8)
+            n = min(pckd_8bit.size, rv.size - n_vals)
+            unpack_4bit_complex(pckd_8bit[0:n], out = rv[n_vals:n_vals + n])
+            n_vals += pckd_8bit.size
         elif correlator.is_narrowband():
-            # the narrowband snap block may be shorter than one spectrum, so make sure we get enough data
-            tempdata = []
-            offset = 0
-            while len(tempdata) < correlator.config['n_chans']:
-                #quanttemp = corr.corr_nb.get_snap_quant(correlator, [fpga], offset = offset)[0][feng_input]
-                logging.debug('get_quant_snapshot: nb, read snap - have %i/%i channels' % (len(tempdata), correlator.config['n_chans']))
-                quanttemp = corr.corr_nb.get_snap_quant_wbc_compat(correlator, [fpga], offset = offset)[0][feng_input]
-                tempdata.extend(quanttemp)
-                # the debug snap block is 1024 128-bit words, so it's 16kbytes long. The offset is in BYTES!
-                # the data in tempdata represents 128-bit WORDS
-                offset = offset + (len(quanttemp) * 128/8)
-            unpacked_vals.extend(tempdata)
+            # the narrowband snap block may be shorter than one spectrum, so keep capturing at increasing offsets until we have enough data
+            corr.corr_functions.write_masked_register([fpga], corr.corr_nb.register_fengine_control, debug_snap_select = corr.corr_nb.snap_fengine_debug_select['quant_16'])
+            spectrum_start = n_vals
+            for chunk in snapshots_stream([fpga], corr.corr_nb.snap_debug, wait_period = 3):
+                logging.debug('get_quant_snapshot: nb, read snap - have %i/%i channels' % (n_vals - spectrum_start, n_chans))
+                quanttemp = corr.corr_nb.get_snap_quant(correlator, [fpga], wbc_compat = True, debug_data = {'data': chunk['data']}, setup_snap = False)[0][feng_input]
+                n = min(len(quanttemp), rv.size - n_vals)
+                rv[n_vals:n_vals + n] = quanttemp[0:n]
+                n_vals += len(quanttemp)
+                if n_vals - spectrum_start >= n_chans:
+                    break
         else:
             raise RuntimeError('Unknown mode.')
-        ns = len(unpacked_vals) / correlator.config['n_chans']
-        logging.debug('get_quant_snapshot: got spectrum %i/%i' % (ns, n_spectra))
-    rv = numpy.array(unpacked_vals)
-    if len(rv) % correlator.config['n_chans'] != 0:
+        logging.debug('get_quant_snapshot: got spectrum %i/%i' % (n_vals / n_chans, n_spectra))
+    if n_vals % n_chans != 0:
         raise RuntimeError('Retrieved data is not a multiple of n_chans, something is wrong.')
-    rv.shape = (ns, correlator.config['n_chans'])
-    if ns < n_spectra:
-        raise RuntimeError('Needed %i spectra, but only ended up with %i, something is wrong.' % (n_spectra, ns))
+    rv.shape = (n_spectra, n_chans)
     if n_spectra == 1:
         return rv[0], 1
     else:
-        return rv[0:n_spectra, :], n_spectra
+        return rv, n_spectra
 
 def Swapped(subcon):
     """swaps the bytes of the stream, prior to parsing"""
@@ -189,8 +729,25 @@ def Swapped(subcon):
         resizer = lambda length: length
     )
 
+def snapshot_decode(raw, bitstruct):
+    """Decode the data of each snap block in a snapshots_get result with the compiled form of a BitStruct.
+    Returns a list of dictionaries: fpga_index, and columns - a dictionary of numpy arrays, one per field.
+    """
+    compiled = corr.bitfield.compile_bitstruct(bitstruct)
+    rv = []
+    for index, d in enumerate(raw['data']):
+        rv.append({'fpga_index': index, 'columns': compiled.decode(d)})
+    return rv
+
+def _snapshot_rows(decoded):
+    """Add the list-of-records view, as GreedyRepeater used to give, to decoded snapshots."""
+    for v in decoded:
+        v['data'] = corr.bitfield.RowView(v['columns'])
+    return decoded
+
 def get_rx_snapshot(correlator, xfpgas = [], snapname = 'snap_rx0'):
-    "Grabs a snapshot of the decoded incomming packet stream. xeng_ids is a list of integers (xeng core numbers)."
+    """Grabs a snapshot of the decoded incomming packet stream. xeng_ids is a list of integers (xeng core numbers).
+    Returns a list of dictionaries, one per fpga: fpga_index, columns - numpy arrays of each field (mcnt, ant, data, valid, etc) - and data, the same fields as a list of records."""
     if xfpgas == []:
        xfpgas = correlator.xfpgas
     raw = snapshots_get(xfpgas, snapname, wait_period = 3, circular_capture = False, man_trig = False)
@@ -199,19 +756,12 @@ def get_rx_snapshot(correlator, xfpgas = [], snapname = 'snap_rx0'):
     elif correlator.is_narrowband():
         rx_bf = corr.corr_nb.snap_xengine_rx
     else: raise RuntimeError('Unknown mode. Cannot get rx snapshot.')
-    unp_rpt = construct.GreedyRepeater(rx_bf)
-    rv = []
-    for index, d in enumerate(raw['data']):
-        v= {}
-        v['fpga_index'] = index
-        v['data'] = unp_rpt.parse(d)
-        rv.append(v)
-    return rv
+    return _snapshot_rows(snapshot_decode(raw, rx_bf))
 
 def get_gbe_rx_snapshot(correlator, xfpgas = [], snapname = 'snap_gbe_rx0'):
     """
     Takes a list of X-ENGINE fpgas and returns the contents of the snap_gbe_rx0 block for each of them in a list.
-    The list contents is a dictionary of the decoded data.
+    The list contents is a dictionary of the decoded data: numpy arrays of each field in columns, and a list of records in data.
     """
     if xfpgas == []:
        xfpgas = correlator.xfpgas
@@ -222,44 +772,26 @@ def get_gbe_rx_snapshot(correlator, xfpgas = [], snapname = 'snap_gbe_rx0'):
         rx_bf = corr.corr_nb.snap_xengine_gbe_rx
     else:
         raise RuntimeError('Unknown mode. Cannot get gbe rx snapshot.')
-    unp_rpt = construct.GreedyRepeater(rx_bf)
-    rv = []
-    for index, d in enumerate(raw['data']):
-        v = {}
-        v['fpga_index'] = index
-        v['data'] = unp_rpt.parse(d)
-        rv.append(v)
-    return rv
+    return _snapshot_rows(snapshot_decode(raw, rx_bf))
 
 
 def get_gbe_tx_snapshot_xeng(correlator, snapnames = 'snap_gbe_tx0', offset = -1, man_trigger = False, man_valid = False):
     raw = snapshots_get(correlator.xfpgas, dev_names = snapnames, wait_period = 3, circular_capture = False, man_trig = man_trigger, offset = offset, man_valid = man_valid)
-    unp_rpt = construct.GreedyRepeater(corr.corr_wb.snap_xengine_gbe_tx)
-    rv = []
-    for index, d in enumerate(raw['data']):
-        v = {}
-        v['fpga_index'] = index
-        v['data'] = unp_rpt.parse(d)
-        rv.append(v)
-    return rv
+    return _snapshot_rows(snapshot_decode(raw, corr.corr_wb.snap_xengine_gbe_tx))
 
 def get_gbe_tx_snapshot_feng(correlator, snap_name = 'snap_gbe_tx0', offset = -1, man_trigger = False, man_valid = False):
     raw = snapshots_get(correlator.ffpgas, dev_names = snap_name, wait_period = 3, circular_capture = False, man_trig = man_trigger, offset = offset)
-    unp_rpt = construct.GreedyRepeater(corr.corr_wb.snap_fengine_gbe_tx)
-    rv = []
+    rv = snapshot_decode(raw, corr.corr_wb.snap_fengine_gbe_tx)
     #step though each FPGA for which we got snap data:
-    for index, d in enumerate(raw['data']):
-        v = {}
-        v['fpga_index'] = index
-        v['data'] = unp_rpt.parse(d)
+    for v in rv:
+        cols = v['columns']
+        n = len(cols['eof'])
         #add some fake values to make it look like a XAUI snap block so we can use the same functions on this data interchangeably:
-        for dp in v['data']:
-            dp['link_down'] = not dp['link_up']
-            dp['hdr_valid'] = False
-            dp['mrst'] = False
-            dp['sync'] = False
-        rv.append(v)
-    return rv
+        cols['link_down'] = numpy.logical_not(cols['link_up'])
+        cols['hdr_valid'] = numpy.zeros(n, dtype = numpy.bool_)
+        cols['mrst'] = numpy.zeros(n, dtype = numpy.bool_)
+        cols['sync'] = numpy.zeros(n, dtype = numpy.bool_)
+    return _snapshot_rows(rv)
 
 def get_xaui_snapshot(correlator, snap_name = None, offset = -1, man_trigger = False, man_valid = False, wait_period = 3):
     """Grabs data from fengines' TX xaui blocks"""
@@ -279,19 +811,105 @@ def get_xaui_snapshot(correlator, snap_name = None, offset = -1, man_trigger = F
         raw = corr.corr_nb.get_snap_xaui(correlator, correlator.ffpgas, offset = offset, man_trigger = man_trigger, man_valid = man_valid, wait_period = wait_period)
     else:
         raise RuntimeError('Unsupported correlator type.')
-    unpack_repeater = construct.GreedyRepeater(snap_bitfield)
-    rv = []
-    for index, d in enumerate(raw['data']):
-        v = {}
-        v['fpga_index'] = index
-        v['data'] = unpack_repeater.parse(d)
-        for dp in v['data']:
-            dp['ip_addr'] = 0
-            dp['link_up'] = not dp['link_down']
-            dp['tx_over'] = False
-            dp['tx_full'] = False
-            dp['led_tx'] = False
-            dp['link_up'] = False
-        rv.append(v)
+    rv = snapshot_decode(raw, snap_bitfield)
+    for v in rv:
+        cols = v['columns']
+        n = len(cols['eof'])
+        # fake values to make it look like a 10GbE tx snap block
+        cols['ip_addr'] = numpy.zeros(n, dtype = numpy.uint32)
+        cols['link_up'] = numpy.logical_not(cols['link_down'])
+        cols['tx_over'] = numpy.zeros(n, dtype = numpy.bool_)
+        cols['tx_full'] = numpy.zeros(n, dtype = numpy.bool_)
+        cols['led_tx'] = numpy.zeros(n, dtype = numpy.bool_)
+    return _snapshot_rows(rv)
+
+
+def snapshot_packets(columns, packet_len, header_field = None, skip_first = False, binary_point = 0, n_chans = None):
+    """
+    Rebuild the packets in a decoded 10GbE or XAUI snapshot (the columns of get_gbe_rx_snapshot, get_gbe_tx_snapshot_feng or get_xaui_snapshot).
+    A packet ends at a word with eof set and starts with its header word, either the word after the previous eof or, if header_field is given, the last word flagged in that column.
+    Each payload word holds four samples of 16 bits, most significant first: 4-bit real and imaginary for pol 0 (Q) in the high byte, then for pol 1 (I).
+    @param columns: dictionary of numpy arrays, with at least data and eof
+    @param packet_len: the expected payload length in 64-bit words, not counting the header. Packets of any other length are marked malformed and not unpacked.
+    @param header_field: optional column that marks header words, eg 'hdr_valid'. Packets without a marked header are dropped.
+    @param skip_first: drop the words before the first eof, which belong to a packet whose start wasn't captured
+    @param binary_point: position of the binary point of the 4-bit samples
+    @param n_chans: if given, freq is worked out as mcnt modulo n_chans
+    @return a dictionary: packets - a numpy structured array with one record per packet (header_index, eof_index, length in words including the header, header, mcnt, ant, freq, ip_addr, valid),
+            and samples - a complex64 array (packets, packet_len * 4, 2 pols) holding the samples of each valid packet and zeros for malformed ones.
+    """
+    data = numpy.asarray(columns['data'], dtype = numpy.uint64)
+    eofs = numpy.flatnonzero(columns['eof'])
+    # each packet starts after the previous one's eof. No eofs gives an empty packet table.
+    starts = numpy.zeros(len(eofs), dtype = numpy.int64)
+    starts[1:] = eofs[:-1] + 1
+    if skip_first:
+        eofs = eofs[1:]
+        starts = starts[1:]
+    if header_field != None:
+        headers = numpy.flatnonzero(columns[header_field])
+        last_header = numpy.searchsorted(headers, eofs, side = 'right') - 1
+        found = last_header >= 0
+        found[found] = headers[last_header[found]] >= starts[found]
+        eofs = eofs[found]
+        starts = headers[last_header[found]]
+    packets = numpy.zeros(len(eofs), dtype = [('header_index', numpy.int32), ('eof_index', numpy.int32), ('length', numpy.int32), ('header', numpy.uint64),
+        ('mcnt', numpy.uint64), ('ant', numpy.uint16), ('freq', numpy.uint32), ('ip_addr', numpy.uint32), ('valid', numpy.bool_)])
+    packets['header_index'] = starts
+    packets['eof_index'] = eofs
+    packets['length'] = eofs - starts + 1
+    packets['header'] = data[starts]
+    packets['mcnt'] = packets['header'] >> numpy.uint64(16)
+    packets['ant'] = packets['header'] & numpy.uint64(0xffff)
+    if n_chans != None:
+        packets['freq'] = packets['mcnt'] % numpy.uint64(n_chans)
+    if columns.has_key('ip_addr'):
+        packets['ip_addr'] = columns['ip_addr'][eofs]
+    packets['valid'] = packets['length'] == (packet_len + 1)
+    samples = numpy.zeros((len(eofs), packet_len * 4, 2), dtype = numpy.complex64)
+    good = numpy.flatnonzero(packets['valid'])
+    if len(good) > 0:
+        payload = data[starts[good, numpy.newaxis] + 1 + numpy.arange(packet_len)]
+        samples[good] = unpack_4bit_complex(payload.astype('>u8'), binary_point = binary_point).reshape(len(good), packet_len * 4, 2)
+    return {'packets': packets, 'samples': samples}
+
+def packet_levels(samples):
+    """
+    Power statistics of the samples of rebuilt packets, see snapshot_packets.
+    @return a dictionary of (packets, 2 pols) arrays: level_r and level_i, the rms of the real and imaginary parts, rms, the rms of the complex values, and peak, the largest real or imaginary value.
+    """
+    rv = {}
+    rv['level_r'] = numpy.sqrt(numpy.mean(samples.real ** 2, axis = 1))
+    rv['level_i'] = numpy.sqrt(numpy.mean(samples.imag ** 2, axis = 1))
+    rv['rms'] = numpy.sqrt(rv['level_r'] ** 2 + rv['level_i'] ** 2)
+    rv['peak'] = numpy.maximum(samples.real.max(axis = 1), samples.imag.max(axis = 1))
     return rv
 
+def malformed_packet_levels(columns, packets, levels, binary_point = 0):
+    """
+    Fill in the power statistics of the malformed packets in levels (from packet_levels) from the payload words those packets did have.
+    snapshot_packets leaves their samples at zero, as they don't fit its fixed-length table.
+    @param columns: the snapshot columns given to snapshot_packets
+    @param packets: the packet table from snapshot_packets
+    """
+    data = numpy.asarray(columns['data'], dtype = numpy.uint64)
+    for n in numpy.flatnonzero(~packets['valid']):
+        payload = data[packets['header_index'][n] + 1:packets['eof_index'][n] + 1]
+        if len(payload) == 0:
+            continue
+        samples = unpack_4bit_complex(payload.astype('>u8'), binary_point = binary_point).reshape(1, len(payload) * 4, 2)
+        for key, value in packet_levels(samples).iteritems():
+            levels[key][n] = value[0]
+    return levels
+
+def packets_by_mcnt(packets, n_ants):
+    """
+    Index rebuilt packets by mcnt and antenna.
+    @return the sorted unique mcnts, and an (mcnts, n_ants) array of the index of each antenna's packet for that mcnt in the packet table, -1 if it wasn't received.
+    """
+    mcnts, inverse = numpy.unique(packets['mcnt'], return_inverse = True)
+    rv = numpy.ones((len(mcnts), n_ants), dtype = numpy.int64) * -1
+    ants = packets['ant'].astype(numpy.int64)
+    in_range = ants < n_ants
+    rv[inverse[in_range], ants[in_range]] = numpy.flatnonzero(in_range)
+    return mcnts, rv
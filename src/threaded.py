@@ -1,15 +1,163 @@
-import katcp_wrapper
+import katcp_wrapper, threading, Queue, time
+
+class FpgaJob:
+    """A handle to a single job submitted to an FpgaWorkerPool, in the style of a future.
+       """
+    def __init__(self, fpga, job_function, job_args):
+        self.fpga = fpga
+        self.host = fpga.host
+        self.job = job_function
+        self.job_args = job_args
+        self.time_submitted = time.time()
+        self._done = threading.Event()
+        self._result = None
+        self._error = None
+    def __str__(self):
+        return '%s(%s)@(%10.5f) - %s' % (self.job.func_name, self.host, self.time_submitted, 'done' if self.done() else 'pending')
+    def run(self):
+        try:
+            self._result = self.job(self.fpga, *self.job_args)
+        except Exception as exc:
+            self._error = RuntimeError("Job %s internal error: %s, %s" % (self.job.func_name, type(exc), exc))
+        self._done.set()
+    def done(self):
+        '''Has this job finished, successfully or not?
+        '''
+        return self._done.isSet()
+    def result(self, timeout = None):
+        """Wait for the job to finish and return its result. Raises a RuntimeError if the job failed or timed out.
+
+        @param timeout: seconds to wait. None waits forever.
+        """
+        self._done.wait(timeout)
+        if not self._done.isSet():
+            raise RuntimeError("Job %s on %s timed out after %.2fs." % (self.job.func_name, self.host, time.time() - self.time_submitted))
+        if self._error != None:
+            raise self._error
+        return self._result
+
+class FpgaWorkerPool:
+    """A bounded pool of long-lived threads that run jobs on FpgaClient objects.
+    Threads are started as they are needed, up to num_threads, and then reused for every later job.
+    """
+    def __init__(self, num_threads = 8):
+        """
+        @param num_threads: the maximum number of worker threads, ie the maximum number of concurrent jobs.
+        """
+        if num_threads < 1:
+            raise RuntimeError('A worker pool needs at least one thread.')
+        self.num_threads = num_threads
+        self._request_queue = Queue.Queue()
+        self._workers = []
+        self._workers_lock = threading.Lock()
+        # jobs submitted and not yet finished, only changed with _workers_lock held
+        self._outstanding = 0
+        self._stopped = False
+
+    def _worker(self):
+        while True:
+            job = self._request_queue.get()
+            if job == None:
+                return
+            job.run()
+            self._workers_lock.acquire()
+            self._outstanding -= 1
+            self._workers_lock.release()
+
+    def _grow(self):
+        # count a new job and start another worker if there are more unfinished jobs than workers
+        self._workers_lock.acquire()
+        self._outstanding += 1
+        if (self._outstanding > len(self._workers)) and (len(self._workers) < self.num_threads):
+            w = threading.Thread(target = self._worker)
+            w.daemon = True
+            self._workers.append(w)
+            w.start()
+        self._workers_lock.release()
+
+    def submit(self, fpga, job_function, *job_args):
+        """Queue a job to be run on one of the pool's threads.
+
+        @param fpga: FpgaClient object, passed as the first argument to job_function
+        @param job_function: the function to be run
+        @param *job_args: further arguments for the job_function
+
+        @return an FpgaJob from which the result can be fetched
+        """
+        if self._stopped:
+            raise RuntimeError('Worker pool has been stopped.')
+        if not isinstance(fpga, katcp_wrapper.FpgaClient):
+            raise TypeError('Currently this pool only supports FpgaClient objects.')
+        job = FpgaJob(fpga, job_function, job_args)
+        self._grow()
+        self._request_queue.put(job)
+        return job
+
+    def map(self, fpga_list, job_function, job_args = (), timeout = None):
+        """Run job_function on every FpgaClient in the list and wait for the results.
+
+        @param fpga_list: list of FpgaClient objects
+        @param job_function: the function to be run - MUST take the FpgaClient object as its first argument
+        @param job_args: tuple of further arguments for the job_function
+        @param timeout: seconds to allow each job, counted from when it was submitted. None waits forever.
+
+        @return a dictionary of results keyed on FpgaClient.host. Jobs that failed or timed out have a RuntimeError as their result.
+        """
+        jobs = [self.submit(f, job_function, *job_args) for f in fpga_list]
+        rv = {}
+        for job in jobs:
+            remaining = None if timeout == None else max(0, job.time_submitted + timeout - time.time())
+            try:
+                rv[job.host] = job.result(remaining)
+            except RuntimeError as exc:
+                rv[job.host] = exc
+        return rv
+
+    def stop(self):
+        """Let the worker threads exit once the jobs already queued are done."""
+        self._stopped = True
+        for w in self._workers:
+            self._request_queue.put(None)
+
+# the number of threads in the module-wide pool, for boards that don't belong to a Correlator
+shared_pool_threads = 16
+
+_shared_pool = None
+_shared_pool_lock = threading.Lock()
+
+def shared_pool():
+    """Return the module-wide FpgaWorkerPool, creating it with shared_pool_threads threads if necessary. Its size is fixed once it has been created."""
+    global _shared_pool
+    _shared_pool_lock.acquire()
+    if _shared_pool == None:
+        _shared_pool = FpgaWorkerPool(max(1, shared_pool_threads))
+    _shared_pool_lock.release()
+    return _shared_pool
+
+def pool_for(fpga_list):
+    """Return the FpgaWorkerPool to run jobs on the given FpgaClient objects: the pool they were given by their Correlator if they all share one, otherwise the module-wide pool."""
+    pools = []
+    for f in fpga_list:
+        pool = getattr(f, 'pool', None)
+        if pool == None:
+            return shared_pool()
+        if pool not in pools:
+            pools.append(pool)
+    if len(pools) != 1:
+        return shared_pool()
+    return pools[0]
 
 def fpga_operation(fpga_list, num_threads = -1, job_function = None, *job_args):
     """Run a provided method on a list of FpgaClient objects in a specified number of threads.
+    The threads belong to the boards' FpgaWorkerPool (see pool_for), so they are started once and reused by later calls.
 
     @param fpga_list: list of FpgaClient objects
-    @param num_threads: how many threads should be used. Default is one per list item
+    @param num_threads: kept for compatibility. The number of threads is capped by the pool.
     @param job_function: the function to be run - MUST take the FpgaClient object as its first argument
     @param *args: further arugments for the job_function
-   
+
     @return a dictionary of results from the functions, keyed on FpgaClient.host
- 
+
     """
 
     """
@@ -26,56 +174,43 @@ def fpga_operation(fpga_list, num_threads = -1, job_function = None, *job_args):
 
     if job_function == None:
         raise RuntimeError("job_function == None?")
-    import threading, Queue
-    # thread class to perform a job from a queue
-    class Corr_worker(threading.Thread):
-        def __init__(self, request_queue, result_queue, job_function, *job_args):
-            self.request_queue = request_queue
-            self.result_queue = result_queue
-            self.job = job_function
-            self.job_args = job_args
-            threading.Thread.__init__(self)
-        def run(self):
-            done = False
-            while not done:
-                try:
-                    # get a job from the queue
-                    request_host = self.request_queue.get(False)
-                    # do some work
-                    try:
-                        result = self.job(request_host, *self.job_args)
-                    except Exception as exc:
-                        errstr = "Job %s internal error: %s, %s" % (self.job.func_name, type(exc), exc)
-                        result = RuntimeError(errstr)
-                    # put the result on the result queue
-                    self.result_queue.put((request_host.host, result))
-                    # and notify done
-                    self.request_queue.task_done()
-                except:
-                    done = True
     if not isinstance(fpga_list, list):
         raise TypeError("fpga_list should be a list() of FpgaClient objects only.")
-    if num_threads == -1:
-        num_threads = len(fpga_list)
-    # create the request and result queues
-    request_queue = Queue.Queue()
-    result_queue = Queue.Queue()
-    # put the list items into a Thread-safe Queue
     for f in fpga_list:
         if not isinstance(f, katcp_wrapper.FpgaClient):
             raise TypeError('Currently this function only supports FpgaClient objects.')
-        request_queue.put(f)
-    # make as many worker threads a specified and start them off
-    workers = [Corr_worker(request_queue, result_queue, job_function, *job_args) for i in range(0, num_threads)]
-    for w in workers:
-        w.daemon = True
-        w.start()
-    # join the last one to wait for completion
-    request_queue.join()
-    # format the result into a dictionary by host
-    rv = {}
-    while not result_queue.empty():
-        res = result_queue.get()
-        rv[res[0]] = res[1]
-    return rv
+    return pool_for(fpga_list).map(fpga_list, job_function, job_args)
+
+def run_jobs(fpga_list, job_function, job_args_list, pool = None):
+    """Run job_function(fpga_list[n], *job_args_list[n]) for each item in the list and return the results in list order.
+    The jobs run concurrently on the pool if they are all FpgaClient objects, otherwise one after the other.
+    Unlike fpga_operation, the same FpgaClient may appear in the list more than once.
 
+    @param fpga_list: list of FpgaClient objects
+    @param job_function: the function to be run - MUST take the FpgaClient object as its first argument
+    @param job_args_list: list of tuples of further arguments, one per item in fpga_list
+    @param pool: the FpgaWorkerPool to use. Default is the boards' own pool, see pool_for.
+
+    @return a list of results. Raises a RuntimeError listing every job that failed.
+    """
+    if len(job_args_list) != len(fpga_list):
+        raise RuntimeError('Need one set of job arguments per FPGA.')
+    concurrent = len(fpga_list) > 1
+    for f in fpga_list:
+        if not isinstance(f, katcp_wrapper.FpgaClient):
+            concurrent = False
+    if not concurrent:
+        return [job_function(f, *job_args_list[n]) for n, f in enumerate(fpga_list)]
+    if pool == None:
+        pool = pool_for(fpga_list)
+    jobs = [pool.submit(f, job_function, *job_args_list[n]) for n, f in enumerate(fpga_list)]
+    rv = []
+    errors = []
+    for job in jobs:
+        try:
+            rv.append(job.result())
+        except RuntimeError as exc:
+            errors.append('%s: %s' % (job.host, exc))
+    if len(errors) > 0:
+        raise RuntimeError('%s failed on %i of %i FPGAs:\n%s' % (job_function.func_name, len(errors), len(jobs), '\n'.join(errors)))
+    return rv